@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# asyncio API for running conversions from an event loop.
+#
+#   report = await convert_onnx_async('model.onnx', timeout=600)
+#
+# Conversions run in warm worker processes (TensorFlow stays imported between
+# jobs), model/output files are read and written off the event loop, and at
+# most max_concurrent conversions run at once. A conversion that is cancelled
+# or times out has its worker process killed, so it stops using CPU.
+
+import asyncio
+import importlib
+import multiprocessing
+import os
+import traceback
+import weakref
+
+import compressed_io
+import conversion_report
+import tb_event_writer
+
+
+# Frontend -> (module, function) converting model bytes to GraphDef bytes,
+# function(model_data, report, options). Workers import the module by name.
+FRONTENDS = {
+    'onnx': ('onnx2tf', 'convert_onnx_data'),
+    'caffe': ('caffe2tf', 'convert_caffe_data'),
+}
+# Seconds a cancelled worker gets to exit after SIGTERM before SIGKILL
+KILL_TIMEOUT = 5.0
+
+
+class ConversionError(RuntimeError):
+    pass
+
+
+def _worker_main(conn):
+    # Runs in the worker process, converters stay imported between jobs
+    while True:
+        try:
+            frontend, (module_name, function_name), model_data, model_path, output_path, options = conn.recv()
+        except EOFError:
+            return
+        report = conversion_report.new_report(frontend, model_path, output_path)
+        try:
+            convert_data = getattr(importlib.import_module(module_name), function_name)
+            data = convert_data(model_data, report, options)
+            conn.send(('ok', data, report))
+        except Exception:
+            conn.send(('error', traceback.format_exc(), report))
+
+
+class _Worker(object):
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self, timeout=None):
+        # Blocks until the worker is gone, run it off the event loop
+        self.process.terminate()
+        self.process.join(KILL_TIMEOUT if timeout is None else timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class ConversionPool(object):
+    def __init__(self, max_concurrent=None):
+        self.max_concurrent = max_concurrent or os.cpu_count() or 1
+        self._context = multiprocessing.get_context('spawn')
+        # One semaphore per event loop: a semaphore is bound to the loop it
+        # first waits on, and each asyncio.run() starts a new loop. Warm
+        # workers are shared, so max_concurrent applies per loop.
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._idle = []
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphores[loop]
+
+    async def convert(self, frontend, model_path, output_path=None, timeout=None, options=None):
+        # options takes the converters' command line flags, e.g. {'dedup': True}
+        if output_path is None:
+            output_path = os.path.splitext(compressed_io.strip_codec(model_path))[0] + '.pb'
+        return await asyncio.wait_for(self._convert(frontend, model_path, output_path, options), timeout)
+
+    async def _kill(self, worker):
+        # Shielded so a second cancellation cannot leave the worker running
+        loop = asyncio.get_running_loop()
+        await asyncio.shield(loop.run_in_executor(None, worker.kill))
+
+    async def _convert(self, frontend, model_path, output_path, options):
+        loop = asyncio.get_running_loop()
+        if frontend not in FRONTENDS:
+            raise ValueError('Unknown frontend %r, expected one of %s' % (frontend, ', '.join(sorted(FRONTENDS))))
+        async with self._semaphore():
+            model_data = await loop.run_in_executor(None, compressed_io.read_file, model_path)
+            worker = self._idle.pop() if len(self._idle) > 0 else _Worker(self._context)
+            try:
+                await loop.run_in_executor(None, worker.conn.send, (frontend, FRONTENDS[frontend], model_data, model_path, output_path, options))
+                del model_data
+                status, payload, report = await loop.run_in_executor(None, worker.conn.recv)
+            except (EOFError, OSError):
+                await self._kill(worker)
+                raise ConversionError('Conversion worker exited while converting %s' % model_path)
+            except BaseException:
+                # Cancelled or timed out, the worker may still be converting.
+                # The slot is given back once it has exited.
+                await self._kill(worker)
+                raise
+            self._idle.append(worker)
+            if status != 'ok':
+                raise ConversionError('Converting %s failed:\n%s' % (model_path, payload))
+            with conversion_report.timed(report, 'write'):
+                file_bytes = await loop.run_in_executor(None, compressed_io.write_file, output_path, payload)
+            if compressed_io.codec_of_path(output_path) is not None:
+                report['compressed_bytes'] = file_bytes
+            if options is not None and options.get('logdir'):
+                with conversion_report.timed(report, 'events'):
+                    report['event_file'] = await loop.run_in_executor(None, tb_event_writer.write_graph_event, payload, options['logdir'])
+            return report
+
+    def close(self):
+        while len(self._idle) > 0:
+            self._idle.pop().kill()
+
+
+_default_pool = None
+
+
+def get_pool():
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ConversionPool()
+    return _default_pool
+
+
+async def convert_onnx_async(model_path, output_path=None, timeout=None, options=None, pool=None):
+    return await (pool or get_pool()).convert('onnx', model_path, output_path, timeout, options)
+
+
+async def convert_caffe_async(model_path, output_path=None, timeout=None, options=None, pool=None):
+    return await (pool or get_pool()).convert('caffe', model_path, output_path, timeout, options)
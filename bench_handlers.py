@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Microbenchmark of the per-op conversion handlers, caffe2tf.convert_layer and
+# onnx2tf.convert_node. Each handler converts one layer on top of a synthetic
+# preceding graph (an input and a chain of ReLUs) of growing size. Handlers
+# that only append NodeDefs take the same time whatever the size, handlers
+# that import the graph for a shape lookup grow with it. The slope of the
+# least squares line through the timings (microseconds per preceding node)
+# and the log-log exponent between the smallest and largest graph tell them
+# apart.
+#
+#   $ python3 bench_handlers.py --sizes 50,200,800,3200 --json bench.json
+#   $ python3 bench_handlers.py --compare bench.json
+
+import argparse
+import json
+import math
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import graph_pb2
+
+import conversion_report
+
+# Input blob/tensor of every benchmark, NCHW
+INPUT_SHAPE = [1, 16, 32, 32]
+
+# Layer parameters of each Caffe handler. "x" is the end of the preceding
+# chain, "data" the net input.
+CAFFE_LAYERS = [
+    ('BatchNorm', ['x'], 'batch_norm_param { use_global_stats: true }'),
+    ('Concat', ['x', 'data'], ''),
+    ('Convolution', ['x'], 'convolution_param { num_output: 16 kernel_size: 3 pad: 1 }'),
+    ('Crop', ['x', 'data'], ''),
+    ('Deconvolution', ['x'], 'convolution_param { num_output: 16 kernel_size: 2 stride: 2 }'),
+    ('Eltwise', ['x', 'data'], ''),
+    ('Flatten', ['x'], ''),
+    ('InnerProduct', ['x'], 'inner_product_param { num_output: 10 }'),
+    ('LRN', ['x'], 'lrn_param { local_size: 5 }'),
+    ('Pooling', ['x'], 'pooling_param { pool: MAX kernel_size: 2 stride: 2 }'),
+    ('PriorBox', ['x', 'data'], 'prior_box_param { min_size: 8 aspect_ratio: 2 }'),
+    ('ReLU', ['x'], ''),
+    ('Reshape', ['x'], 'reshape_param { shape { dim: 0 dim: -1 } }'),
+    ('Softmax', ['x'], ''),
+    ('Python', ['x'], ''),
+]
+
+# ONNX handlers as (op_type, inputs, attributes, initializers), opset 9.
+# Inputs named "v" read a separate [1, 64] input.
+ONNX_NODES = [
+    ('Add', ['x', 'x'], {}, {}),
+    ('AveragePool', ['x'], {'kernel_shape': [2, 2], 'strides': [2, 2]}, {}),
+    ('BatchNormalization', ['x', 's', 'b', 'm', 'var'], {}, dict((name, np.ones([16], np.float32)) for name in ('s', 'b', 'm', 'var'))),
+    ('Concat', ['x', 'x'], {'axis': 1}, {}),
+    ('Constant', [], {'value': np.array([1, -1], np.int64)}, {}),
+    ('Conv', ['x', 'W'], {'kernel_shape': [3, 3], 'pads': [1, 1, 1, 1]}, {'W': np.ones([16, 16, 3, 3], np.float32)}),
+    ('Flatten', ['x'], {'axis': 1}, {}),
+    ('Gemm', ['v', 'G'], {'transB': 1}, {'G': np.ones([10, 64], np.float32)}),
+    ('GlobalAveragePool', ['x'], {}, {}),
+    ('LRN', ['x'], {'size': 5}, {}),
+    ('MaxPool', ['x'], {'kernel_shape': [2, 2], 'strides': [2, 2]}, {}),
+    ('Mul', ['x', 'x'], {}, {}),
+    ('Pad', ['x'], {'pads': [0, 0, 1, 1, 0, 0, 1, 1]}, {}),
+    ('Relu', ['x'], {}, {}),
+    ('Reshape', ['x', 'shape'], {}, {'shape': np.array([1, -1], np.int64)}),
+    ('Softmax', ['x'], {'axis': 1}, {}),
+    ('Sum', ['x', 'x'], {}, {}),
+    ('Transpose', ['x'], {'perm': [0, 2, 3, 1]}, {}),
+    ('Upsample', ['x', 'scales'], {'mode': 'nearest'}, {'scales': np.array([1, 1, 2, 2], np.float32)}),
+    ('Sigmoid', ['x'], {}, {}),
+]
+
+
+def time_handler(convert, graph_def, repeat):
+    # Median seconds of convert(copy of graph_def), each call in a fresh
+    # default graph like a conversion
+    times = []
+    for _ in range(repeat):
+        copy = graph_pb2.GraphDef()
+        copy.CopyFrom(graph_def)
+        with tf.Graph().as_default():
+            start = time.perf_counter()
+            convert(copy)
+            times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def caffe_cases(sizes, ops, repeat):
+    import google.protobuf.text_format
+    import caffe2tf
+    from caffe.proto import caffe_pb2
+
+    results = {}
+    for size in sizes:
+        text = 'layer { name: "data" type: "Input" top: "data" input_param { shape { dim: %s } } }\n' % ' dim: '.join(str(d) for d in INPUT_SHAPE)
+        bottom = 'data'
+        for i in range(size):
+            top = 'x' if i == size - 1 else 'relu%d' % i
+            text += 'layer { name: "%s" type: "ReLU" bottom: "%s" top: "%s" }\n' % (top, bottom, top)
+            bottom = top
+        net = caffe_pb2.NetParameter()
+        google.protobuf.text_format.Merge(text, net)
+        prefix = graph_pb2.GraphDef()
+        report = conversion_report.new_report('caffe')
+        for layer in net.layer:
+            caffe2tf.convert_layer(layer, prefix, report)
+        for op, bottoms, params in CAFFE_LAYERS:
+            if ops and op not in ops:
+                continue
+            layer = caffe_pb2.LayerParameter()
+            google.protobuf.text_format.Merge('name: "target" type: "%s" top: "target" %s %s' % (
+                op, ' '.join('bottom: "%s"' % (b if b != 'x' or size > 0 else 'data') for b in bottoms), params), layer)
+            results.setdefault(op, []).append((len(prefix.node), _time_or_error(lambda g: caffe2tf.convert_layer(layer, g, report), prefix, repeat)))
+    return results
+
+
+def _onnx_model(size, op, inputs, attributes, initializers):
+    import onnx
+    from onnx import helper, numpy_helper
+
+    nodes = []
+    bottom = 'data'
+    for i in range(size):
+        top = 'x' if i == size - 1 else 'relu%d' % i
+        nodes.append(helper.make_node('Relu', [bottom], [top], name=top))
+        bottom = top
+    inputs = [name if name != 'x' or size > 0 else 'data' for name in inputs]
+    tensors = [numpy_helper.from_array(array, name) for name, array in initializers.items()]
+    attrs = dict((key, numpy_helper.from_array(value) if isinstance(value, np.ndarray) else value) for key, value in attributes.items())
+    nodes.append(helper.make_node(op, inputs, ['target'], name='target', **attrs))
+    graph_inputs = [helper.make_tensor_value_info('data', onnx.TensorProto.FLOAT, INPUT_SHAPE),
+                    helper.make_tensor_value_info('v', onnx.TensorProto.FLOAT, [1, 64])]
+    graph_inputs += [helper.make_tensor_value_info(t.name, t.data_type, t.dims) for t in tensors]
+    graph = helper.make_graph(nodes, 'bench', graph_inputs, [helper.make_empty_tensor_value_info('target')], tensors)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 9)])
+    model.ir_version = 4
+    return model
+
+
+def onnx_cases(sizes, ops, repeat):
+    import onnx2tf
+
+    results = {}
+    for size in sizes:
+        for op, inputs, attributes, initializers in ONNX_NODES:
+            if ops and op not in ops:
+                continue
+            model = _onnx_model(size, op, inputs, attributes, initializers)
+            graph = model.graph
+            shapes = onnx2tf.onnx_shape_index(model, graph)
+            name_to_graph_input, name_to_tensor, placeholders, tensors = onnx2tf.extract_summary(graph)
+            prefix = graph_pb2.GraphDef()
+            onnx2tf.create_constants(prefix, name_to_graph_input, name_to_tensor, placeholders, tensors)
+            report = conversion_report.new_report('onnx')
+            report['tf_imports'] = {'avoided': 0, 'performed': 0}
+            for n in graph.node[:-1]:
+                prefix = onnx2tf.convert_node(n, prefix, report, shapes, name_to_tensor, False)
+            target = graph.node[-1]
+            results.setdefault(op, []).append((len(prefix.node), _time_or_error(lambda g: onnx2tf.convert_node(target, g, report, shapes, name_to_tensor, False), prefix, repeat)))
+    return results
+
+
+def _time_or_error(convert, graph_def, repeat):
+    try:
+        return time_handler(convert, graph_def, repeat)
+    except Exception as e:
+        # A handler the synthetic layer does not suit, reported instead of timed
+        return '%s: %s' % (type(e).__name__, str(e).splitlines()[0] if str(e) else '')
+
+
+def scaling(points):
+    # (slope in seconds per preceding node, log-log exponent) of the timings
+    timed = [(n, t) for n, t in points if not isinstance(t, str)]
+    if len(timed) < 2:
+        return None, None
+    mean_n = sum(n for n, _ in timed) / float(len(timed))
+    mean_t = sum(t for _, t in timed) / float(len(timed))
+    var_n = sum((n - mean_n) ** 2 for n, _ in timed)
+    slope = sum((n - mean_n) * (t - mean_t) for n, t in timed) / var_n if var_n > 0 else 0.0
+    (n0, t0), (n1, t1) = timed[0], timed[-1]
+    exponent = math.log(t1 / t0) / math.log(float(n1) / n0) if n0 > 0 and n1 > n0 and t0 > 0 and t1 > 0 else None
+    return slope, exponent
+
+
+def summarize(results):
+    summary = {}
+    for op, points in results.items():
+        slope, exponent = scaling(points)
+        summary[op] = {'nodes': [n for n, _ in points], 'seconds': [t for _, t in points], 'slope': slope, 'exponent': exponent}
+    return summary
+
+
+def print_summary(frontend, summary, repeat, previous=None):
+    sizes = next(iter(summary.values()))['nodes'] if summary else []
+    print('[i] %s handlers, median of %d calls, time per call by preceding graph size' % (frontend, repeat))
+    print('    %-20s %s %12s %8s %s' % ('handler', ''.join('%11s' % ('%d nodes' % n) for n in sizes), 'us/node', 'exponent', ' vs previous' if previous else ''))
+    for op in sorted(summary, key=lambda op: -(summary[op]['slope'] or 0)):
+        entry = summary[op]
+        cells = ''.join('%11s' % ('error' if isinstance(t, str) else '%.3f ms' % (t * 1e3)) for t in entry['seconds'])
+        slope = '-' if entry['slope'] is None else '%.3f' % (entry['slope'] * 1e6)
+        exponent = '-' if entry['exponent'] is None else '%.2f' % entry['exponent']
+        change = ''
+        old = (previous or {}).get(op)
+        if old is not None:
+            # Compared at the largest graph size timed in both runs
+            common = set(entry['nodes']) & set(old['nodes'])
+            if len(common) > 0:
+                t = entry['seconds'][entry['nodes'].index(max(common))]
+                old_t = old['seconds'][old['nodes'].index(max(common))]
+                if not isinstance(t, str) and not isinstance(old_t, str):
+                    change = '  %.2fx' % (t / old_t)
+        print('    %-20s %s %12s %8s%s' % (op, cells, slope, exponent, change))
+    for op in sorted(summary):
+        for t in summary[op]['seconds']:
+            if isinstance(t, str):
+                print('    %s: %s' % (op, t))
+                break
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Times each op conversion handler against growing preceding graphs.')
+    parser.add_argument('--frontend', choices=['caffe', 'onnx', 'both'], default='both', help='Default is both.')
+    parser.add_argument('--ops', help='Comma separated handlers to time, e.g. Convolution,Conv. Default is all.')
+    parser.add_argument('--sizes', default='50,200,800,3200', help='Comma separated lengths of the preceding ReLU chain. Default is 50,200,800,3200.')
+    parser.add_argument('--repeat', type=int, default=5, help='Calls per handler and size, the median is reported. Default is 5.')
+    parser.add_argument('--json', help='Write the timings to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run, compared at the largest graph size both runs timed')
+    args = parser.parse_args(args)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    ops = set(args.ops.split(',')) if args.ops else None
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['frontends']
+    frontends = ['caffe', 'onnx'] if args.frontend == 'both' else [args.frontend]
+    output = {'sizes': sizes, 'repeat': args.repeat, 'tensorflow': tf.__version__, 'frontends': {}}
+    for frontend in frontends:
+        results = (caffe_cases if frontend == 'caffe' else onnx_cases)(sizes, ops, args.repeat)
+        summary = summarize(results)
+        output['frontends'][frontend] = summary
+        print_summary(frontend, summary, args.repeat, previous.get(frontend))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+        print('[i] JSON: ', args.json)
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
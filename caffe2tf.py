@@ -2,8 +2,11 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import argparse
-import code
+import collections
+import hashlib
+import re
 import struct
+import sys
 
 import google.protobuf.text_format
 import numpy as np
@@ -12,490 +15,1022 @@ from tensorflow.core.framework import (attr_value_pb2, graph_pb2, node_def_pb2,
                                        op_def_pb2)
 from tensorflow.python.framework import tensor_shape, tensor_util
 
+import compressed_io
+import conversion_checkpoint
+import conversion_progress
+import conversion_report
+import graph_passes
+import graphdef_wire
+import layer_templates
+import model_watch
+import sharded_graphdef
+import tb_event_writer
 from caffe.proto import caffe_pb2
 
-unsupported_caffe_types = set()
+prior_box_cache = {}
 
-def gen_initial_graphdef(net):
-        output_graph_def = graph_pb2.GraphDef()
-        for i in range(len(net.layer)):
-                layer = net.layer[i]
-
-                if layer.type == "Input":
-                        placeholder = node_def_pb2.NodeDef()
-                        placeholder.op = 'Placeholder'
-                        placeholder.name = layer.name
-                        placeholder.attr["dtype"].type = 1
-                        temp_shape = list(layer.input_param.shape[0].dim)
-                        output_shape = [temp_shape[0], temp_shape[2], temp_shape[3], temp_shape[1]]
-                        placeholder.attr["shape"].CopyFrom(attr_value_pb2.AttrValue(shape=tensor_shape.TensorShape(output_shape).as_proto()))
-                        
-                        output_graph_def.node.extend([placeholder])
-                
-                elif layer.type == "BatchNorm":
-                        # Prepare attributes
-                        train = False
-                        is_not_training = layer.batch_norm_param.use_global_stats
-                        if is_not_training != 1:
-                                train = True
-                        input_name = layer.bottom[0]
-                        try:
-                                moment = layer.batch_norm_param.moving_average_fraction
-                        except:
-                                moment = 0.99 # TensorFlow default
-                        try:
-                                eps = layer.batch_norm_param.eps
-                        except:
-                                eps = 0.001 # TensorFlow default
-                        
-                        # Generate layer
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")[0]
-                                tensor = op.outputs[0]
-                                output_tensor = tf.layers.batch_normalization(tensor, momentum=moment, epsilon=eps, training=train, name=layer.name+'/BatchNorm')
-                                tf.identity(output_tensor, name=layer.name)
-     
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif layer.type == "Concat":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "ConcatV2"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        num_inputs = len(layer.bottom)
-                        new_node.attr["N"].i = num_inputs
-                        if num_inputs > 0:
-                                for i in layer.bottom:
-                                        new_node.input.extend([i]) 
-
-                        # Generate axis input tensor
-                        axis = node_def_pb2.NodeDef()
-                        axis.op = "Const"
-                        axis.name = new_node.name + "/axis"
-                        axis.attr["dtype"].type = 3 # DT_INT32
-                        axis.attr["value"].tensor.dtype = 3 # DT_INT32
-
-                        # Get Caffe axis
-                        try:
-                                caffe_axis = layer.concat_param.axis
-                        except:
-                                caffe_axis = 1 # Default axis param for caffe.Concat (Channels dimension)
-                        
-                        # Get bottom's output shape
-                        input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
-                        bottom_shape = input_as_op.outputs[0].shape.as_list()
-
-                        # Take into account NCHW ordering for Caffe.Concat vs NHWC for tf.Concat        
-                        if caffe_axis == 0:
-                                tf_axis = 0
-                        else:
-                                tf_axis = -1
+def gen_prior_boxes(param, layer_h, layer_w, img_h, img_w):
+        # Follows the PriorBox layer at https://github.com/weiliu89/caffe/blob/ssd/src/caffe/layers/prior_box_layer.cpp
+        key = (param.SerializeToString(), layer_h, layer_w, img_h, img_w)
+        if key in prior_box_cache:
+                return prior_box_cache[key]
 
-                        axis.attr["value"].tensor.int_val.append(tf_axis)
-                        new_node.input.extend([axis.name])
+        aspect_ratios = [1.0]
+        for ar in param.aspect_ratio:
+                if any(abs(ar - a) < 1e-6 for a in aspect_ratios):
+                        continue
+                aspect_ratios.append(ar)
+                if param.flip:
+                        aspect_ratios.append(1.0 / ar)
+        if param.HasField("img_h") or param.HasField("img_w"):
+                img_h, img_w = param.img_h, param.img_w
+        elif param.HasField("img_size"):
+                img_h, img_w = param.img_size, param.img_size
+        if param.HasField("step_h") or param.HasField("step_w"):
+                step_h, step_w = param.step_h, param.step_w
+        elif param.HasField("step"):
+                step_h, step_w = param.step, param.step
+        else:
+                step_h, step_w = float(img_h) / layer_h, float(img_w) / layer_w
 
-                        output_graph_def.node.extend([axis])
-                        output_graph_def.node.extend([new_node])
+        # Box sizes in caffe order for every location: min box, sqrt(min*max) box, then the other aspect ratios
+        box_w = []
+        box_h = []
+        for s, min_size in enumerate(param.min_size):
+                box_w.append(min_size)
+                box_h.append(min_size)
+                if len(param.max_size) > 0:
+                        box_w.append(np.sqrt(min_size * param.max_size[s]))
+                        box_h.append(np.sqrt(min_size * param.max_size[s]))
+                for ar in aspect_ratios[1:]:
+                        box_w.append(min_size * np.sqrt(ar))
+                        box_h.append(min_size / np.sqrt(ar))
+        half_w = np.array(box_w) / 2.0
+        half_h = np.array(box_h) / 2.0
 
-                elif layer.type == "Convolution":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Conv2D"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        try:
-                                stride = list(layer.convolution_param.stride)[0]
-                        except:
-                                stride = 1 # Default stride for tf.Conv2D
-                        stride_list = [1, stride, stride, 1]
-                        new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
-                        try:
-                                # Fails because padding default = 0, "VALID" anyways
-                                if layer.convolution_param.pad[0] == 0:
-                                        new_node.attr["padding"].s = "VALID".encode("utf-8")
-                                else:
-                                        new_node.attr["padding"].s = "SAME".encode("utf-8")
-                        except:
-                                new_node.attr["padding"].s = "VALID".encode("utf-8")
-                        # new_node.attr["padding"].s = "VALID".encode("utf-8")
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])    
+        # [layer_h, layer_w, num_priors, 4] as (xmin, ymin, xmax, ymax)
+        center_x = ((np.arange(layer_w) + param.offset) * step_w)[np.newaxis, :, np.newaxis]
+        center_y = ((np.arange(layer_h) + param.offset) * step_h)[:, np.newaxis, np.newaxis]
+        boxes = np.empty((layer_h, layer_w, len(box_w), 4))
+        boxes[..., 0] = (center_x - half_w) / img_w
+        boxes[..., 1] = (center_y - half_h) / img_h
+        boxes[..., 2] = (center_x + half_w) / img_w
+        boxes[..., 3] = (center_y + half_h) / img_h
+        if param.clip:
+                np.clip(boxes, 0.0, 1.0, out=boxes)
 
-                        # Get bottom's output shape
-                        input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
-                        bottom_shape = input_as_op.outputs[0].shape.as_list()
-   
-                        # Generate kernel node
-                        kernel = node_def_pb2.NodeDef()
-                        kernel.op = "Const"      
-                        kernel.name = new_node.name + "/kernel"        
-                        kernel.attr["dtype"].type = 1
-                        kernel_shape = tensor_shape.TensorShape([layer.convolution_param.kernel_size[0],
-                                                                layer.convolution_param.kernel_size[0],
-                                                                bottom_shape[3],
-                                                                layer.convolution_param.num_output]).as_proto()
-                        kernel.attr["value"].tensor.tensor_shape.CopyFrom(kernel_shape) 
-                        
-                        new_node.input.extend([kernel.name])        
-
-                        output_graph_def.node.extend([kernel])
-                        output_graph_def.node.extend([new_node])
+        variance = list(param.variance)
+        if len(variance) == 0:
+                variance = [0.1] # Default caffe value
+        variances = np.empty_like(boxes)
+        variances[...] = variance
+
+        priors = np.stack([boxes.reshape(-1), variances.reshape(-1)])[np.newaxis].astype('<f4')
+        prior_box_cache[key] = priors
+        return priors
+
+def convert_layer(layer, output_graph_def, report):
+        # Appends the NodeDefs for one Caffe layer to output_graph_def
+        if layer.type == "Input":
+                placeholder = node_def_pb2.NodeDef()
+                placeholder.op = 'Placeholder'
+                placeholder.name = layer.name
+                placeholder.attr["dtype"].type = 1
+                if len(layer.input_param.shape) == 0:
+                        raise ValueError('Input "%s" has no shape' % layer.name)
+                output_shape = list(layer.input_param.shape[0].dim)
+                if len(output_shape) == 4:
+                        output_shape = [output_shape[0], output_shape[2], output_shape[3], output_shape[1]]
+                placeholder.attr["shape"].CopyFrom(attr_value_pb2.AttrValue(shape=tensor_shape.TensorShape(output_shape).as_proto()))
                 
-                elif layer.type == "Crop":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "ResizeBilinear"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        new_node.attr["align_corners"].b = False
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])    
-
-                        # Get bottom1's output shape (height and width only, generic case)
-                        input1_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
-                        bottom1_shape = input1_as_op.outputs[0].shape.as_list()
-
-                        # Get bottom2's output shape (height and width only, generic case)
-                        input2_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[1]], name="")[0]
-                        bottom2_shape = input2_as_op.outputs[0].shape.as_list()
-                        hw_list = bottom2_shape[1:3]
-
-                        if hw_list == [None, None]:
-                                hw_list = [-1, -1]
-
-                        shape_tuple = tuple(hw_list)
-                        pack_format = '<'+'l'*2                  
-
-                        # Generate size node
-                        size_node = node_def_pb2.NodeDef()
-                        size_node.op = "Const"
-                        size_node.name = new_node.name + "/size"
-                        size_node.attr["dtype"].type = 3
-                        size_packed = struct.pack(pack_format, *shape_tuple)
-                        size_node.attr["value"].tensor.tensor_shape.dim.add(size=2)
-                        size_node.attr["value"].tensor.dtype = 3 # DT_INT32
-                        size_node.attr["value"].tensor.tensor_content = size_packed # Set 0's during second pass
-                        new_node.input.extend([size_node.name])
+                output_graph_def.node.extend([placeholder])
+        
+        elif layer.type == "BatchNorm":
+                # Prepare attributes
+                train = False
+                is_not_training = layer.batch_norm_param.use_global_stats
+                if is_not_training != 1:
+                        train = True
+                try:
+                        eps = layer.batch_norm_param.eps
+                except:
+                        eps = 0.001 # TensorFlow default
 
-                        output_graph_def.node.extend([new_node])
-                        output_graph_def.node.extend([size_node])
-
-                elif layer.type == "Deconvolution":
-                        # Generate conv2D transpose
-                        kernel_size = layer.convolution_param.kernel_size[0]
-                        num_output = layer.convolution_param.num_output
-                        try:
-                                stride = list(layer.convolution_param.stride)[0]
-                        except:
-                                stride = 1 # Default stride for tf.Conv2D
-                        input_name = layer.bottom[0]
-
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")
-                                tensor = op[0].outputs[0]
-                                output_tensor = tf.layers.conv2d_transpose(tensor, num_output, kernel_size, strides=stride, name=layer.name+'Deconvolution')
-                                tf.identity(output_tensor, name=layer.name)
-                                           
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif layer.type == "Eltwise":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.name = layer.name
-                        num_inputs = len(layer.bottom)
-                        try:
-                                op_enum = layer.eltwise_param.operation
-                        except:
-                                op_enum = 1 # default is SUM
-                        if op_enum == 0:
-                                new_node.op = "Mul"
-                        elif op_enum == 1:
-                                new_node.op = "AddN"
-                                new_node.attr["N"].i = num_inputs
-                        elif op_enum == 2:
-                                new_node.op = "Max"
-                        new_node.attr["T"].type = 1
-                        if num_inputs > 0:
-                                for i in layer.bottom:
-                                        new_node.input.extend([i])
-                        output_graph_def.node.extend([new_node])
+                # Get bottom's output shape
+                input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom_shape = input_as_op.outputs[0].shape
+
+                # The parameters need the channel count
+                if bottom_shape.dims is None or bottom_shape.as_list()[-1] is None:
+                        # Recorded like an unsupported layer instead of stopping the conversion
+                        identity = node_def_pb2.NodeDef()
+                        identity.op = "Identity"
+                        identity.name = layer.name
+                        identity.attr["T"].type = 1
+                        identity.input.extend([layer.bottom[0]])
+                        conversion_report.add_fallback(report, layer.name, "BatchNorm(unknown channels)")
+                        output_graph_def.node.extend([identity])
+                        return
+                bottom_shape = bottom_shape.as_list()
+                input_name = layer.bottom[0]
+
+                # FusedBatchNorm takes 4-D input only. Caffe normalizes over all
+                # axes but the channel axis, so other ranks (e.g. after an
+                # InnerProduct) are reshaped to [-1, 1, 1, C] and back
+                if len(bottom_shape) != 4:
+                        input_name = layer.name + "/input"
+                        reshape = node_def_pb2.NodeDef()
+                        reshape.op = "Reshape"
+                        reshape.name = input_name
+                        reshape.attr["T"].type = 1 # DT_FLOAT
+                        reshape.attr["Tshape"].type = 3 # DT_INT32
+                        reshape.input.extend([layer.bottom[0], reshape.name + "/shape"])
 
-                elif layer.type == "Flatten":
-                        # Generally used to flatten NHWC 4D tensor to N(H*W*C) 2D tensor
-                        # Generate main node, we use a specific configuration of Reshape
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Reshape"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1 # DT_FLOAT
-                        new_node.attr["Tshape"].type = 3 # DT_INT32
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])
-                        try:
-                                caffe_axis = layer.flatten_param.axis
-                        except: 
-                                caffe_axis = 1 # Default caffe value
-                        try:
-                                caffe_end_axis = layer.flatten_param.end_axis
-                        except:
-                                caffe_end_axis = -1 # Default caffe value
-
-                        # Get bottom's output shape
-                        input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
-                        bottom_shape = input_as_op.outputs[0].shape.as_list()     
-
-                        # General case
-                        if caffe_axis == 1 and caffe_end_axis == -1:
-                                num_dims = 2
-                                out_dim = np.prod(bottom_shape[1:])
-                                out_shape = [-1, out_dim]
-                        else: 
-                                print("Unsupported non-generic case for flatten. Please review.")
-                                import code
-                                code.interact(local=locals())
-
-                        # Generate shape node
                         shape_node = node_def_pb2.NodeDef()
                         shape_node.op = "Const"
-                        shape_node.name = new_node.name + "/shape"
+                        shape_node.name = reshape.name + "/shape"
                         shape_node.attr["dtype"].type = 3 # DT_INT32
-                        shape_tuple = tuple(out_shape)
-                        pack_format = '<'+'l'*num_dims
-                        shape_packed = struct.pack(pack_format, *shape_tuple)
-                        shape_node.attr["value"].tensor.tensor_shape.dim.add(size=num_dims)
+                        shape_node.attr["value"].tensor.tensor_shape.dim.add(size=4)
                         shape_node.attr["value"].tensor.dtype = 3 # DT_INT32
-                        shape_node.attr["value"].tensor.tensor_content = shape_packed
-                        new_node.input.extend([shape_node.name])
+                        shape_node.attr["value"].tensor.tensor_content = struct.pack('<'+'l'*4, -1, 1, 1, bottom_shape[-1])
+                        output_graph_def.node.extend([shape_node, reshape])
 
-                        output_graph_def.node.extend([new_node])
-                        output_graph_def.node.extend([shape_node])                       
-
-                elif layer.type == "InnerProduct":
-                        # Generate layer 
-                        num_output = layer.inner_product_param.num_output
-                        input_name = layer.bottom[0]
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")
-                                tensor = op[0].outputs[0]
-                                output_tensor = tf.contrib.layers.fully_connected(tensor, num_output)
-                                # Create connector to match output name with layer.name
-                                tf.identity(output_tensor, name=layer.name)
-                        
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif layer.type == "LRN":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "LRN"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])
-                        try:
-                                caffe_alpha = layer.lrn_param.alpha
-                        except:
-                                caffe_alpha = 1 # Default alpha for tf.LRN
-                        try:
-                                caffe_beta = layer.lrn_param.beta
-                        except:
-                                caffe_beta = 0.5 # Default for tf.LRN
-                        try:
-                                caffe_local_size = layer.lrn_param.local_size
-                        except:
-                                caffe_local_size = 5
-                        new_node.attr["alpha"].f = caffe_alpha
-                        new_node.attr["beta"].f = caffe_beta
-                        new_node.attr["depth_radius"].i = caffe_local_size
-                        output_graph_def.node.extend([new_node])                
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "FusedBatchNorm"
+                new_node.name = layer.name if input_name == layer.bottom[0] else layer.name + "/BatchNorm"
+                new_node.attr["T"].type = 1
+                new_node.attr["epsilon"].f = eps
+                new_node.attr["is_training"].b = train
+                new_node.input.extend([input_name])
+
+                # Generate scale, offset, mean and variance nodes (one value per channel)
+                for param_name in ["scale", "offset", "mean", "variance"]:
+                        param_node = node_def_pb2.NodeDef()
+                        param_node.op = "Const"
+                        param_node.name = layer.name + "/" + param_name
+                        param_node.attr["dtype"].type = 1
+                        param_shape = tensor_shape.TensorShape([bottom_shape[-1]]).as_proto()
+                        param_node.attr["value"].tensor.tensor_shape.CopyFrom(param_shape)
+                        new_node.input.extend([param_node.name])
+                        output_graph_def.node.extend([param_node])
+
+                output_graph_def.node.extend([new_node])
+
+                if input_name != layer.bottom[0]:
+                        # Back to the input's shape, which may have an unknown batch
+                        shape_of = node_def_pb2.NodeDef()
+                        shape_of.op = "Shape"
+                        shape_of.name = layer.name + "/shape"
+                        shape_of.attr["T"].type = 1
+                        shape_of.attr["out_type"].type = 3 # DT_INT32
+                        shape_of.input.extend([layer.bottom[0]])
+
+                        reshape = node_def_pb2.NodeDef()
+                        reshape.op = "Reshape"
+                        reshape.name = layer.name
+                        reshape.attr["T"].type = 1 # DT_FLOAT
+                        reshape.attr["Tshape"].type = 3 # DT_INT32
+                        reshape.input.extend([new_node.name, shape_of.name])
+                        output_graph_def.node.extend([shape_of, reshape])
+
+        elif layer.type == "Concat":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "ConcatV2"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                num_inputs = len(layer.bottom)
+                new_node.attr["N"].i = num_inputs
+                if num_inputs > 0:
+                        for i in layer.bottom:
+                                new_node.input.extend([i]) 
+
+                # Generate axis input tensor
+                axis = node_def_pb2.NodeDef()
+                axis.op = "Const"
+                axis.name = new_node.name + "/axis"
+                axis.attr["dtype"].type = 3 # DT_INT32
+                axis.attr["value"].tensor.dtype = 3 # DT_INT32
+
+                # Get Caffe axis
+                try:
+                        caffe_axis = layer.concat_param.axis
+                except:
+                        caffe_axis = 1 # Default axis param for caffe.Concat (Channels dimension)
                 
-                elif layer.type == "Pooling":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "MaxPool" # MaxPool by default
-                        if layer.pooling_param.pool == 1:
-                                new_node.op = "AvgPool"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        try:
-                                k_dim = layer.pooling_param.kernel_size
-                        except:
-                                k_dim = 1
-                        kernel_shape = [1, k_dim, k_dim, 1]
-                        new_node.attr["ksize"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=kernel_shape))
-                        try:
-                                # Fails because padding default = 0, "VALID" anyways
-                                if layer.pooling_param.pad == 0:
-                                        new_node.attr["padding"].s = "VALID".encode("utf-8")
-                                else:
-                                        new_node.attr["padding"].s = "SAME".encode("utf-8")
-                        except:
+                # Get bottom's output shape
+                input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom_shape = input_as_op.outputs[0].shape.as_list()
+
+                # Take into account NCHW ordering for Caffe.Concat vs NHWC for tf.Concat        
+                if caffe_axis == 0:
+                        tf_axis = 0
+                else:
+                        tf_axis = -1
+
+                axis.attr["value"].tensor.int_val.append(tf_axis)
+                new_node.input.extend([axis.name])
+
+                output_graph_def.node.extend([axis])
+                output_graph_def.node.extend([new_node])
+
+        elif layer.type == "Convolution":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Conv2D"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                try:
+                        stride = list(layer.convolution_param.stride)[0]
+                except:
+                        stride = 1 # Default stride for tf.Conv2D
+                stride_list = [1, stride, stride, 1]
+                new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
+                try:
+                        # Fails because padding default = 0, "VALID" anyways
+                        if layer.convolution_param.pad[0] == 0:
                                 new_node.attr["padding"].s = "VALID".encode("utf-8")
-                        try:
-                                stride = layer.pooling_param.stride
-                        except:
-                                stride = 1
-                        stride_list = [1, stride, stride, 1]
-                        new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]]) 
-
-                        # if layer.name == "pool5/7x7_s1":
-                        #         import code
-                        #         code.interact(local=locals())
-                        output_graph_def.node.extend([new_node])
+                        else:
+                                new_node.attr["padding"].s = "SAME".encode("utf-8")
+                except:
+                        new_node.attr["padding"].s = "VALID".encode("utf-8")
+                # new_node.attr["padding"].s = "VALID".encode("utf-8")
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])    
+
+                # Get bottom's output shape
+                input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom_shape = input_as_op.outputs[0].shape.as_list()
+   
+                # Generate kernel node
+                kernel = node_def_pb2.NodeDef()
+                kernel.op = "Const"      
+                kernel.name = new_node.name + "/kernel"        
+                kernel.attr["dtype"].type = 1
+                kernel_shape = tensor_shape.TensorShape([layer.convolution_param.kernel_size[0],
+                                                        layer.convolution_param.kernel_size[0],
+                                                        bottom_shape[3],
+                                                        layer.convolution_param.num_output]).as_proto()
+                kernel.attr["value"].tensor.tensor_shape.CopyFrom(kernel_shape) 
+                
+                new_node.input.extend([kernel.name])        
+
+                output_graph_def.node.extend([kernel])
+                output_graph_def.node.extend([new_node])
+        
+        elif layer.type == "Crop":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "ResizeBilinear"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                new_node.attr["align_corners"].b = False
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])    
+
+                # Get bottom1's output shape (height and width only, generic case)
+                input1_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom1_shape = input1_as_op.outputs[0].shape.as_list()
+
+                # Get bottom2's output shape (height and width only, generic case)
+                input2_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[1]], name="")[0]
+                bottom2_shape = input2_as_op.outputs[0].shape.as_list()
+                hw_list = bottom2_shape[1:3]
+
+                if hw_list == [None, None]:
+                        hw_list = [-1, -1]
+
+                shape_tuple = tuple(hw_list)
+                pack_format = '<'+'l'*2                  
+
+                # Generate size node
+                size_node = node_def_pb2.NodeDef()
+                size_node.op = "Const"
+                size_node.name = new_node.name + "/size"
+                size_node.attr["dtype"].type = 3
+                size_packed = struct.pack(pack_format, *shape_tuple)
+                size_node.attr["value"].tensor.tensor_shape.dim.add(size=2)
+                size_node.attr["value"].tensor.dtype = 3 # DT_INT32
+                size_node.attr["value"].tensor.tensor_content = size_packed # Set 0's during second pass
+                new_node.input.extend([size_node.name])
+
+                output_graph_def.node.extend([new_node])
+                output_graph_def.node.extend([size_node])
+
+        elif layer.type == "Deconvolution":
+                # Generate main node, a transposed convolution is the gradient of Conv2D w.r.t. its input
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Conv2DBackpropInput"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                kernel_size = layer.convolution_param.kernel_size[0]
+                num_output = layer.convolution_param.num_output
+                try:
+                        stride = list(layer.convolution_param.stride)[0]
+                except:
+                        stride = 1 # Default stride for tf.Conv2D
+                try:
+                        pad = list(layer.convolution_param.pad)[0]
+                except:
+                        pad = 0 # Default pad for caffe.Deconvolution
+                stride_list = [1, stride, stride, 1]
+                new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
+                if pad == 0:
+                        new_node.attr["padding"].s = "VALID".encode("utf-8")
+                else:
+                        new_node.attr["padding"].s = "SAME".encode("utf-8")
+
+                # Get bottom's output shape
+                input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom_shape = input_as_op.outputs[0].shape.as_list()
+
+                # Generate output size node, caffe output size is stride*(in - 1) + kernel - 2*pad
+                out_shape = [-1, -1, -1, num_output]
+                if bottom_shape[0] is not None:
+                        out_shape[0] = bottom_shape[0]
+                for i in [1, 2]:
+                        if bottom_shape[i] is not None:
+                                out_shape[i] = stride * (bottom_shape[i] - 1) + kernel_size - 2 * pad
+                size_node = node_def_pb2.NodeDef()
+                size_node.op = "Const"
+                size_node.name = new_node.name + "/input_sizes"
+                size_node.attr["dtype"].type = 3 # DT_INT32
+                size_packed = struct.pack('<'+'l'*4, *out_shape)
+                size_node.attr["value"].tensor.tensor_shape.dim.add(size=4)
+                size_node.attr["value"].tensor.dtype = 3 # DT_INT32
+                size_node.attr["value"].tensor.tensor_content = size_packed
+
+                # Generate kernel node, [height, width, output_channels, input_channels] for transposed convolutions
+                kernel = node_def_pb2.NodeDef()
+                kernel.op = "Const"
+                kernel.name = new_node.name + "/kernel"
+                kernel.attr["dtype"].type = 1
+                kernel_shape = tensor_shape.TensorShape([kernel_size,
+                                                        kernel_size,
+                                                        num_output,
+                                                        bottom_shape[3]]).as_proto()
+                kernel.attr["value"].tensor.tensor_shape.CopyFrom(kernel_shape)
+
+                new_node.input.extend([size_node.name, kernel.name, layer.bottom[0]])
+
+                output_graph_def.node.extend([size_node])
+                output_graph_def.node.extend([kernel])
+                output_graph_def.node.extend([new_node])
+
+        elif layer.type == "Eltwise":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.name = layer.name
+                num_inputs = len(layer.bottom)
+                try:
+                        op_enum = layer.eltwise_param.operation
+                except:
+                        op_enum = 1 # default is SUM
+                if op_enum == 0:
+                        new_node.op = "Mul"
+                elif op_enum == 1:
+                        new_node.op = "AddN"
+                        new_node.attr["N"].i = num_inputs
+                elif op_enum == 2:
+                        new_node.op = "Max"
+                new_node.attr["T"].type = 1
+                if num_inputs > 0:
+                        for i in layer.bottom:
+                                new_node.input.extend([i])
+                output_graph_def.node.extend([new_node])
+
+        elif layer.type == "Flatten":
+                # Generally used to flatten NHWC 4D tensor to N(H*W*C) 2D tensor
+                # Generate main node, we use a specific configuration of Reshape
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Reshape"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1 # DT_FLOAT
+                new_node.attr["Tshape"].type = 3 # DT_INT32
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])
+                try:
+                        caffe_axis = layer.flatten_param.axis
+                except: 
+                        caffe_axis = 1 # Default caffe value
+                try:
+                        caffe_end_axis = layer.flatten_param.end_axis
+                except:
+                        caffe_end_axis = -1 # Default caffe value
+
+                # Get bottom's output shape
+                input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom_shape = input_as_op.outputs[0].shape.as_list()     
+
+                # General case
+                if caffe_axis == 1 and caffe_end_axis == -1:
+                        num_dims = 2
+                        out_dim = np.prod(bottom_shape[1:])
+                        out_shape = [-1, out_dim]
+                else:
+                        # Recorded like an unsupported layer instead of stopping the conversion
+                        identity = node_def_pb2.NodeDef()
+                        identity.op = "Identity"
+                        identity.name = layer.name
+                        identity.attr["T"].type = 1
+                        identity.input.extend([layer.bottom[0]])
+                        conversion_report.add_fallback(report, layer.name, "Flatten(axis=%d,end_axis=%d)" % (caffe_axis, caffe_end_axis))
+                        output_graph_def.node.extend([identity])
+                        return
+
+                # Generate shape node
+                shape_node = node_def_pb2.NodeDef()
+                shape_node.op = "Const"
+                shape_node.name = new_node.name + "/shape"
+                shape_node.attr["dtype"].type = 3 # DT_INT32
+                shape_tuple = tuple(out_shape)
+                pack_format = '<'+'l'*num_dims
+                shape_packed = struct.pack(pack_format, *shape_tuple)
+                shape_node.attr["value"].tensor.tensor_shape.dim.add(size=num_dims)
+                shape_node.attr["value"].tensor.dtype = 3 # DT_INT32
+                shape_node.attr["value"].tensor.tensor_content = shape_packed
+                new_node.input.extend([shape_node.name])
+
+                output_graph_def.node.extend([new_node])
+                output_graph_def.node.extend([shape_node])                       
+
+        elif layer.type == "InnerProduct":
+                num_output = layer.inner_product_param.num_output
+                input_name = layer.bottom[0]
+
+                # Get bottom's output shape
+                input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom_shape = input_as_op.outputs[0].shape.as_list()
+                in_dim = int(np.prod(bottom_shape[1:]))
+
+                # Flatten N-D inputs to [N, in_dim] first, as caffe.InnerProduct does
+                if len(bottom_shape) > 2:
+                        flatten = node_def_pb2.NodeDef()
+                        flatten.op = "Reshape"
+                        flatten.name = layer.name + "/flatten"
+                        flatten.attr["T"].type = 1
+                        flatten.attr["Tshape"].type = 3 # DT_INT32
 
-                elif layer.type == "PriorBox":
-                        # Follows definition of PriorBox class at https://github.com/intel/caffe/blob/master/src/caffe/layers/prior_box_layer.cpp
-                        # Generate main node, we use a specific configuration of Reshape
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Reshape"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1 # DT_INT32
-                        new_node.attr["Tshape"].type = 3 # DT_INT32    
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])
-
-                        # Get bottom's output shape
-                        input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
-                        bottom_shape = input_as_op.outputs[0].shape.as_list()       
-
-                        # Compute num_priors
-                        min_size = len(layer.prior_box_param.min_size)
-                        max_size = len(layer.prior_box_param.max_size)
-                        aspect_ratio_size = len(layer.prior_box_param.aspect_ratio)
-                        num_priors = min_size * aspect_ratio_size + max_size
-
-                        # General case
-                        num_dims = 3
-                        out_dim = np.prod(bottom_shape[1:3])*num_priors*4
-
-                        # 1 set of priors shared across all images in a batch
-                        # 2 channels. 1st stores mean of each prior coordinate, second stores variance of each prior coordinate              
-                        #TODO Figure out how to set out_shape[2] = out_dim as a valid reshape. Pad?
-                        out_shape = [1, 2, -1]
-
-                        # Generate shape node
                         shape_node = node_def_pb2.NodeDef()
                         shape_node.op = "Const"
-                        shape_node.name = new_node.name + "/shape"
-                        shape_node.attr["dtype"].type = 3 # DT_FLOAT32
-                        shape_tuple = tuple(out_shape)
-                        pack_format = '<'+'l'*num_dims
-                        shape_packed = struct.pack(pack_format, *shape_tuple)
-                        shape_node.attr["value"].tensor.tensor_shape.dim.add(size=num_dims)
+                        shape_node.name = flatten.name + "/shape"
+                        shape_node.attr["dtype"].type = 3 # DT_INT32
+                        shape_packed = struct.pack('<'+'l'*2, -1, in_dim)
+                        shape_node.attr["value"].tensor.tensor_shape.dim.add(size=2)
                         shape_node.attr["value"].tensor.dtype = 3 # DT_INT32
                         shape_node.attr["value"].tensor.tensor_content = shape_packed
-                        new_node.input.extend([shape_node.name])
+                        flatten.input.extend([input_name, shape_node.name])
+
+                        output_graph_def.node.extend([shape_node])
+                        output_graph_def.node.extend([flatten])
+                        input_name = flatten.name
+
+                # Generate weights node
+                weights = node_def_pb2.NodeDef()
+                weights.op = "Const"
+                weights.name = layer.name + "/weights"
+                weights.attr["dtype"].type = 1
+                weights_shape = tensor_shape.TensorShape([in_dim, num_output]).as_proto()
+                weights.attr["value"].tensor.tensor_shape.CopyFrom(weights_shape)
+                output_graph_def.node.extend([weights])
+
+                # Generate main node, MatMul + BiasAdd ends on layer.name
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "MatMul"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                new_node.input.extend([input_name, weights.name])
+                if layer.inner_product_param.bias_term:
+                        new_node.name = layer.name + "/MatMul"
+
+                        bias = node_def_pb2.NodeDef()
+                        bias.op = "Const"
+                        bias.name = layer.name + "/bias"
+                        bias.attr["dtype"].type = 1
+                        bias_shape = tensor_shape.TensorShape([num_output]).as_proto()
+                        bias.attr["value"].tensor.tensor_shape.CopyFrom(bias_shape)
+
+                        bias_add = node_def_pb2.NodeDef()
+                        bias_add.op = "BiasAdd"
+                        bias_add.name = layer.name
+                        bias_add.attr["T"].type = 1
+                        bias_add.input.extend([new_node.name, bias.name])
 
                         output_graph_def.node.extend([new_node])
-                        output_graph_def.node.extend([shape_node]) 
-
-                elif layer.type == "ReLU":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Relu"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])
+                        output_graph_def.node.extend([bias])
+                        output_graph_def.node.extend([bias_add])
+                else:
                         output_graph_def.node.extend([new_node])
-                
-                elif layer.type == "Reshape":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Reshape"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        new_node.attr["Tshape"].type = 3 # DT_INT32
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])
-
-                        # Get bottom's output shape
-                        input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
-                        bottom_shape = input_as_op.outputs[0].shape.as_list()
-
-                        # Generate shape node
-                        shape_node = node_def_pb2.NodeDef()
-                        shape_node.op = "Const"
-                        shape_node.name = new_node.name + "/shape"
-                        shape_node.attr["dtype"].type = 3 # DT_INT32
-                        unsorted_caffe_shape = layer.reshape_param.shape.ListFields()[0][1]
-                        # Convert NCHW caffe_shape to NHWC ordering
-                        if len(unsorted_caffe_shape) == 4:
-                                caffe_shape = [unsorted_caffe_shape[0],
-                                                        unsorted_caffe_shape[2],
-                                                        unsorted_caffe_shape[3],
-                                                        unsorted_caffe_shape[1]]
+
+        elif layer.type == "LRN":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "LRN"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])
+                try:
+                        caffe_alpha = layer.lrn_param.alpha
+                except:
+                        caffe_alpha = 1 # Default alpha for tf.LRN
+                try:
+                        caffe_beta = layer.lrn_param.beta
+                except:
+                        caffe_beta = 0.5 # Default for tf.LRN
+                try:
+                        caffe_local_size = layer.lrn_param.local_size
+                except:
+                        caffe_local_size = 5
+                new_node.attr["alpha"].f = caffe_alpha
+                new_node.attr["beta"].f = caffe_beta
+                new_node.attr["depth_radius"].i = caffe_local_size
+                output_graph_def.node.extend([new_node])                
+        
+        elif layer.type == "Pooling":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "MaxPool" # MaxPool by default
+                if layer.pooling_param.pool == 1:
+                        new_node.op = "AvgPool"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                try:
+                        k_dim = layer.pooling_param.kernel_size
+                except:
+                        k_dim = 1
+                kernel_shape = [1, k_dim, k_dim, 1]
+                new_node.attr["ksize"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=kernel_shape))
+                try:
+                        # Fails because padding default = 0, "VALID" anyways
+                        if layer.pooling_param.pad == 0:
+                                new_node.attr["padding"].s = "VALID".encode("utf-8")
                         else:
-                                caffe_shape = unsorted_caffe_shape
-                        num_dims = len(caffe_shape)
-                        temp_shape = []
-                        for i in range(num_dims):
-                                if caffe_shape[i] == 0:
-                                        # Take note of NCHW ordering for caffe_shape vs NHWC for bottom_shape                                        
-                                        temp_shape.append(bottom_shape[i])
-                                else:
-                                        temp_shape.append(caffe_shape[i])
-                        shape_tuple = tuple(temp_shape)
-                        pack_format = '<'+'l'*num_dims
-                        shape_packed = struct.pack(pack_format, *shape_tuple)
-                        shape_node.attr["value"].tensor.tensor_shape.dim.add(size=num_dims)
-                        shape_node.attr["value"].tensor.dtype = 3 # DT_INT32
-                        shape_node.attr["value"].tensor.tensor_content = shape_packed # Set 0's during second pass
-                        new_node.input.extend([shape_node.name])
+                                new_node.attr["padding"].s = "SAME".encode("utf-8")
+                except:
+                        new_node.attr["padding"].s = "VALID".encode("utf-8")
+                try:
+                        stride = layer.pooling_param.stride
+                except:
+                        stride = 1
+                stride_list = [1, stride, stride, 1]
+                new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]]) 
 
-                        output_graph_def.node.extend([new_node])
-                        output_graph_def.node.extend([shape_node])
+                # if layer.name == "pool5/7x7_s1":
+                #         import code
+                #         code.interact(local=locals())
+                output_graph_def.node.extend([new_node])
 
-                elif layer.type == "Softmax":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Softmax"
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])
-                        output_graph_def.node.extend([new_node])
+        elif layer.type == "PriorBox":
+                # Priors only depend on the feature map and image sizes, so they are
+                # precomputed into a single Const shared by every batch size
+                input_list = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0], layer.bottom[1]], name="")
+                layer_shape = input_list[0].outputs[0].shape.as_list()
+                image_shape = input_list[1].outputs[0].shape.as_list()
+                priors = gen_prior_boxes(layer.prior_box_param, layer_shape[1], layer_shape[2], image_shape[1], image_shape[2])
+
+                # Generate main node, [1, 2, num_boxes*4]: box coordinates in channel 0, variances in channel 1
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Const"
+                new_node.name = layer.name
+                new_node.attr["dtype"].type = 1 # DT_FLOAT
+                new_node.attr["value"].tensor.dtype = 1 # DT_FLOAT
+                new_node.attr["value"].tensor.tensor_shape.CopyFrom(tensor_shape.TensorShape(priors.shape).as_proto())
+                new_node.attr["value"].tensor.tensor_content = priors.tobytes()
+
+                output_graph_def.node.extend([new_node])
 
+        elif layer.type == "ReLU":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Relu"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])
+                output_graph_def.node.extend([new_node])
+        
+        elif layer.type == "Reshape":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Reshape"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                new_node.attr["Tshape"].type = 3 # DT_INT32
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])
+
+                # Get bottom's output shape
+                input_as_op = tf.import_graph_def(output_graph_def, return_elements=[layer.bottom[0]], name="")[0]
+                bottom_shape = input_as_op.outputs[0].shape.as_list()
+
+                # Generate shape node
+                shape_node = node_def_pb2.NodeDef()
+                shape_node.op = "Const"
+                shape_node.name = new_node.name + "/shape"
+                shape_node.attr["dtype"].type = 3 # DT_INT32
+                unsorted_caffe_shape = layer.reshape_param.shape.ListFields()[0][1]
+                # Convert NCHW caffe_shape to NHWC ordering
+                if len(unsorted_caffe_shape) == 4:
+                        caffe_shape = [unsorted_caffe_shape[0],
+                                                unsorted_caffe_shape[2],
+                                                unsorted_caffe_shape[3],
+                                                unsorted_caffe_shape[1]]
                 else:
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = 'Identity'
-                        new_node.name = layer.name
-                        new_node.attr["T"].type = 1
-                        if len(layer.bottom) > 0:
-                                new_node.input.extend([layer.bottom[0]])
-                        # For user to keep track of unsuppported Caffe ops
-                        if layer.type != "Identity":
-                                unsupported_caffe_types.add(layer.type)
-                        output_graph_def.node.extend([new_node])
+                        caffe_shape = unsorted_caffe_shape
+                num_dims = len(caffe_shape)
+                temp_shape = []
+                for i in range(num_dims):
+                        if caffe_shape[i] == 0:
+                                # Take note of NCHW ordering for caffe_shape vs NHWC for bottom_shape                                        
+                                temp_shape.append(bottom_shape[i])
+                        else:
+                                temp_shape.append(caffe_shape[i])
+                shape_tuple = tuple(temp_shape)
+                pack_format = '<'+'l'*num_dims
+                shape_packed = struct.pack(pack_format, *shape_tuple)
+                shape_node.attr["value"].tensor.tensor_shape.dim.add(size=num_dims)
+                shape_node.attr["value"].tensor.dtype = 3 # DT_INT32
+                shape_node.attr["value"].tensor.tensor_content = shape_packed # Set 0's during second pass
+                new_node.input.extend([shape_node.name])
+
+                output_graph_def.node.extend([new_node])
+                output_graph_def.node.extend([shape_node])
+
+        elif layer.type == "Softmax":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Softmax"
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])
+                output_graph_def.node.extend([new_node])
+
+        else:
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = 'Identity'
+                new_node.name = layer.name
+                new_node.attr["T"].type = 1
+                if len(layer.bottom) > 0:
+                        new_node.input.extend([layer.bottom[0]])
+                # For user to keep track of unsuppported Caffe ops
+                if layer.type != "Identity":
+                        conversion_report.add_fallback(report, layer.name, layer.type)
+                output_graph_def.node.extend([new_node])
+
+# Templates and checkpoints written by another version of the lowering never
+# match. It covers every module that shapes the emitted or restored nodes,
+# and the TensorFlow version whose shape inference the handlers query.
+VERSIONED_MODULES = [__file__, layer_templates.__file__, graph_passes.__file__, graphdef_wire.__file__, conversion_checkpoint.__file__]
+
+def converter_version():
+        digest = hashlib.sha1(tf.__version__.encode('utf-8'))
+        for path in VERSIONED_MODULES:
+                with open(path, 'rb') as f:
+                        digest.update(f.read())
+        return digest.hexdigest()
+
+CONVERTER_VERSION = converter_version()
 
+# One TemplateCache per cache directory, kept for the life of the process so
+# warm workers reuse blocks across models
+template_caches = {}
+
+def get_template_cache(cache_dir=None):
+        if cache_dir not in template_caches:
+                template_caches[cache_dir] = layer_templates.TemplateCache(convert_layer, CONVERTER_VERSION, cache_dir)
+        return template_caches[cache_dir]
+
+memory_checkpoints = {}
+
+def get_memory_checkpoint(model_path=None):
+        # Last conversion of model_path in this process, for --watch
+        if model_path not in memory_checkpoints:
+                memory_checkpoints[model_path] = conversion_checkpoint.MemoryCheckpoint(CONVERTER_VERSION)
+        return memory_checkpoints[model_path]
+
+def gen_initial_graphdef(net, report=None, templates=None, checkpoint=None, progress=None):
+        if report is None:
+                report = conversion_report.new_report('caffe')
+        output_graph_def = graph_pb2.GraphDef()
+        # Units converted in one go: single layers, or blocks ending at joins
+        # when repeated blocks are instantiated from templates
+        if templates is None:
+                units = [(i, i + 1) for i in range(len(net.layer))]
+        else:
+                units = list(layer_templates.layer_segments(net))
+        done = 0
+        if checkpoint is not None:
+                done = checkpoint.restore(net.layer, output_graph_def, report)
+        counts = collections.Counter()
+        try:
+                for start, end in units:
+                        if end <= done:
+                                continue
+                        if start < done or templates is None:
+                                # A block the checkpoint ended inside is finished layer by layer
+                                for i in range(max(start, done), end):
+                                        if progress is not None:
+                                                progress.update(i, net.layer[i].type, net.layer[i].name, output_graph_def)
+                                        convert_layer(net.layer[i], output_graph_def, report)
+                        else:
+                                if progress is not None:
+                                        progress.update(start, net.layer[start].type, net.layer[start].name, output_graph_def)
+                                counts[templates.convert_segment(net.layer[start:end], output_graph_def, report)] += 1
+                        done = end
+                        if checkpoint is not None:
+                                checkpoint.update(done, output_graph_def, report)
+        except BaseException:
+                # Killed (Ctrl-C) or a layer failed, keep what was converted so far
+                if checkpoint is not None and done > 0:
+                        checkpoint.save(output_graph_def, report)
+                raise
+        if checkpoint is not None:
+                checkpoint.save(output_graph_def, report)
+        if templates is not None:
+                report['templates'] = dict(counts)
         return output_graph_def
 
+def parse_cut_inputs(spec):
+        # --inputs value to {blob: Caffe dims or None}, the dims of a blob
+        # follow it: "pool5:1,512,7,7,rois" -> {'pool5': [1, 512, 7, 7], 'rois': None}
+        inputs = {}
+        name = None
+        for token in spec.split(','):
+                if name is not None and inputs[name] is not None and re.match(r'^-?\d+$', token):
+                        inputs[name].append(int(token))
+                        continue
+                name, sep, dim = token.partition(':')
+                if name == '':
+                        name = None
+                        continue
+                inputs[name] = [int(dim)] if sep else None
+        return inputs
+
+def extract_subnet(net, outputs, inputs=()):
+        # Returns a NetParameter holding only the layers the requested outputs depend on.
+        # Blobs listed in inputs are cut and become Input layers, shaped when
+        # inputs maps them to Caffe dims (parse_cut_inputs).
+        producers = {}
+        for i, layer in enumerate(net.layer):
+                for top in layer.top:
+                        producers.setdefault(top, []).append(i)
+                if layer.name not in layer.top:
+                        producers.setdefault(layer.name, []).append(i)
+
+        def producer_before(blob, index):
+                # Latest layer writing blob before index, in-place layers rewrite their bottom
+                candidates = [i for i in producers.get(blob, []) if i < index]
+                if len(candidates) == 0:
+                        raise ValueError('No layer produces "%s"' % blob)
+                return candidates[-1]
+
+        keep = set()
+        cuts = []
+        pending = [producer_before(name, len(net.layer)) for name in outputs]
+        while pending:
+                i = pending.pop()
+                if i in keep:
+                        continue
+                keep.add(i)
+                for bottom in net.layer[i].bottom:
+                        if bottom in inputs:
+                                if bottom not in cuts:
+                                        cuts.append(bottom)
+                        else:
+                                pending.append(producer_before(bottom, i))
+
+        subnet = caffe_pb2.NetParameter()
+        subnet.name = net.name
+        for name in cuts:
+                input_layer = subnet.layer.add()
+                input_layer.name = name
+                input_layer.type = "Input"
+                input_layer.top.extend([name])
+                if isinstance(inputs, dict) and inputs[name] is not None:
+                        input_layer.input_param.shape.add().dim.extend(inputs[name])
+        for i in sorted(keep):
+                subnet.layer.add().CopyFrom(net.layer[i])
+        return subnet
+
+def infer_cut_shapes(net, subnet, inputs):
+        # Gives the Input layers extract_subnet cut at inputs without dims the
+        # shape of their blob in net, by converting the layers it depends on
+        cuts = [layer for layer in subnet.layer if layer.type == "Input" and layer.name in inputs and len(layer.input_param.shape) == 0]
+        if len(cuts) == 0:
+                return subnet
+        blobs = [layer.name for layer in cuts]
+        prefix = extract_subnet(net, blobs)
+        message = 'Shape of cut blob "%s" is unknown, give it as --inputs %s:N,C,H,W'
+        try:
+                with tf.Graph().as_default(), tf.Session() as sess:
+                        prefix_graph_def = gen_initial_graphdef(prefix, conversion_report.new_report('caffe'))
+        except ValueError as e:
+                raise ValueError((message + ' (%s)') % (blobs[0], blobs[0], e))
+        with tf.Graph().as_default():
+                ops = tf.import_graph_def(prefix_graph_def, return_elements=blobs, name="")
+        for layer, op in zip(cuts, ops):
+                shape = op.outputs[0].shape
+                if shape.dims is None or None in shape.as_list():
+                        raise ValueError(message % (layer.name, layer.name))
+                dims = shape.as_list()
+                if len(dims) == 4:
+                        dims = [dims[0], dims[3], dims[1], dims[2]]
+                layer.input_param.shape.add().dim.extend(dims)
+        return subnet
+
+# NetParameter / LayerParameter field numbers (caffe/proto/caffe.proto)
+NET_LAYERS_V1 = 2
+NET_LAYER = 100
+LAYER_BLOBS = 7
+V1_LAYER_BLOBS = 6
+
+# Control bytes never found in a text prototxt, always found in a binary
+# NetParameter (length prefixes of short strings such as layer types)
+BINARY_BYTES = re.compile(rb'[\x00-\x08\x0e-\x1f]')
+
+def is_binary_net(model_data):
+        return BINARY_BYTES.search(model_data[:4096]) is not None
+
+def strip_blobs(model_data):
+        # Copies a binary NetParameter without the layers' weight blobs, which
+        # are most of a caffemodel and never used since only shapes are emitted
+        buf = memoryview(model_data)
+        out = bytearray()
+        for field, wire_type, value, start, end in graphdef_wire.iter_field_spans(buf):
+                if field not in (NET_LAYER, NET_LAYERS_V1) or wire_type != graphdef_wire.LENGTH_DELIMITED:
+                        out += buf[start:end]
+                        continue
+                blobs = LAYER_BLOBS if field == NET_LAYER else V1_LAYER_BLOBS
+                spans = [(s, e) for f, _, _, s, e in graphdef_wire.iter_field_spans(value) if f != blobs]
+                layer = b''.join(value[s:e] for s, e in spans)
+                if len(layer) == len(value):
+                        out += buf[start:end]
+                else:
+                        out += graphdef_wire.encode_varint(field << 3 | graphdef_wire.LENGTH_DELIMITED)
+                        out += graphdef_wire.encode_varint(len(layer))
+                        out += layer
+        return bytes(out)
+
+def parse_net(model_data):
+        # Accepts text prototxt or binary NetParameter (e.g. a .caffemodel)
+        net = caffe_pb2.NetParameter()
+        if is_binary_net(model_data):
+                net.ParseFromString(strip_blobs(model_data))
+        else:
+                google.protobuf.text_format.Merge(model_data.decode('utf-8'), net)
+        if len(net.layer) == 0 and len(net.layers) > 0:
+                raise ValueError('Net uses deprecated V1 "layers", upgrade it with Caffe\'s upgrade_net_proto_text/binary first')
+        return net
+
+def build_caffe_graph(model_data, report, options=None):
+        # Converts prototxt or binary NetParameter bytes to a GraphDef
+        if options is None:
+                options = {}
+        if options.get('weight_dtype', 'fp32') != 'fp32':
+                # Caffe weights are Consts without values, the only payloads
+                # are PriorBox priors, which must stay exact
+                raise ValueError('weight_dtype is not supported for Caffe models, they carry no weight Consts')
+        with conversion_report.timed(report, 'parse'):
+                net = parse_net(model_data)
+        if options.get('outputs'):
+                with conversion_report.timed(report, 'extract'):
+                        inputs = parse_cut_inputs(options.get('inputs') or '')
+                        net = infer_cut_shapes(net, extract_subnet(net, options['outputs'].split(','), inputs), inputs)
+        conversion_report.count_source_ops(report, [layer.type for layer in net.layer])
+
+        with conversion_report.timed(report, 'convert'):
+                templates = None
+                if options.get('templates') or options.get('template_cache'):
+                        templates = get_template_cache(options.get('template_cache'))
+                checkpoint = None
+                if options.get('checkpoint'):
+                        checkpoint = conversion_checkpoint.ConversionCheckpoint(options['checkpoint'], CONVERTER_VERSION, options.get('checkpoint_interval') or 60.0)
+                elif options.get('watch'):
+                        # Layers before the first edit are reused from the last conversion
+                        checkpoint = get_memory_checkpoint(options.get('model'))
+                progress = conversion_progress.from_options('caffe', len(net.layer), options)
+                try:
+                        # A fresh default graph per conversion, ops of earlier
+                        # conversions in the process (--watch, warm workers)
+                        # would slow the imports down
+                        with tf.Graph().as_default(), tf.Session() as sess:
+                                output_graph_def = gen_initial_graphdef(net, report, templates, checkpoint, progress)
+                except BaseException as e:
+                        if progress is not None:
+                                progress.fail(e)
+                        raise
+                if progress is not None:
+                        progress.finish(len(net.layer), output_graph_def)
+        if options.get('dedup'):
+                with conversion_report.timed(report, 'dedup'):
+                        removed, saved = graph_passes.dedup_constants(output_graph_def)
+                report['dedup'] = {'removed_nodes': removed, 'bytes_saved': saved}
+        if options.get('scopes'):
+                with conversion_report.timed(report, 'scopes'):
+                        before, after = graph_passes.assign_name_scopes(output_graph_def)
+                report['scopes'] = {'top_level_before': before, 'top_level_after': after}
+        with conversion_report.timed(report, 'validate'):
+                with tf.Graph().as_default() as graph:
+                        tf.import_graph_def(output_graph_def, name='')
+        return output_graph_def
+
+def convert_caffe_data(model_data, report, options=None):
+        # Converts prototxt or binary NetParameter bytes to serialized GraphDef bytes
+        output_graph_def = build_caffe_graph(model_data, report, options)
+        with conversion_report.timed(report, 'serialize'):
+                data = output_graph_def.SerializeToString()
+        conversion_report.finalize(report, output_graph_def, len(data))
+        return data
+
+def write_event_file(report, graph_bytes, logdir):
+        # TensorBoard graph view without a separate summary step
+        with conversion_report.timed(report, 'events'):
+                report['event_file'] = tb_event_writer.write_graph_event(graph_bytes, logdir)
+
+def convert_caffe(model_path, output_path, options=None):
+        report = conversion_report.new_report('caffe', model_path, output_path)
+        with conversion_report.timed(report, 'read'):
+                model_data = compressed_io.read_file(model_path)
+        if options is not None and options.get('shard_size'):
+                # Large Const payloads go to sidecar shards to stay under the 2 GB protobuf limit
+                if compressed_io.codec_of_path(output_path) is not None:
+                        raise ValueError('Shards are memory-mapped and cannot be compressed, write %s instead' % compressed_io.strip_codec(output_path))
+                output_graph_def = build_caffe_graph(model_data, report, options)
+                with conversion_report.timed(report, 'write'):
+                        total_bytes = sharded_graphdef.write_sharded(output_graph_def, output_path, int(options['shard_size'] * 2**20))
+                conversion_report.finalize(report, output_graph_def, total_bytes)
+                if options.get('logdir'):
+                        write_event_file(report, output_graph_def.SerializeToString(), options['logdir'])
+                return report
+        data = convert_caffe_data(model_data, report, options)
+        with conversion_report.timed(report, 'write'):
+                file_bytes = compressed_io.write_file(output_path, data)
+        if compressed_io.codec_of_path(output_path) is not None:
+                report['compressed_bytes'] = file_bytes
+        if options is not None and options.get('logdir'):
+                write_event_file(report, data, options['logdir'])
+        return report
+
 ## -------------------------------- MAIN ---------------------------------- ##
-parser = argparse.ArgumentParser(description='Generates a TensorFlow model from a Caffe prototxt.')
-parser.add_argument('-m', '--model', required=True, help='Target Caffe prototxt. e.g. deploy.prototxt')
-parser.add_argument('-o', '--output', default='converted_caffe_model.pb', help='Name of output TensorFlow model. Default is converted_caffe_model.pb.')
-args = parser.parse_args()
-
-print('[i] Input model:  ', args.model)
-print('[i] Output: ', args.output)
-
-net = caffe_pb2.NetParameter()
-f = open(args.model, 'r')
-net = google.protobuf.text_format.Merge(str(f.read()), net)
-
-with tf.Session() as sess:
-        output_graph_def = gen_initial_graphdef(net)
-with tf.Graph().as_default() as graph:
-	tf.import_graph_def(output_graph_def, name='')
-with open(args.output, "wb") as f:
-        f.write(output_graph_def.SerializeToString())
-if len(unsupported_caffe_types) == 0:
-        print('All caffe layer types in this prototxt are supported')
-else:
-        print('Unsupported Caffe ops: ', unsupported_caffe_types)
-f.close()
+def main(args):
+        parser = argparse.ArgumentParser(description='Generates a TensorFlow model from a Caffe prototxt.')
+        parser.add_argument('-m', '--model', required=True, help='Target Caffe prototxt or binary NetParameter, optionally gzip/zstd compressed. e.g. deploy.prototxt, model.caffemodel, deploy.prototxt.gz')
+        parser.add_argument('-o', '--output', default='converted_caffe_model.pb', help='Name of output TensorFlow model, compressed when it ends in .gz or .zst. Default is converted_caffe_model.pb.')
+        parser.add_argument('--dedup', action='store_true', help='Merge Const nodes with identical contents.')
+        parser.add_argument('--scopes', action='store_true', help='Nest nodes into name scopes inferred from layer names and topology, for TensorBoard.')
+        parser.add_argument('--outputs', help='Comma separated layers/blobs to keep. Only the layers they depend on are converted.')
+        parser.add_argument('--inputs', help='Comma separated blobs to cut at, used with --outputs. They become Placeholders, shaped like the blobs in the full net or as given in Caffe order after the name, e.g. pool5:1,512,7,7.')
+        parser.add_argument('--shard-size', type=float, help='Write large Const payloads to sidecar shard files of about this many MB, with the structure in the .pb.')
+        parser.add_argument('--checkpoint', help='Save the partial conversion to CHECKPOINT.pb/.json and resume from it when rerun, also after edits to the prototxt.')
+        parser.add_argument('--checkpoint-interval', type=float, default=60.0, help='Least number of seconds between checkpoint saves. Default is 60.')
+        parser.add_argument('--logdir', help='Also write a TensorBoard event file with the graph to this directory.')
+        parser.add_argument('--no-progress', action='store_true', help='Do not draw the progress bar. It is drawn only when stderr is a terminal.')
+        parser.add_argument('--progress-json', help='Append progress events as JSON lines to this file or named pipe.')
+        parser.add_argument('--templates', action='store_true', help='Convert repeated blocks once and instantiate the rest from templates.')
+        parser.add_argument('--template-cache', help='Directory keeping block templates between runs. Implies --templates.')
+        parser.add_argument('--watch', action='store_true', help='Keep running and convert again each time the model is saved. Unchanged leading layers are reused.')
+        args = parser.parse_args(args)
+
+        print('[i] Input model:  ', args.model)
+        print('[i] Output: ', args.output)
+
+        options = vars(args)
+        options['progress'] = not args.no_progress and sys.stderr.isatty()
+        if args.watch:
+                def convert():
+                        report = convert_caffe(args.model, args.output, options)
+                        print_summary(report)
+                        return report
+                model_watch.watch(args.model, convert)
+                return
+        print_summary(convert_caffe(args.model, args.output, options))
+
+def print_summary(report):
+        if 'dedup' in report:
+                print('[i] Deduplicated %d Const nodes, saved %d bytes' % (report['dedup']['removed_nodes'], report['dedup']['bytes_saved']))
+        if 'scopes' in report:
+                print('[i] Top-level names: %d -> %d' % (report['scopes']['top_level_before'], report['scopes']['top_level_after']))
+        if 'templates' in report:
+                print('[i] Template blocks: %d hit, %d converted, %d uncacheable' % (report['templates'].get('hit', 0), report['templates'].get('miss', 0), report['templates'].get('uncacheable', 0)))
+        if report.get('checkpoint', {}).get('path') == '<memory>':
+                print('[i] Reused %d unchanged layers of the last conversion' % report['checkpoint']['resumed_layers'])
+        elif 'checkpoint' in report:
+                print('[i] Checkpoint %s: resumed after %d layers, saved %d times' % (report['checkpoint']['path'], report['checkpoint']['resumed_layers'], report['checkpoint']['saves']))
+        if 'compressed_bytes' in report:
+                print('[i] Compressed output: %d -> %d bytes' % (report['output_bytes'], report['compressed_bytes']))
+        if 'event_file' in report:
+                print('[i] Event file: ', report['event_file'])
+        print('[i] Report: ', conversion_report.write_report(report))
+        if len(report['unsupported_types']) == 0:
+                print('All caffe layer types in this prototxt are supported')
+        else:
+                print('Unsupported Caffe ops: ', set(report['unsupported_types']))
+
+if __name__=='__main__':
+        main(sys.argv[1:])
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Streaming gzip/zstd for model inputs and converted outputs. Writes pick the
+# codec from the extension (model.pb.gz, model.pb.zst), reads from the magic
+# bytes, so compressed models load whatever they are named. Data passes
+# through the codec in CHUNK_SIZE pieces and no uncompressed copy is written
+# to disk, except by map_file, which needs one to map.
+
+import argparse
+import contextlib
+import gzip
+import mmap
+import os
+import sys
+import tempfile
+import time
+
+try:
+    # Optional, only needed for .zst files
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1 << 20
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+CODEC_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def codec_of_path(path):
+    return CODEC_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def strip_codec(path):
+    # "model.pb.zst" -> "model.pb"
+    if codec_of_path(path) is not None:
+        return os.path.splitext(path)[0]
+    return path
+
+
+def _require_zstd():
+    if zstandard is None:
+        raise ImportError('.zst files need the zstandard package (pip install zstandard)')
+
+
+def _decompressor(raw):
+    # Decompressing reader over the open file raw, None for a plain file
+    magic = raw.read(len(ZSTD_MAGIC))
+    raw.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if magic == ZSTD_MAGIC:
+        _require_zstd()
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    return None
+
+
+def read_file(path):
+    # Decompressed contents of path, plain files are returned as they are
+    with open(path, 'rb') as raw:
+        stream = _decompressor(raw)
+        if stream is None:
+            return raw.read()
+        data = bytearray()
+        with stream:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+        return bytes(data)
+
+
+def map_file(path, tmp_dir=None):
+    # Read-only memory map of the decompressed contents of path. Compressed
+    # files are decompressed to an unlinked temporary file in tmp_dir first.
+    with open(path, 'rb') as raw:
+        stream = _decompressor(raw)
+        if stream is None:
+            return mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+        # The map stays valid once the file is closed
+        with stream, tempfile.TemporaryFile(dir=tmp_dir) as tmp:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                tmp.write(chunk)
+            tmp.flush()
+            return mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@contextlib.contextmanager
+def open_write(path, size=None):
+    # Writable stream to path, compressed when path has a codec extension.
+    # size is the number of bytes that will be written, if known.
+    codec = codec_of_path(path)
+    with open(path, 'wb') as raw:
+        if codec is None:
+            yield raw
+            return
+        if codec == 'gzip':
+            # mtime=0 keeps the output reproducible
+            stream = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+        else:
+            _require_zstd()
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw, size=-1 if size is None else size, closefd=False)
+        with stream:
+            yield stream
+
+
+def write_file(path, data):
+    # Writes data, compressed when path has a codec extension. Returns the
+    # number of bytes on disk.
+    view = memoryview(data)
+    with open_write(path, len(view)) as stream:
+        for start in range(0, len(view), CHUNK_SIZE):
+            stream.write(view[start:start + CHUNK_SIZE])
+    return os.path.getsize(path)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Measures compression ratio and throughput of the supported codecs on model files.')
+    parser.add_argument('files', nargs='+', help='Models or converted .pb files')
+    parser.add_argument('--tmp', default='.', help='Directory for the temporary compressed files')
+    args = parser.parse_args(args)
+
+    extensions = ['.gz'] + (['.zst'] if zstandard is not None else [])
+    for extension in extensions:
+        raw_bytes = 0
+        stored_bytes = 0
+        write_time = 0.0
+        read_time = 0.0
+        for path in args.files:
+            data = read_file(path)
+            tmp_path = os.path.join(args.tmp, os.path.basename(path) + extension)
+            start = time.time()
+            stored_bytes += write_file(tmp_path, data)
+            write_time += time.time() - start
+            start = time.time()
+            if read_file(tmp_path) != data:
+                print('Round trip mismatch for %s' % path)
+                return 1
+            read_time += time.time() - start
+            raw_bytes += len(data)
+            os.remove(tmp_path)
+        print('[i] %-4s %d files, %.2f MB -> %.2f MB (%.1fx), write %.0f MB/s, read %.0f MB/s' % (
+            CODEC_EXTENSIONS[extension], len(args.files), raw_bytes / 2.0**20, stored_bytes / 2.0**20,
+            raw_bytes / float(max(stored_bytes, 1)), raw_bytes / 2.0**20 / max(write_time, 1e-9), raw_bytes / 2.0**20 / max(read_time, 1e-9)))
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
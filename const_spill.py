@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Disk-backed store for Const payloads, so converting a model with large
+# weights does not hold them all in memory (onnx2tf --max-memory).
+#
+# Payloads of at least SPILL_MIN_BYTES are appended to an unlinked temporary
+# file, 64-byte aligned, once the payloads kept in memory reach the store's
+# allowance. A spilled Const keeps its dtype and shape, an empty
+# tensor_content and a _spill attr with its entry number. Identical payloads
+# share one entry. Small Consts (shapes, axes) always stay in memory, the
+# converters read those.
+#
+# Payloads are read back through a memory map. write_graph_def streams the
+# GraphDef node by node and copies each spilled payload into the output in
+# CHUNK_SIZE pieces, so the serialized graph is never held in memory either.
+# Pages are dropped from the map once read: they stay in the page cache, but
+# not in the RSS of the process.
+
+import hashlib
+import mmap
+import tempfile
+
+import conversion_progress
+import graphdef_wire
+
+SPILL_ATTR = '_spill'
+SPILL_MIN_BYTES = 64 * 1024
+ALIGNMENT = 64
+CHUNK_SIZE = 1 << 20
+# Share of the budget left at startup that payloads kept in memory may use,
+# the rest covers the graph structure, the parsed model and the one payload
+# being converted
+KEEP_FRACTION = 0.25
+
+MAP_ENTRY_KEY = 1
+MAP_ENTRY_VALUE = 2
+
+
+def drop_pages(mapped, offset, length):
+    # Releases the resident pages of a read-only file mapping
+    if length <= 0 or not hasattr(mmap, 'MADV_DONTNEED'):
+        return
+    start = offset - offset % mmap.PAGESIZE
+    mapped.madvise(mmap.MADV_DONTNEED, start, min(offset + length, len(mapped)) - start)
+
+
+def _key(field):
+    return graphdef_wire.encode_varint(field << 3 | graphdef_wire.LENGTH_DELIMITED)
+
+
+def _field_size(field, length):
+    # Encoded size of a length-delimited field with a length bytes value
+    return len(_key(field)) + len(graphdef_wire.encode_varint(length)) + length
+
+
+def _field_header(field, length):
+    return _key(field) + graphdef_wire.encode_varint(length)
+
+
+class ConstSpillStore(object):
+    def __init__(self, budget_bytes, directory=None):
+        # budget_bytes is the peak RSS to stay under, directory receives the
+        # spill file (the system temporary directory by default)
+        self.budget_bytes = budget_bytes
+        self.allowance = max(budget_bytes - (conversion_progress.rss_bytes() or 0), 0) * KEEP_FRACTION
+        self.directory = directory
+        self.file = tempfile.TemporaryFile(prefix='spill-', dir=directory)
+        self.size = 0
+        # entry number -> (offset, length)
+        self.entries = []
+        self.by_digest = {}
+        self.mapped = None
+        # Maps replaced when the file grew, callers may still hold views
+        self.old_maps = []
+        # name -> (mapped, offset, length) of payloads left in an input file
+        self.sources = {}
+        self.kept_bytes = 0
+        self.spilled_tensors = 0
+        self.spilled_bytes = 0
+
+    def add_source(self, name, mapped, offset, length):
+        self.sources[name] = (mapped, offset, length)
+
+    def has_source(self, name):
+        return name in self.sources
+
+    def source(self, name):
+        mapped, offset, length = self.sources[name]
+        return memoryview(mapped)[offset:offset + length]
+
+    def release_source(self, name):
+        # Drops the pages of an input payload read through source()
+        mapped, offset, length = self.sources[name]
+        drop_pages(mapped, offset, length)
+
+    def is_spilled(self, node):
+        return SPILL_ATTR in node.attr
+
+    def put(self, node, data):
+        # Sets the payload of the Const node, in memory or spilled. Returns
+        # True when spilled. data is bytes or a contiguous array.
+        tensor = node.attr['value'].tensor
+        view = memoryview(data)
+        # Views of empty arrays cannot be cast
+        view = view.cast('B') if view.nbytes > 0 else memoryview(b'')
+        if len(view) < SPILL_MIN_BYTES or self.kept_bytes + len(view) <= self.allowance:
+            tensor.tensor_content = view.tobytes()
+            self.kept_bytes += len(view)
+            return False
+        digest = hashlib.sha1(view).digest()
+        index = self.by_digest.get(digest)
+        if index is None:
+            offset = self.size + -self.size % ALIGNMENT
+            self.file.seek(offset)
+            for start in range(0, len(view), CHUNK_SIZE):
+                self.file.write(view[start:start + CHUNK_SIZE])
+            self.size = offset + len(view)
+            index = self.by_digest[digest] = len(self.entries)
+            self.entries.append((offset, len(view)))
+        tensor.ClearField('tensor_content')
+        node.attr[SPILL_ATTR].i = index
+        self.spilled_tensors += 1
+        self.spilled_bytes += len(view)
+        return True
+
+    def _map(self):
+        if self.mapped is None or len(self.mapped) < self.size:
+            self.file.flush()
+            if self.mapped is not None:
+                self.old_maps.append(self.mapped)
+            self.mapped = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.mapped
+
+    def payload(self, node):
+        # Read-only view of the spilled payload of node
+        offset, length = self.entries[node.attr[SPILL_ATTR].i]
+        return memoryview(self._map())[offset:offset + length]
+
+    def release(self, node):
+        # Drops the pages of a payload read through payload()
+        offset, length = self.entries[node.attr[SPILL_ATTR].i]
+        for mapped in self.old_maps + [self._map()]:
+            if len(mapped) >= offset + length:
+                drop_pages(mapped, offset, length)
+
+    def _write_spilled_node(self, node, stream):
+        # The node without its value attr, then value as one more map entry:
+        # AttrValue.tensor = TensorProto without content + tensor_content
+        offset, length = self.entries[node.attr[SPILL_ATTR].i]
+        skeleton = type(node)()
+        skeleton.CopyFrom(node)
+        del skeleton.attr[SPILL_ATTR]
+        tensor_bytes = skeleton.attr['value'].tensor.SerializeToString()
+        del skeleton.attr['value']
+        node_bytes = skeleton.SerializeToString()
+
+        tensor_size = len(tensor_bytes) + _field_size(graphdef_wire.TENSOR_CONTENT, length)
+        attr_size = _field_size(graphdef_wire.ATTR_TENSOR, tensor_size)
+        entry_size = _field_size(MAP_ENTRY_KEY, len(b'value')) + _field_size(MAP_ENTRY_VALUE, attr_size)
+        node_size = len(node_bytes) + _field_size(graphdef_wire.NODE_ATTR, entry_size)
+        header = b''.join([
+            _field_header(graphdef_wire.GRAPH_NODE, node_size), node_bytes,
+            _field_header(graphdef_wire.NODE_ATTR, entry_size),
+            _field_header(MAP_ENTRY_KEY, len(b'value')), b'value',
+            _field_header(MAP_ENTRY_VALUE, attr_size),
+            _field_header(graphdef_wire.ATTR_TENSOR, tensor_size), tensor_bytes,
+            _field_header(graphdef_wire.TENSOR_CONTENT, length)])
+        stream.write(header)
+        mapped = self._map()
+        for start in range(offset, offset + length, CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, offset + length)
+            stream.write(mapped[start:end])
+            drop_pages(mapped, start, end - start)
+        return len(header) + length
+
+    def write_graph_def(self, graph_def, stream):
+        # Serializes graph_def to stream with the spilled payloads in place.
+        # Returns the number of bytes written.
+        written = 0
+        for node in graph_def.node:
+            if self.is_spilled(node):
+                written += self._write_spilled_node(node, stream)
+                continue
+            data = node.SerializeToString()
+            header = _field_header(graphdef_wire.GRAPH_NODE, len(data))
+            stream.write(header)
+            stream.write(data)
+            written += len(header) + len(data)
+        # Fields after the nodes, the parser does not mind the order
+        rest = type(graph_def)()
+        for field in ('versions', 'library'):
+            if graph_def.HasField(field):
+                getattr(rest, field).CopyFrom(getattr(graph_def, field))
+        data = rest.SerializeToString()
+        stream.write(data)
+        return written + len(data)
+
+    def summary(self):
+        return {
+            'budget_bytes': self.budget_bytes,
+            'spilled_tensors': self.spilled_tensors,
+            'spilled_bytes': self.spilled_bytes,
+            'spill_file_bytes': self.size,
+            'peak_rss_bytes': conversion_progress.peak_rss_bytes(),
+        }
+
+    def close(self):
+        maps = self.old_maps + [self.mapped] + [source[0] for source in self.sources.values()]
+        for mapped in set(m for m in maps if m is not None):
+            try:
+                mapped.close()
+            except BufferError:
+                # A view is still alive, the map goes with it
+                pass
+        self.mapped = None
+        self.old_maps = []
+        self.sources = {}
+        self.file.close()
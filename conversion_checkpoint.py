@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Checkpoints of a running layer-by-layer conversion, so a killed or failed
+# run resumes where it stopped instead of starting over.
+#
+#   <path>.pb    partial GraphDef
+#   <path>.json  converter version, one sha1 per converted layer and the node
+#                and fallback counts after each completed layer or block
+#
+# Layers only append nodes, so the state after any completed boundary is a
+# prefix of the saved GraphDef. On resume the longest run of unchanged
+# layers is kept, which also covers edits to the prototxt after the
+# checkpoint: everything before the first edited layer is reused.
+# MemoryCheckpoint keeps the same state in memory, for --watch.
+
+import hashlib
+import json
+import os
+import time
+
+from google.protobuf.message import DecodeError
+
+import conversion_report
+
+FORMAT_VERSION = 1
+
+
+def layer_fingerprints(layers):
+    return [hashlib.sha1(layer.SerializeToString(deterministic=True)).hexdigest() for layer in layers]
+
+
+def _write_atomic(path, data, mode):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ConversionCheckpoint(object):
+    def __init__(self, path, version, interval=60.0):
+        # version identifies the converter, checkpoints of another version
+        # are ignored. interval is the least number of seconds between saves.
+        self.path = path
+        self.version = version
+        self.interval = interval
+        self.fingerprints = []
+        self.boundaries = []
+        self.last_save = time.time()
+
+    def restore(self, layers, graph_def, report):
+        # Loads the checkpoint into the empty graph_def and report. Returns
+        # the number of leading layers already converted.
+        self.fingerprints = layer_fingerprints(layers)
+        self.boundaries = [(0, 0, 0)]
+        self.last_save = time.time()
+        report['checkpoint'] = {'path': self.path, 'resumed_layers': 0, 'saves': 0}
+        try:
+            meta, data = self._load()
+            graph_def.ParseFromString(data)
+        except (IOError, ValueError, DecodeError):
+            # No checkpoint yet, or a torn one
+            del graph_def.node[:]
+            return 0
+        if meta.get('format') != FORMAT_VERSION or meta.get('version') != self.version:
+            del graph_def.node[:]
+            return 0
+
+        unchanged = 0
+        for saved, current in zip(meta['fingerprints'], self.fingerprints):
+            if saved != current:
+                break
+            unchanged += 1
+        start, num_nodes, num_fallbacks = max(b for b in [(0, 0, 0)] + [tuple(b) for b in meta['boundaries']] if b[0] <= unchanged)
+        if num_nodes > len(graph_def.node):
+            del graph_def.node[:]
+            return 0
+        del graph_def.node[num_nodes:]
+        for entry in meta['fallback_nodes'][:num_fallbacks]:
+            conversion_report.add_fallback(report, entry['name'], entry['type'])
+        self.boundaries = [tuple(b) for b in meta['boundaries'] if b[0] <= start]
+        report['checkpoint']['resumed_layers'] = start
+        return start
+
+    def update(self, layers_done, graph_def, report, force=False):
+        # Records a completed boundary, saves if interval has passed or force
+        self.boundaries.append((layers_done, len(graph_def.node), len(report['fallback_nodes'])))
+        if force or time.time() - self.last_save >= self.interval:
+            self.save(graph_def, report)
+
+    def save(self, graph_def, report):
+        # Only state up to the last recorded boundary is used on restore, so
+        # nodes of a layer that failed halfway are harmless
+        layers_done, num_nodes, num_fallbacks = self.boundaries[-1]
+        meta = {
+            'format': FORMAT_VERSION,
+            'version': self.version,
+            'fingerprints': self.fingerprints[:layers_done],
+            'boundaries': self.boundaries,
+            'fallback_nodes': report['fallback_nodes'][:num_fallbacks],
+        }
+        self._store(meta, graph_def.SerializeToString())
+        self.last_save = time.time()
+        report['checkpoint']['saves'] += 1
+
+    def _load(self):
+        with open(self.path + '.json') as f:
+            meta = json.load(f)
+        with open(self.path + '.pb', 'rb') as f:
+            return meta, f.read()
+
+    def _store(self, meta, data):
+        _write_atomic(self.path + '.pb', data, 'wb')
+        _write_atomic(self.path + '.json', json.dumps(meta), 'w')
+
+
+class MemoryCheckpoint(ConversionCheckpoint):
+    # Saved at the end of each conversion and when one fails, so the next
+    # conversion of the edited model in the same process reuses its prefix
+    def __init__(self, version):
+        ConversionCheckpoint.__init__(self, '<memory>', version, float('inf'))
+        self.saved = None
+
+    def _load(self):
+        if self.saved is None:
+            raise IOError('Nothing converted yet')
+        return self.saved
+
+    def _store(self, meta, data):
+        # boundaries is the live list, later updates must not change the save
+        self.saved = (dict(meta, boundaries=list(meta['boundaries'])), data)
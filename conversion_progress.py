@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Live progress of a layer-by-layer conversion: layers done out of total,
+# nodes per second, the op type being converted, the GraphDef byte size and
+# the process RSS. Shown as a progress bar on a TTY and, optionally, written
+# as JSON lines for batch orchestrators:
+#
+#   {"event": "start", "frontend": "caffe", "total": 243, "time": ...}
+#   {"event": "progress", "done": 120, "total": 243, "op_type": "Convolution",
+#    "layer": "res4b_branch2a", "nodes": 512, "nodes_per_sec": 803.1,
+#    "graph_bytes": 98304, "rss_bytes": 312475648, "elapsed": 0.64}
+#   {"event": "end", ...same fields as progress...}
+#   {"event": "error", "error": "KeyboardInterrupt()", ...}
+#
+# Events are rate limited: the first one comes after interval seconds, and
+# the wait after an event is at least OVERHEAD_FACTOR times what the event
+# cost, which keeps the overhead under 1% however large the graph gets.
+# GraphDef.ByteSize() serializes the whole graph, weights included, so the
+# size is summed from per-node sizes cached by node name and each node is
+# measured once.
+
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+BAR_WIDTH = 30
+OVERHEAD_FACTOR = 100
+
+
+def rss_bytes():
+    # Resident set size, or the peak RSS where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    # Highest RSS of the process so far
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _human_bytes(num_bytes):
+    if num_bytes is None:
+        return '?'
+    if num_bytes < 2**20:
+        return '%.0f KB' % (num_bytes / 2.0**10)
+    return '%.1f MB' % (num_bytes / 2.0**20)
+
+
+class ConversionProgress(object):
+    def __init__(self, frontend, total, tty=False, json_path=None, interval=0.5):
+        # tty draws the bar on stderr, json_path receives the JSON lines (a
+        # file or a named pipe). interval is the least number of seconds
+        # between events.
+        self.frontend = frontend
+        self.total = total
+        self.tty = tty
+        self.json_file = open(json_path, 'a') if json_path else None
+        self.interval = interval
+        self.start = time.time()
+        self.next_event = self.start + interval
+        self.node_bytes = {}
+        # Nodes already there at the first layer (initializers, a resumed
+        # checkpoint) do not count towards nodes/s
+        self.first_nodes = None
+        # Last reported position, for fail()
+        self.done = 0
+        self.graph_def = None
+        self._write({'event': 'start', 'frontend': frontend, 'total': total, 'time': self.start})
+
+    def _write(self, event):
+        if self.json_file is not None:
+            self.json_file.write(json.dumps(event) + '\n')
+            self.json_file.flush()
+
+    def _draw(self, event, end=False):
+        filled = BAR_WIDTH * event['done'] // max(event['total'], 1)
+        line = '[%s%s] %d/%d layers  %.0f nodes/s  %s  graph %s  RSS %s' % (
+            '#' * filled, '.' * (BAR_WIDTH - filled), event['done'], event['total'], event['nodes_per_sec'],
+            event['op_type'] or '-', _human_bytes(event['graph_bytes']), _human_bytes(event['rss_bytes']))
+        sys.stderr.write('\r\x1b[K' + line + ('\n' if end else ''))
+        sys.stderr.flush()
+
+    def _graph_bytes(self, graph_def):
+        total = 0
+        for node in graph_def.node:
+            size = self.node_bytes.get(node.name)
+            if size is None:
+                size = self.node_bytes[node.name] = node.ByteSize()
+            total += size
+        # Field tags and lengths of the repeated node field
+        return total + 4 * len(graph_def.node)
+
+    def _emit(self, kind, done, op_type, layer, graph_def, **extra):
+        now = time.time()
+        elapsed = now - self.start
+        if self.first_nodes is None:
+            self.first_nodes = len(graph_def.node)
+        event = {
+            'event': kind,
+            'done': done,
+            'total': self.total,
+            'op_type': op_type,
+            'layer': layer,
+            'nodes': len(graph_def.node),
+            'nodes_per_sec': (len(graph_def.node) - self.first_nodes) / max(elapsed, 1e-9),
+            'graph_bytes': self._graph_bytes(graph_def),
+            'rss_bytes': rss_bytes(),
+            'elapsed': elapsed,
+        }
+        event.update(extra)
+        self._write(event)
+        if self.tty:
+            self._draw(event, kind != 'progress')
+        cost = time.time() - now
+        self.next_event = now + max(self.interval, OVERHEAD_FACTOR * cost)
+
+    def update(self, done, op_type, layer, graph_def):
+        # Called before converting a layer; done layers are in graph_def
+        self.done = done
+        self.graph_def = graph_def
+        if self.first_nodes is None:
+            self.first_nodes = len(graph_def.node)
+        if time.time() >= self.next_event:
+            self._emit('progress', done, op_type, layer, graph_def)
+
+    def finish(self, done, graph_def):
+        self._emit('end', done, None, None, graph_def)
+        self.close()
+
+    def fail(self, error):
+        # Reports the error at the last update, the layer that was converting
+        if self.graph_def is not None:
+            self._emit('error', self.done, None, None, self.graph_def, error=repr(error))
+        else:
+            self._write({'event': 'error', 'done': 0, 'total': self.total, 'error': repr(error), 'elapsed': time.time() - self.start})
+        self.close()
+
+    def close(self):
+        if self.json_file is not None:
+            self.json_file.close()
+            self.json_file = None
+
+
+def from_options(frontend, total, options):
+    # None unless the converter options ask for progress
+    if not options.get('progress') and not options.get('progress_json'):
+        return None
+    return ConversionProgress(frontend, total, bool(options.get('progress')), options.get('progress_json'), options.get('progress_interval') or 0.5)
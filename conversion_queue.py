@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+# Work queue on a shared filesystem, so any number of hosts convert one model
+# zoo together. A queue is a directory:
+#
+#   pending/<job>.json          jobs waiting for a worker
+#   leased/<job>@<worker>.json  jobs being converted, the mtime is the heartbeat
+#   done/<job>.json             converted, with the output and report paths
+#   failed/<job>.json           out of attempts, with the error of each attempt
+#
+# Every state change is a rename, which is atomic on POSIX filesystems and
+# NFS, so exactly one worker wins each claim. Workers touch their lease while
+# converting; a lease not touched for lease_timeout seconds belongs to a dead
+# worker or a lost host and is taken back to pending by whichever worker sees it
+# first. Failed and expired attempts are retried with exponential backoff
+# until max_attempts. Times are compared against the file server's clock (the
+# mtime of a touched file), so hosts do not need synchronized clocks.
+#
+# Jobs run at least once. A reaping worker checks the heartbeat again after
+# taking a lease over and gives a live one back, but a worker stalled for
+# longer than lease_timeout loses its lease and the job runs a second time.
+# The stalled worker still finishes; outputs and reports are written to a
+# temporary name and renamed into place, so a duplicate run only replaces
+# them with the same contents.
+#
+#   $ python3 conversion_queue.py submit /shared/queue zoo/*.onnx zoo/*.prototxt --options '{"dedup": true}'
+#   $ python3 conversion_queue.py work /shared/queue --processes 4
+#   $ python3 conversion_queue.py status /shared/queue
+
+import argparse
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import compressed_io
+import conversion_report
+
+QUEUE_DIRS = ('pending', 'leased', 'done', 'failed')
+CLOCK_FILE = '.clock'
+LEASE_TIMEOUT = 300.0
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 30.0
+# Seconds a worker waits for a lease it found missing to be given back
+GIVE_BACK_SECONDS = 1.0
+
+# frontend -> (module, function(model_path, output_path, options) -> report)
+FRONTENDS = {
+    'onnx': ('onnx2tf', 'convert_onnx'),
+    'caffe': ('caffe2tf', 'convert_caffe'),
+}
+
+
+def frontend_of_path(path):
+    extension = os.path.splitext(compressed_io.strip_codec(path))[1].lower()
+    if extension == '.onnx':
+        return 'onnx'
+    if extension in ('.prototxt', '.caffemodel', '.binaryproto', '.pbtxt'):
+        return 'caffe'
+    raise ValueError('Cannot tell the frontend of %s, pass --frontend' % path)
+
+
+def job_id(model_path, output_path):
+    # Stable, so submitting the same model and output twice is detected
+    digest = hashlib.sha1(('%s\n%s' % (model_path, output_path)).encode('utf-8')).hexdigest()[:10]
+    base = os.path.splitext(os.path.basename(compressed_io.strip_codec(model_path)))[0]
+    return '%s-%s' % (base, digest)
+
+
+def worker_name():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def init_queue(queue_dir):
+    for d in QUEUE_DIRS:
+        path = os.path.join(queue_dir, d)
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+
+def fs_now(queue_dir):
+    # Current time of the file server, not of this host
+    path = os.path.join(queue_dir, CLOCK_FILE)
+    with open(path, 'a'):
+        os.utime(path, None)
+    return os.stat(path).st_mtime
+
+
+def _write_json(path, data):
+    # Written beside path and renamed over it. Names starting with '.' are
+    # never picked up as jobs.
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.%s.%s.tmp' % (name, worker_name()))
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _job_files(queue_dir, state):
+    return sorted(name for name in os.listdir(os.path.join(queue_dir, state)) if name.endswith('.json') and not name.startswith('.'))
+
+
+def _job_of_lease(name):
+    # "<job>@<worker>.json" -> "<job>"
+    return name[:-len('.json')].rsplit('@', 1)[0]
+
+
+def submit(queue_dir, model_path, output_path=None, frontend=None, options=None, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+    # Returns the job id, or None when the job is already queued or done
+    init_queue(queue_dir)
+    # Other hosts resolve the paths, so they are stored absolute
+    model_path = os.path.abspath(model_path)
+    if output_path is None:
+        output_path = os.path.splitext(compressed_io.strip_codec(model_path))[0] + '.pb'
+    output_path = os.path.abspath(output_path)
+    job = job_id(model_path, output_path)
+    for state in ('pending', 'done', 'failed'):
+        if os.path.exists(os.path.join(queue_dir, state, job + '.json')):
+            return None
+    if any(_job_of_lease(name) == job for name in _job_files(queue_dir, 'leased')):
+        return None
+    _write_json(os.path.join(queue_dir, 'pending', job + '.json'), {
+        'id': job,
+        'frontend': frontend or frontend_of_path(model_path),
+        'model': model_path,
+        'output': output_path,
+        'options': options or {},
+        'attempts': 0,
+        'max_attempts': max_attempts,
+        'retry_delay': retry_delay,
+        'not_before': 0.0,
+        'submitted': fs_now(queue_dir),
+        'errors': [],
+    })
+    return job
+
+
+class Lease(object):
+    def __init__(self, queue_dir, path, spec, worker, lease_timeout):
+        self.queue_dir = queue_dir
+        self.path = path
+        self.spec = spec
+        self.worker = worker
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, args=(lease_timeout / 4.0,), daemon=True)
+        self._thread.start()
+
+    def _touch(self):
+        try:
+            os.utime(self.path, None)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _heartbeat(self, interval):
+        while not self._stop.wait(interval):
+            if self._touch():
+                continue
+            # A reaping worker that renamed the lease just after a heartbeat
+            # gives it back at once
+            if self._stop.wait(GIVE_BACK_SECONDS) or self._touch():
+                continue
+            # Taken back as stale, the job is queued again
+            self.lost = True
+            return
+
+    def release(self, state, spec):
+        # Moves the job to pending, done or failed with the updated spec
+        self._stop.set()
+        self._thread.join()
+        _write_json(os.path.join(self.queue_dir, state, spec['id'] + '.json'), spec)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def retry_or_fail(self, error):
+        spec = dict(self.spec)
+        spec['errors'] = spec['errors'] + [{'worker': self.worker, 'attempt': spec['attempts'], 'error': error}]
+        if spec['attempts'] >= spec['max_attempts']:
+            self.release('failed', spec)
+            return 'failed'
+        spec['not_before'] = fs_now(self.queue_dir) + spec['retry_delay'] * 2 ** (spec['attempts'] - 1)
+        self.release('pending', spec)
+        return 'pending'
+
+
+def claim(queue_dir, worker, lease_timeout=LEASE_TIMEOUT):
+    # Leases the first ready pending job, or returns None
+    now = fs_now(queue_dir)
+    for name in _job_files(queue_dir, 'pending'):
+        job = name[:-len('.json')]
+        pending_path = os.path.join(queue_dir, 'pending', name)
+        try:
+            if _read_json(pending_path)['not_before'] > now:
+                continue
+        except (IOError, ValueError):
+            # Claimed meanwhile, or being replaced
+            continue
+        lease_path = os.path.join(queue_dir, 'leased', '%s@%s.json' % (job, worker))
+        try:
+            os.rename(pending_path, lease_path)
+        except FileNotFoundError:
+            # Another worker was faster
+            continue
+        spec = _read_json(lease_path)
+        if os.path.exists(os.path.join(queue_dir, 'done', name)):
+            # A run that lost its lease finished after all
+            os.remove(lease_path)
+            continue
+        spec['attempts'] += 1
+        _write_json(lease_path, spec)
+        return Lease(queue_dir, lease_path, spec, worker, lease_timeout)
+    return None
+
+
+def reap_stale(queue_dir, worker, lease_timeout=LEASE_TIMEOUT):
+    # Takes over leases not touched for lease_timeout seconds and releases
+    # them as failed attempts. Returns the number of jobs taken back.
+    now = fs_now(queue_dir)
+    reaped = 0
+    for name in _job_files(queue_dir, 'leased'):
+        path = os.path.join(queue_dir, 'leased', name)
+        try:
+            if now - os.stat(path).st_mtime < lease_timeout:
+                continue
+            job = _job_of_lease(name)
+            if job + '@' + worker + '.json' == name:
+                continue
+            # Taking the lease over first makes sure only one worker reaps it
+            own_path = os.path.join(queue_dir, 'leased', '%s@%s.json' % (job, worker))
+            os.rename(path, own_path)
+            # The rename keeps the mtime: a heartbeat between the stat and the
+            # rename means the owner is alive, the lease goes back to it
+            if now - os.stat(own_path).st_mtime < lease_timeout:
+                os.rename(own_path, path)
+                continue
+            os.utime(own_path, None)
+            spec = _read_json(own_path)
+        except FileNotFoundError:
+            continue
+        lease = Lease(queue_dir, own_path, spec, worker, lease_timeout)
+        lease.retry_or_fail('Lease of %s expired' % name[len(job) + 1:-len('.json')])
+        reaped += 1
+    return reaped
+
+
+def _tmp_output(path):
+    # Same directory and extension, so the codec is still picked from the name
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.%s.%s' % (worker_name(), name))
+
+
+def run_job(spec):
+    # Converts one job, returns its report. Outputs appear under their final
+    # names only when complete.
+    options = dict(spec['options'])
+    output_path = spec['output']
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    # Sidecar shards are named after the output, those are written in place
+    tmp_path = output_path if options.get('shard_size') else _tmp_output(output_path)
+    module_name, function_name = FRONTENDS[spec['frontend']]
+    convert = getattr(importlib.import_module(module_name), function_name)
+    report = convert(spec['model'], tmp_path, options)
+    if tmp_path != output_path:
+        os.replace(tmp_path, output_path)
+    report['output'] = output_path
+    report_path = conversion_report.report_path(output_path)
+    tmp_report = _tmp_output(report_path)
+    conversion_report.write_report(report, tmp_report)
+    os.replace(tmp_report, report_path)
+    return report
+
+
+def work(queue_dir, worker=None, lease_timeout=LEASE_TIMEOUT, poll_interval=2.0, exit_when_empty=False):
+    # Claims and converts jobs until the queue is empty (with exit_when_empty)
+    # or forever. Returns the number of jobs converted.
+    worker = worker or worker_name()
+    init_queue(queue_dir)
+    converted = 0
+    while True:
+        reap_stale(queue_dir, worker, lease_timeout)
+        lease = claim(queue_dir, worker, lease_timeout)
+        if lease is None:
+            if exit_when_empty and len(_job_files(queue_dir, 'pending')) == 0 and len(_job_files(queue_dir, 'leased')) == 0:
+                return converted
+            time.sleep(poll_interval)
+            continue
+        spec = lease.spec
+        print('[i] %s: converting %s (attempt %d of %d)' % (worker, spec['model'], spec['attempts'], spec['max_attempts']))
+        start = time.time()
+        try:
+            report = run_job(spec)
+        except KeyboardInterrupt:
+            # Stopped by hand, the attempt does not count
+            spec = dict(spec)
+            spec['attempts'] -= 1
+            lease.release('pending', spec)
+            raise
+        except Exception:
+            state = lease.retry_or_fail(traceback.format_exc())
+            print('[!] %s: %s failed, %s' % (worker, spec['model'], 'retrying later' if state == 'pending' else 'out of attempts'))
+            continue
+        done = dict(spec)
+        done.update({
+            'worker': worker,
+            'seconds': time.time() - start,
+            'report': conversion_report.report_path(spec['output']),
+            'output_bytes': report['output_bytes'],
+            'unsupported_types': report['unsupported_types'],
+            'lease_lost': lease.lost,
+        })
+        lease.release('done', done)
+        converted += 1
+        print('[i] %s: wrote %s' % (worker, spec['output']))
+
+
+def status(queue_dir):
+    counts = dict((state, len(_job_files(queue_dir, state))) for state in QUEUE_DIRS)
+    now = fs_now(queue_dir)
+    counts['workers'] = sorted(set(name[:-len('.json')].rsplit('@', 1)[1] for name in _job_files(queue_dir, 'leased')))
+    counts['oldest_heartbeat'] = max([now - os.stat(os.path.join(queue_dir, 'leased', name)).st_mtime for name in _job_files(queue_dir, 'leased')] or [0.0])
+    return counts
+
+
+def _work_process(queue_dir, lease_timeout, poll_interval, exit_when_empty):
+    return work(queue_dir, None, lease_timeout, poll_interval, exit_when_empty)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Distributes conversions over workers sharing a queue directory.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    submit_parser = commands.add_parser('submit', help='Queue models for conversion')
+    submit_parser.add_argument('queue', help='Queue directory on the shared filesystem')
+    submit_parser.add_argument('models', nargs='+', help='Caffe prototxt/NetParameter or ONNX models')
+    submit_parser.add_argument('--output-dir', help='Directory of the outputs. Default is next to each model.')
+    submit_parser.add_argument('--suffix', default='.pb', help='Output file extension, e.g. .pb.zst. Default is .pb.')
+    submit_parser.add_argument('--frontend', choices=['caffe', 'onnx'], help='Default is from the model extension.')
+    submit_parser.add_argument('--options', default='{}', help='Converter flags as JSON, e.g. \'{"dedup": true, "weights": true}\'')
+    submit_parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS, help='Attempts before a job is failed. Default is %d.' % MAX_ATTEMPTS)
+    submit_parser.add_argument('--retry-delay', type=float, default=RETRY_DELAY, help='Seconds before the first retry, doubled after each failed attempt. Default is %d.' % RETRY_DELAY)
+
+    work_parser = commands.add_parser('work', help='Convert queued models')
+    work_parser.add_argument('queue', help='Queue directory on the shared filesystem')
+    work_parser.add_argument('--processes', type=int, default=1, help='Worker processes on this host. Default is 1.')
+    work_parser.add_argument('--lease-timeout', type=float, default=LEASE_TIMEOUT, help='Seconds without a heartbeat before a lease is taken back. Default is %d.' % LEASE_TIMEOUT)
+    work_parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between looks at an empty queue. Default is 2.')
+    work_parser.add_argument('--exit-when-empty', action='store_true', help='Stop once no job is pending or leased.')
+
+    status_parser = commands.add_parser('status', help='Count jobs in each state')
+    status_parser.add_argument('queue', help='Queue directory on the shared filesystem')
+    args = parser.parse_args(args)
+
+    if args.command == 'submit':
+        options = json.loads(args.options)
+        queued = 0
+        for model in args.models:
+            output = None
+            if args.output_dir:
+                output = os.path.join(args.output_dir, os.path.splitext(os.path.basename(compressed_io.strip_codec(model)))[0] + args.suffix)
+            elif args.suffix != '.pb':
+                output = os.path.splitext(compressed_io.strip_codec(model))[0] + args.suffix
+            job = submit(args.queue, model, output, args.frontend, options, args.max_attempts, args.retry_delay)
+            if job is None:
+                print('[i] Already queued: ', model)
+            else:
+                queued += 1
+        print('[i] Queued %d jobs in %s' % (queued, args.queue))
+        return 0
+
+    if args.command == 'work':
+        if args.processes == 1:
+            work(args.queue, None, args.lease_timeout, args.poll_interval, args.exit_when_empty)
+            return 0
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=_work_process, args=(args.queue, args.lease_timeout, args.poll_interval, args.exit_when_empty)) for _ in range(args.processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        return 0
+
+    counts = status(args.queue)
+    print('[i] %s: %d pending, %d leased, %d done, %d failed' % (args.queue, counts['pending'], counts['leased'], counts['done'], counts['failed']))
+    if len(counts['workers']) > 0:
+        print('    Workers: %s, oldest heartbeat %.0f s ago' % (', '.join(counts['workers']), counts['oldest_heartbeat']))
+    for name in _job_files(args.queue, 'failed'):
+        spec = _read_json(os.path.join(args.queue, 'failed', name))
+        print('    Failed %s: %s' % (spec['model'], spec['errors'][-1]['error'].strip().splitlines()[-1]))
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Structured per-conversion report shared by caffe2tf and onnx2tf.
+# Written as JSON next to the output .pb.
+
+import collections
+import contextlib
+import json
+import os
+import time
+
+import compressed_io
+
+
+def new_report(frontend, model_path=None, output_path=None):
+    return {
+        'frontend': frontend,
+        'model': model_path,
+        'output': output_path,
+        'source_op_counts': {},
+        'tf_op_counts': {},
+        'unsupported_types': [],
+        'fallback_nodes': [],
+        'timings': collections.OrderedDict(),
+        'num_nodes': 0,
+        'num_edges': 0,
+        'output_bytes': 0,
+    }
+
+
+@contextlib.contextmanager
+def timed(report, phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        report['timings'][phase] = report['timings'].get(phase, 0.0) + time.time() - start
+
+
+def count_source_ops(report, op_types):
+    report['source_op_counts'] = dict(collections.Counter(op_types))
+
+
+def add_fallback(report, name, op_type):
+    # Layer converted to an Identity because its type is not supported
+    report['fallback_nodes'].append({'name': name, 'type': op_type})
+    if op_type not in report['unsupported_types']:
+        report['unsupported_types'].append(op_type)
+
+
+def finalize(report, graph_def, output_bytes):
+    report['tf_op_counts'] = dict(collections.Counter(n.op for n in graph_def.node))
+    report['num_nodes'] = len(graph_def.node)
+    report['num_edges'] = sum(len(n.input) for n in graph_def.node)
+    report['output_bytes'] = output_bytes
+
+
+def report_path(output_path):
+    return os.path.splitext(compressed_io.strip_codec(output_path))[0] + '.report.json'
+
+
+def write_report(report, path=None):
+    if path is None:
+        path = report_path(report['output'])
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Static cost estimate for converted GraphDefs: per-layer MACs, parameter
+# bytes and activation bytes, plus the peak live-activation memory when the
+# layers run in topological order. Shapes come from TensorFlow's shape
+# inference, the same lookups the converters use while emitting nodes.
+
+import argparse
+import collections
+import csv
+import heapq
+import json
+import os
+import sys
+
+import tensorflow as tf
+from tensorflow.core.framework import attr_value_pb2, graph_pb2
+
+import compressed_io
+import sharded_graphdef
+import tb_event_writer
+
+PARAM_OPS = ('Const', 'VariableV2')
+CSV_FIELDS = ['name', 'op', 'output_shapes', 'macs', 'param_bytes', 'activation_bytes']
+
+
+def dims_of(tensor, batch):
+    # Unknown batch dims count as batch, any other unknown dim gives None
+    if tensor.shape.dims is None:
+        return None
+    dims = tensor.shape.as_list()
+    if len(dims) > 0 and dims[0] is None:
+        dims[0] = batch
+    if any(d is None for d in dims):
+        return None
+    return dims
+
+
+def product(factors):
+    result = 1
+    for f in factors:
+        result *= f
+    return result
+
+
+def tensor_bytes(tensor, batch):
+    dims = dims_of(tensor, batch)
+    if dims is None:
+        return None
+    return product(dims) * tensor.dtype.size
+
+
+def layer_macs(op, batch):
+    # Multiply-accumulates of the compute-bound ops, every other op counts 0
+    if op.type in ('Conv2D', 'DepthwiseConv2dNative'):
+        out, kernel = dims_of(op.outputs[0], batch), dims_of(op.inputs[1], batch)
+        if out is None or kernel is None:
+            return None
+        # Each output element reads kh * kw (* in_channels for Conv2D) inputs
+        return product(out + kernel[:2] + (kernel[2:3] if op.type == 'Conv2D' else []))
+    if op.type == 'Conv2DBackpropInput':
+        grad, kernel = dims_of(op.inputs[2], batch), dims_of(op.inputs[1], batch)
+        if grad is None or kernel is None:
+            return None
+        # Each input element is scattered through kh * kw * out_channels weights
+        return product(grad + kernel[:3])
+    if op.type == 'MatMul':
+        out, a = dims_of(op.outputs[0], batch), dims_of(op.inputs[0], batch)
+        if out is None or a is None:
+            return None
+        return product(out) * a[0 if op.get_attr('transpose_a') else 1]
+    if op.type in ('FusedBatchNorm', 'FusedBatchNormV3'):
+        out = dims_of(op.outputs[0], batch)
+        return product(out) if out is not None else None
+    return 0
+
+
+def param_source(tensor):
+    # Const or variable behind a chain of Identity reads or the Cast (and Mul
+    # by scales) of a --weight-dtype payload, if any
+    op = tensor.op
+    while op.type in ('Identity', 'Cast', 'Mul') and len(op.inputs) > 0:
+        if op.type == 'Mul' and param_source(op.inputs[1]) is None:
+            break
+        op = op.inputs[0].op
+    return op if op.type in PARAM_OPS else None
+
+
+def data_path(graph):
+    # Ops downstream of a Placeholder, in topological order (Kahn's algorithm,
+    # ties broken by position in the GraphDef)
+    ops = graph.get_operations()
+    position = dict((op.name, i) for i, op in enumerate(ops))
+    reached = set(op.name for op in ops if op.type == 'Placeholder')
+    for op in ops:
+        if any(t.op.name in reached for t in op.inputs):
+            reached.add(op.name)
+    pending = {}
+    consumers = collections.defaultdict(list)
+    for op in ops:
+        if op.name not in reached:
+            continue
+        producers = set(t.op.name for t in op.inputs if t.op.name in reached)
+        pending[op.name] = len(producers)
+        for p in producers:
+            consumers[p].append(op.name)
+    ready = [position[name] for name, count in pending.items() if count == 0]
+    heapq.heapify(ready)
+    schedule = []
+    while len(ready) > 0:
+        op = ops[heapq.heappop(ready)]
+        schedule.append(op)
+        for c in consumers[op.name]:
+            pending[c] -= 1
+            if pending[c] == 0:
+                heapq.heappush(ready, position[c])
+    return schedule
+
+
+def estimate_costs(graph_def, batch=1):
+    # Returns (layers, summary). Sizes that depend on unknown dims are None.
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    schedule = data_path(graph)
+    on_path = set(op.name for op in schedule)
+
+    layers = []
+    params = {}
+    for op in schedule:
+        param_bytes = 0
+        for t in op.inputs:
+            source = param_source(t)
+            if source is not None and source.name not in on_path:
+                size = tensor_bytes(source.outputs[0], batch) or 0
+                params[source.name] = size
+                param_bytes += size
+        if op.type == 'Identity':
+            activation_bytes = 0
+        else:
+            sizes = [tensor_bytes(t, batch) for t in op.outputs]
+            activation_bytes = None if None in sizes else sum(sizes)
+        layers.append({
+            'name': op.name,
+            'op': op.type,
+            'output_shapes': [t.shape.as_list() if t.shape.dims is not None else None for t in op.outputs],
+            'macs': layer_macs(op, batch),
+            'param_bytes': param_bytes,
+            'activation_bytes': activation_bytes,
+        })
+
+    # Peak live activations: an output is allocated when its op runs and freed
+    # after its last consumer. Identity outputs alias their input buffer and
+    # outputs nobody consumes are freed right after their op, like unfetched
+    # outputs in the TensorFlow executor.
+    buffer_of = {}
+    buffer_bytes = {}
+    uses = collections.Counter()
+    for op in schedule:
+        for t in op.outputs:
+            if op.type == 'Identity' and op.inputs[0].name in buffer_of:
+                buffer_of[t.name] = buffer_of[op.inputs[0].name]
+            else:
+                buffer_of[t.name] = t.name
+                buffer_bytes[t.name] = tensor_bytes(t, batch) or 0
+        for t in op.inputs:
+            if t.name in buffer_of:
+                uses[buffer_of[t.name]] += 1
+    live = 0
+    peak = (0, '')
+    for op in schedule:
+        allocated = [t.name for t in op.outputs if buffer_of[t.name] == t.name]
+        live += sum(buffer_bytes[buf] for buf in allocated)
+        if live > peak[0]:
+            peak = (live, op.name)
+        for t in op.inputs:
+            if t.name in buffer_of:
+                buf = buffer_of[t.name]
+                uses[buf] -= 1
+                if uses[buf] == 0:
+                    live -= buffer_bytes[buf]
+        live -= sum(buffer_bytes[buf] for buf in allocated if uses[buf] == 0)
+
+    summary = {
+        'batch': batch,
+        'layers': len(layers),
+        'macs': sum(l['macs'] or 0 for l in layers),
+        'param_bytes': sum(params.values()),
+        'activation_bytes': sum(l['activation_bytes'] or 0 for l in layers),
+        'peak_activation_bytes': peak[0],
+        'peak_at': peak[1],
+        'unknown': [l['name'] for l in layers if l['macs'] is None or l['activation_bytes'] is None],
+    }
+    return layers, summary
+
+
+def annotate(graph_def, layers):
+    # Costs as underscore attrs, shown in TensorBoard's node info card;
+    # _output_shapes also labels the edges with tensor shapes
+    by_name = dict((l['name'], l) for l in layers)
+    for node in graph_def.node:
+        layer = by_name.get(node.name)
+        if layer is None:
+            continue
+        for key in ('macs', 'param_bytes', 'activation_bytes'):
+            if layer[key] is not None:
+                node.attr['_' + key].i = layer[key]
+        shapes = [tf.TensorShape(s).as_proto() for s in layer['output_shapes']]
+        node.attr['_output_shapes'].CopyFrom(attr_value_pb2.AttrValue(list=attr_value_pb2.AttrValue.ListValue(shape=shapes)))
+    return graph_def
+
+
+def write_csv(layers, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for l in layers:
+            row = dict(l)
+            row['output_shapes'] = ';'.join('x'.join('?' if d is None else str(d) for d in s) if s is not None else '?' for s in l['output_shapes'])
+            writer.writerow(row)
+
+
+def load_graph_def(path):
+    # Plain, compressed (.pb.zst, .pb.gz) or sharded GraphDef. Returns the
+    # GraphDef and, for a sharded one, its reader. Costs only need the Const
+    # shapes, so sharded payloads stay on disk.
+    if os.path.exists(sharded_graphdef.index_path(path)):
+        reader = sharded_graphdef.ShardedGraphReader(path)
+        return reader.load_graph_def(), reader
+    graph_def = graph_pb2.GraphDef()
+    graph_def.ParseFromString(compressed_io.read_file(path))
+    return graph_def, None
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Estimates per-layer MACs, parameter bytes and activation memory of a converted GraphDef.')
+    parser.add_argument('-g', '--graph', required=True, help='Converted .pb, .pb.zst or .pb.gz file, or the structure .pb of a sharded GraphDef')
+    parser.add_argument('--batch', type=int, default=1, help='Value used for unknown batch dimensions. Default is 1.')
+    parser.add_argument('--csv', help='Write per-layer costs to this CSV file')
+    parser.add_argument('--json', help='Write per-layer costs and the summary to this JSON file')
+    parser.add_argument('-o', '--output', help='Write a copy of the graph with the costs as node attributes')
+    parser.add_argument('-l', '--logdir', help='Write the annotated graph as a TensorBoard event file to this directory')
+    parser.add_argument('--top', type=int, default=10, help='Number of most expensive layers shown. Default is 10.')
+    args = parser.parse_args(args)
+
+    graph_def, reader = load_graph_def(args.graph)
+    try:
+        layers, summary = estimate_costs(graph_def, args.batch)
+    except ValueError as e:
+        # Shape inference rejected the graph, e.g. an op fed a wrong rank
+        print('Cannot infer shapes of %s: %s' % (args.graph, e))
+        return 1
+
+    print('[i] %s, batch %d, %d layers' % (args.graph, summary['batch'], summary['layers']))
+    print('    MACs %d (%.3f G)' % (summary['macs'], summary['macs'] / 1e9))
+    print('    parameters %.2f MB, activations %.2f MB' % (summary['param_bytes'] / 2.0**20, summary['activation_bytes'] / 2.0**20))
+    print('    peak live activations %.2f MB at %s' % (summary['peak_activation_bytes'] / 2.0**20, summary['peak_at']))
+    for l in sorted(layers, key=lambda l: l['macs'] or 0, reverse=True)[:args.top]:
+        if l['macs']:
+            print('    %-40s %-20s %d MACs' % (l['name'], l['op'], l['macs']))
+    if len(summary['unknown']) > 0:
+        print('    Unknown shapes, not counted (%d): %s' % (len(summary['unknown']), ', '.join(summary['unknown'])))
+
+    if args.csv:
+        write_csv(layers, args.csv)
+        print('[i] CSV: ', args.csv)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'graph': args.graph, 'summary': summary, 'layers': layers}, f, indent=1)
+        print('[i] JSON: ', args.json)
+    if args.output or args.logdir:
+        annotated = annotate(graph_def, layers)
+        if args.logdir:
+            # TensorBoard shows the structure, sharded payloads are left out
+            print('[i] Event file: ', tb_event_writer.write_graph_event(annotated.SerializeToString(), args.logdir))
+        if args.output:
+            if reader is not None:
+                # A single file again, only possible below 2 GB
+                reader.materialize(annotated)
+            compressed_io.write_file(args.output, annotated.SerializeToString())
+            print('[i] Annotated graph: ', args.output)
+    if reader is not None:
+        reader.close()
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
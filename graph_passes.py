@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+# GraphDef rewrite passes run by the converters after gen_initial_graphdef.
+# They only use the protobuf API, so TensorFlow is not imported here.
+
+import collections
+import hashlib
+import heapq
+import re
+
+import numpy as np
+
+
+def split_input(input_name):
+    # "^ctrl" -> ("^", "ctrl", ""), "node:1" -> ("", "node", ":1")
+    prefix = ''
+    if input_name.startswith('^'):
+        prefix = '^'
+        input_name = input_name[1:]
+    name, sep, port = input_name.partition(':')
+    return prefix, name, sep + port
+
+
+def rename_inputs(graph_def, renames):
+    for node in graph_def.node:
+        for i, input_name in enumerate(node.input):
+            prefix, name, port = split_input(input_name)
+            if name in renames:
+                node.input[i] = prefix + renames[name] + port
+
+
+def const_payloads(graph_def, store=None):
+    # Yields (node, tensor_content), content None for nodes other than Const.
+    # Payloads spilled to store (const_spill.ConstSpillStore) are read from
+    # it, their pages are dropped once the caller moves on.
+    for node in graph_def.node:
+        if node.op != 'Const':
+            yield node, None
+        elif store is not None and store.is_spilled(node):
+            yield node, store.payload(node)
+            store.release(node)
+        else:
+            yield node, node.attr['value'].tensor.tensor_content
+
+
+def dedup_constants(graph_def, store=None):
+    # Keeps one Const per distinct (dtype, shape, tensor_content) and rewires
+    # consumers of the duplicates to it. Returns (removed_nodes, bytes_saved).
+    canonical = {}
+    renames = {}
+    bytes_saved = 0
+    for node, content in const_payloads(graph_def, store):
+        if content is None or len(node.input) > 0 or len(content) == 0:
+            continue
+        tensor = node.attr['value'].tensor
+        h = hashlib.sha1(content)
+        h.update(node.device.encode('utf-8'))
+        h.update(node.attr['dtype'].SerializeToString())
+        h.update(tensor.tensor_shape.SerializeToString())
+        key = h.digest()
+        if key in canonical:
+            renames[node.name] = canonical[key]
+            # Spilled payloads are not part of ByteSize
+            bytes_saved += node.ByteSize() + len(content) - len(tensor.tensor_content)
+        else:
+            canonical[key] = node.name
+
+    if len(renames) > 0:
+        kept = [node for node in graph_def.node if node.name not in renames]
+        del graph_def.node[:]
+        graph_def.node.extend(kept)
+        rename_inputs(graph_def, renames)
+    return len(renames), bytes_saved
+
+
+# TensorFlow DataType enum values
+DT_FLOAT = 1
+DT_INT8 = 6
+DT_HALF = 19
+FLOAT16_MAX = 65504.0
+# Fewest values per channel for per-channel int8 scales, below that one scale
+# covers the tensor (e.g. PriorBox coordinates, biases)
+MIN_CHANNEL_VALUES = 16
+
+WEIGHT_DTYPES = ('fp32', 'fp16', 'int8')
+# Inputs that take learned weights, by op. Only Consts read there and nowhere
+# else have their precision reduced: other Consts (PriorBox priors, shapes,
+# anchors, lookup tables) are used as exact values.
+WEIGHT_INPUTS = {
+    'Conv2D': (1,),
+    'Conv3D': (1,),
+    'DepthwiseConv2dNative': (1,),
+    'Conv2DBackpropInput': (1,),
+    'MatMul': (1,),
+    'FusedBatchNorm': (1, 2, 3, 4),
+    'FusedBatchNormV3': (1, 2, 3, 4),
+}
+
+
+def _new_node(like, op, name, inputs=()):
+    # Detached NodeDef of the same class as like, without importing TensorFlow
+    node = type(like)()
+    node.op = op
+    node.name = name
+    node.device = like.device
+    node.input.extend(inputs)
+    return node
+
+
+def _const(like, name, dtype, array, store=None):
+    node = _new_node(like, 'Const', name)
+    node.attr['dtype'].type = dtype
+    tensor = node.attr['value'].tensor
+    tensor.dtype = dtype
+    for size in array.shape:
+        tensor.tensor_shape.dim.add(size=size)
+    if store is not None:
+        store.put(node, array.tobytes())
+    else:
+        tensor.tensor_content = array.tobytes()
+    return node
+
+
+def _cast(like, name, input_name, src_dtype):
+    node = _new_node(like, 'Cast', name, [input_name])
+    node.attr['SrcT'].type = src_dtype
+    node.attr['DstT'].type = DT_FLOAT
+    return node
+
+
+def weight_consts(graph_def):
+    # Names of the nodes only read at WEIGHT_INPUTS, control inputs aside
+    weight = set()
+    other = set()
+    for node in graph_def.node:
+        positions = WEIGHT_INPUTS.get(node.op, ())
+        for i, input_name in enumerate(node.input):
+            prefix, name, _ = split_input(input_name)
+            if prefix == '^':
+                continue
+            (weight if i in positions else other).add(name)
+    return weight - other
+
+
+def reduce_weight_precision(graph_def, weight_dtype, min_bytes=1024, store=None):
+    # Stores float32 weight payloads of at least min_bytes as float16 or int8:
+    # Consts read only as a convolution filter, a MatMul b operand or
+    # FusedBatchNorm parameters, see WEIGHT_INPUTS.
+    # Consumers still read a float32 tensor under the original name:
+    #   fp16: name/fp16 (Const) -> name (Cast)
+    #   int8: name/int8 (Const) -> name/cast (Cast) -> name (Mul by name/scale)
+    # int8 is symmetric with one scale per index of the last axis, the output
+    # channel of HWIO kernels and MatMul weights, when the channels are large
+    # enough. Payloads with values that do not fit (inf, nan, beyond float16
+    # range) stay float32.
+    # Returns (tensors, bytes_before, bytes_after) of the rewritten payloads.
+    # With a store, spilled payloads are read from it and the reduced ones
+    # spilled to it.
+    if weight_dtype == 'fp32':
+        return 0, 0, 0
+    reduced = 0
+    bytes_before = 0
+    bytes_after = 0
+    nodes = []
+    weights_only = weight_consts(graph_def)
+    for node, content in const_payloads(graph_def, store):
+        tensor = node.attr['value'].tensor if content is not None else None
+        if tensor is None or tensor.dtype != DT_FLOAT or len(content) < min_bytes or node.name not in weights_only:
+            nodes.append(node)
+            continue
+        shape = [d.size for d in tensor.tensor_shape.dim]
+        weights = np.frombuffer(content, dtype='<f4')
+        if weights.size != int(np.prod(shape)) or not np.isfinite(weights).all():
+            nodes.append(node)
+            continue
+        weights = weights.reshape(shape)
+        name = node.name
+        if weight_dtype == 'fp16':
+            if np.abs(weights).max() > FLOAT16_MAX:
+                nodes.append(node)
+                continue
+            half = weights.astype('<f2')
+            nodes.append(_const(node, name + '/fp16', DT_HALF, half, store))
+            nodes.append(_cast(node, name, name + '/fp16', DT_HALF))
+            stored = half.nbytes
+        else:
+            if weights.ndim >= 2 and weights.size >= MIN_CHANNEL_VALUES * shape[-1]:
+                absmax = np.abs(weights).max(axis=tuple(range(weights.ndim - 1)))
+            else:
+                absmax = np.abs(weights).max()
+            scale = np.where(absmax > 0, absmax / 127.0, 1.0).astype('<f4')
+            quantized = np.clip(np.rint(weights / scale), -127, 127).astype('i1')
+            nodes.append(_const(node, name + '/int8', DT_INT8, quantized, store))
+            nodes.append(_const(node, name + '/scale', DT_FLOAT, scale))
+            nodes.append(_cast(node, name + '/cast', name + '/int8', DT_INT8))
+            mul = _new_node(node, 'Mul', name, [name + '/cast', name + '/scale'])
+            mul.attr['T'].type = DT_FLOAT
+            nodes.append(mul)
+            stored = quantized.nbytes + scale.nbytes
+        reduced += 1
+        bytes_before += len(content)
+        bytes_after += stored
+
+    if reduced > 0:
+        del graph_def.node[:]
+        graph_def.node.extend(nodes)
+    return reduced, bytes_before, bytes_after
+
+
+_NAME_TOKEN = re.compile(r'[A-Za-z]+|\d+|[^A-Za-z\d]+')
+
+
+def _common_scope(names):
+    # Shared numbered part of the names, labelled after the first one:
+    # res2a, bn2b -> "res2", conv1_1, relu1_2 -> "conv1",
+    # concat_2_1, concat_2_2 -> "concat_2". None if no number is shared.
+    common = None
+    for name in names:
+        tokens = _NAME_TOKEN.findall(name)
+        first = next((k for k, token in enumerate(tokens) if token.isdigit()), len(tokens))
+        if common is None:
+            lead, common = ''.join(tokens[:first]), tokens[first:]
+            continue
+        for k, token in enumerate(tokens[first:first + len(common)] + [None]):
+            if k == len(common) or token != common[k]:
+                common = common[:k]
+                break
+    while len(common) > 0 and not common[-1][0].isalnum():
+        common.pop()
+    if len(common) == 0:
+        return None
+    return lead + ''.join(common)
+
+
+def _unique_label(label, used):
+    candidate = label
+    i = 1
+    while candidate in used:
+        candidate = '%s_%d' % (label, i)
+        i += 1
+    used.add(candidate)
+    return candidate
+
+
+def assign_name_scopes(graph_def, max_top_level=32):
+    # Nests top-level names into scopes TensorBoard can collapse:
+    #   stage/block/original_name
+    # A unit is every node sharing a top-level name ("fc6", "fc6/weights").
+    # Units are walked in topological order and a block ends at each join
+    # (a unit fed by two or more non-source units, e.g. a residual Add or a
+    # dense Concat). Consecutive blocks form a stage when their names share a
+    # numbered prefix (res2a, res2b -> res2) or they repeat the same ops.
+    # Returns (top_level_before, top_level_after).
+    units = []
+    unit_nodes = {}
+    for node in graph_def.node:
+        unit = node.name.split('/', 1)[0]
+        if unit not in unit_nodes:
+            unit_nodes[unit] = []
+            units.append(unit)
+        unit_nodes[unit].append(node)
+    if len(units) <= max_top_level:
+        return len(units), len(units)
+    order = {unit: i for i, unit in enumerate(units)}
+
+    preds = {unit: set() for unit in units}
+    succs = {unit: set() for unit in units}
+    for unit in units:
+        for node in unit_nodes[unit]:
+            for input_name in node.input:
+                src = split_input(input_name)[1].split('/', 1)[0]
+                if src != unit and src in preds:
+                    preds[unit].add(src)
+                    succs[src].add(unit)
+
+    # Kahn's algorithm, ties broken by position in the GraphDef
+    remaining = {unit: len(preds[unit]) for unit in units}
+    ready = [order[unit] for unit in units if remaining[unit] == 0]
+    heapq.heapify(ready)
+    topo = []
+    while len(ready) > 0:
+        unit = units[heapq.heappop(ready)]
+        topo.append(unit)
+        for succ in succs[unit]:
+            remaining[succ] -= 1
+            if remaining[succ] == 0:
+                heapq.heappush(ready, order[succ])
+    if len(topo) < len(units):
+        placed = set(topo)
+        topo.extend(unit for unit in units if unit not in placed)
+
+    # Sources (weights, inputs) follow their first consumer instead of
+    # piling up in the first block
+    sources = set(unit for unit in units if len(preds[unit]) == 0)
+    blocks = [[]]
+    for unit in topo:
+        if unit in sources:
+            continue
+        blocks[-1].append(unit)
+        if len([p for p in preds[unit] if p not in sources]) >= 2:
+            blocks.append([])
+    if len(blocks[-1]) == 0:
+        blocks.pop()
+    if len(blocks) == 0:
+        return len(units), len(units)
+    # Long join-free chains (VGG, or modules converted as one unit) are cut
+    # where the numbered part of the names changes: conv1_*, conv2_*, ...
+    split_blocks = []
+    for block in blocks:
+        if len(block) <= max_top_level:
+            split_blocks.append(block)
+            continue
+        run = [block[0]]
+        for unit in block[1:]:
+            if _common_scope(run + [unit]) is None:
+                split_blocks.append(run)
+                run = []
+            run.append(unit)
+        split_blocks.append(run)
+    blocks = split_blocks
+    block_of = {}
+    for i, block in enumerate(blocks):
+        for unit in block:
+            block_of[unit] = i
+    for unit in topo:
+        if unit in sources:
+            consumers = [s for s in succs[unit] if s in block_of]
+            if len(consumers) > 0:
+                blocks[block_of[min(consumers, key=order.get)]].insert(0, unit)
+            else:
+                blocks[0].insert(0, unit)
+
+    def signature(block):
+        ops = collections.Counter(n.op for unit in block for n in unit_nodes[unit] if n.op != 'Const')
+        return tuple(sorted(ops.items()))
+
+    # A block is labelled after its last unit, the join that closes it
+    labels = [block[-1] for block in blocks]
+    stages = []
+    for i, block in enumerate(blocks):
+        if len(stages) > 0:
+            stage = stages[-1]
+            prefix = _common_scope([labels[j] for j in stage['blocks']] + [labels[i]])
+            if prefix is not None and (len(stage['blocks']) == 1 or prefix == stage['prefix']):
+                stage['blocks'].append(i)
+                stage['prefix'] = prefix
+                continue
+            # Names without shared numbers (ONNX output ids): repeated motifs
+            if prefix is None and stage['prefix'] is None and signature(block) == signature(blocks[stage['blocks'][-1]]):
+                stage['blocks'].append(i)
+                continue
+        stages.append({'blocks': [i], 'prefix': None})
+
+    # Top-level items are (stage label or None, [(block label or None, units)])
+    items = []
+    for stage in stages:
+        members = [(labels[i] if len(blocks[i]) > 1 else None, blocks[i]) for i in stage['blocks']]
+        label = None
+        if len(members) > 1:
+            label = stage['prefix'] or '%s_to_%s' % (labels[stage['blocks'][0]], labels[stage['blocks'][-1]])
+        items.append((label, members))
+
+    # Still too wide, group consecutive items into parts
+    parts = [(None, items)]
+    if len(items) > max_top_level:
+        size = (len(items) + max_top_level - 1) // max_top_level
+        parts = []
+        for start in range(0, len(items), size):
+            chunk = items[start:start + size]
+            names = [label or members[0][0] or members[0][1][-1] for label, members in chunk]
+            first, last = chunk[0][1][0][1][-1], chunk[-1][1][-1][1][-1]
+            parts.append((_common_scope(names) or '%s_to_%s' % (first, last), chunk))
+
+    # Labels must not clash with names left at the same level
+    scope_of = {}
+    part_used = set()
+    for part_label, part_items in parts:
+        if part_label is not None:
+            part_label = _unique_label(part_label, part_used)
+        stage_used = set(members[0][0] or members[0][1][0] for stage_label, members in part_items if stage_label is None)
+        for stage_label, members in part_items:
+            if stage_label is not None:
+                stage_label = _unique_label(stage_label, stage_used)
+            for block_label, block in members:
+                prefix = '/'.join(l for l in (part_label, stage_label, block_label) if l is not None)
+                for unit in block:
+                    scope_of[unit] = prefix
+
+    renames = {}
+    for unit in units:
+        if scope_of.get(unit):
+            for node in unit_nodes[unit]:
+                renames[node.name] = scope_of[unit] + '/' + node.name
+    for node in graph_def.node:
+        if node.name in renames:
+            node.name = renames[node.name]
+    rename_inputs(graph_def, renames)
+
+    top_level = set(node.name.split('/', 1)[0] for node in graph_def.node)
+    return len(units), len(top_level)
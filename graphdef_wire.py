@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Minimal protobuf wire-format reader for serialized GraphDefs.
+# Only decodes the NodeDef fields the graph tools need, so converted .pb files
+# can be inspected without importing TensorFlow.
+
+import struct
+
+import compressed_io
+
+# Wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# GraphDef / NodeDef field numbers (tensorflow/core/framework/*.proto)
+GRAPH_NODE = 1
+NODE_NAME = 1
+NODE_OP = 2
+NODE_INPUT = 3
+NODE_ATTR = 5
+ATTR_LIST = 1
+ATTR_S = 2
+ATTR_I = 3
+ATTR_F = 4
+ATTR_B = 5
+ATTR_TYPE = 6
+ATTR_SHAPE = 7
+ATTR_TENSOR = 8
+TENSOR_DTYPE = 1
+TENSOR_SHAPE = 2
+TENSOR_CONTENT = 4
+SHAPE_DIM = 2
+SHAPE_UNKNOWN_RANK = 3
+DIM_SIZE = 1
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def to_signed64(value):
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def iter_fields(buf, start=0, end=None):
+    # Yields (field_number, wire_type, value). Length-delimited values are
+    # memoryview slices into buf, so nested messages are never copied.
+    if end is None:
+        end = len(buf)
+    pos = start
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field = key >> 3
+        wire_type = key & 0x7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('Unsupported wire type %d at offset %d' % (wire_type, pos))
+        yield field, wire_type, value
+
+
+def iter_field_spans(buf, start=0, end=None):
+    # Like iter_fields, also yielding where each encoded field starts and ends
+    # (key included), so callers can copy fields through unchanged
+    if end is None:
+        end = len(buf)
+    pos = start
+    while pos < end:
+        field_start = pos
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 0x7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type in (FIXED64, FIXED32):
+            value = buf[pos:pos + (8 if wire_type == FIXED64 else 4)]
+            pos += len(value)
+        else:
+            raise ValueError('Unsupported wire type %d at offset %d' % (wire_type, pos))
+        yield key >> 3, wire_type, value, field_start, pos
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def input_node_name(input_name):
+    # "^ctrl" -> "ctrl", "node:1" -> "node"
+    if input_name.startswith('^'):
+        input_name = input_name[1:]
+    return input_name.split(':')[0]
+
+
+class NodeRecord(object):
+    __slots__ = ('name', 'op', 'inputs', 'attrs')
+
+    def __init__(self):
+        self.name = ''
+        self.op = ''
+        self.inputs = []
+        # attr key -> raw serialized AttrValue bytes
+        self.attrs = {}
+
+
+def parse_node_def(buf, with_attrs=True):
+    node = NodeRecord()
+    for field, wire_type, value in iter_fields(buf):
+        if field == NODE_NAME:
+            node.name = bytes(value).decode('utf-8')
+        elif field == NODE_OP:
+            node.op = bytes(value).decode('utf-8')
+        elif field == NODE_INPUT:
+            node.inputs.append(bytes(value).decode('utf-8'))
+        elif field == NODE_ATTR and with_attrs:
+            key = ''
+            attr_value = b''
+            for entry_field, _, entry_value in iter_fields(value):
+                if entry_field == 1:
+                    key = bytes(entry_value).decode('utf-8')
+                elif entry_field == 2:
+                    attr_value = bytes(entry_value)
+            node.attrs[key] = attr_value
+    return node
+
+
+def parse_graph_def(buf, with_attrs=True):
+    buf = memoryview(buf)
+    nodes = []
+    for field, wire_type, value in iter_fields(buf):
+        if field == GRAPH_NODE and wire_type == LENGTH_DELIMITED:
+            nodes.append(parse_node_def(value, with_attrs))
+    return nodes
+
+
+def read_graph_def(path, with_attrs=True):
+    # .pb.gz / .pb.zst outputs are decompressed in memory
+    return parse_graph_def(compressed_io.read_file(path), with_attrs)
+
+
+def parse_tensor_shape(buf):
+    # Returns a list of dims (-1 for unknown) or None for unknown rank
+    dims = []
+    for field, _, value in iter_fields(buf):
+        if field == SHAPE_DIM:
+            size = 0
+            for dim_field, _, dim_value in iter_fields(value):
+                if dim_field == DIM_SIZE:
+                    size = to_signed64(dim_value)
+            dims.append(size)
+        elif field == SHAPE_UNKNOWN_RANK and value:
+            return None
+    return dims
+
+
+def attr_tensor(attr_bytes):
+    # Returns (dtype, shape, tensor_content) for a tensor-valued AttrValue
+    dtype = 0
+    shape = []
+    content = b''
+    for field, _, value in iter_fields(memoryview(attr_bytes)):
+        if field == ATTR_TENSOR:
+            for tensor_field, _, tensor_value in iter_fields(value):
+                if tensor_field == TENSOR_DTYPE:
+                    dtype = tensor_value
+                elif tensor_field == TENSOR_SHAPE:
+                    shape = parse_tensor_shape(tensor_value)
+                elif tensor_field == TENSOR_CONTENT:
+                    content = tensor_value
+    return dtype, shape, content
+
+
+def attr_scalar(attr_bytes):
+    # Decodes s/i/f/b/type/shape AttrValues, returns None for anything else
+    for field, _, value in iter_fields(memoryview(attr_bytes)):
+        if field == ATTR_S:
+            return bytes(value).decode('utf-8', 'replace')
+        elif field == ATTR_I:
+            return to_signed64(value)
+        elif field == ATTR_F:
+            return struct.unpack('<f', value)[0]
+        elif field == ATTR_B:
+            return bool(value)
+        elif field == ATTR_TYPE:
+            return value
+        elif field == ATTR_SHAPE:
+            return parse_tensor_shape(value)
+    return None
+
+
+def node_shape(node):
+    # Best-effort static output shape recorded on the NodeDef itself
+    if 'shape' in node.attrs:
+        return attr_scalar(node.attrs['shape'])
+    if '_output_shapes' in node.attrs:
+        for field, _, value in iter_fields(memoryview(node.attrs['_output_shapes'])):
+            if field == ATTR_LIST:
+                for list_field, _, list_value in iter_fields(value):
+                    if list_field == ATTR_SHAPE:
+                        return parse_tensor_shape(list_value)
+    if 'value' in node.attrs:
+        return attr_tensor(node.attrs['value'])[1]
+    return None
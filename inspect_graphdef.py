@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import sys
+
+import compressed_io
+import conversion_report
+import graphdef_wire
+import sharded_graphdef
+
+# TensorFlow auto-names ops after their type (e.g. "conv2d_transpose/BiasAdd_1")
+AUTO_NAME_SUFFIX = re.compile(r'_\d+$')
+
+
+def is_connector(node, index):
+    # Identity nodes the converters add to keep a layer name on a TensorFlow
+    # generated subgraph, as opposed to Identity fallbacks for unsupported
+    # layers. Only a guess from names and inputs, used for graphs without
+    # a conversion report.
+    if node.name.endswith('/read') or len(node.inputs) == 0:
+        return True
+    producer = index.get(graphdef_wire.input_node_name(node.inputs[0]))
+    if producer is None or producer.op == 'VariableV2':
+        return True
+    last = AUTO_NAME_SUFFIX.sub('', producer.name.split('/')[-1])
+    return '/' in producer.name and last == producer.op
+
+
+def graph_depth(nodes, index):
+    # Longest data-dependency chain, by Kahn's algorithm over the node graph
+    consumers = collections.defaultdict(list)
+    pending = {}
+    for node in nodes:
+        producers = set(graphdef_wire.input_node_name(i) for i in node.inputs)
+        producers = [p for p in producers if p in index]
+        pending[node.name] = len(producers)
+        for p in producers:
+            consumers[p].append(node.name)
+    depth = dict((name, 1) for name, count in pending.items() if count == 0)
+    ready = list(depth)
+    while ready:
+        name = ready.pop()
+        for c in consumers[name]:
+            depth[c] = max(depth.get(c, 1), depth[name] + 1)
+            pending[c] -= 1
+            if pending[c] == 0:
+                ready.append(c)
+    return max(depth.values()) if len(depth) > 0 else 0
+
+
+def report_fallbacks(path):
+    # Fallback node names recorded in the conversion report next to path,
+    # None when there is no report
+    try:
+        with open(conversion_report.report_path(path)) as f:
+            report = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return set(entry['name'] for entry in report.get('fallback_nodes', []))
+
+
+def is_recorded(name, recorded):
+    # --scopes prepends name scopes to the names the report recorded
+    parts = name.split('/')
+    return any('/'.join(parts[i:]) in recorded for i in range(len(parts)))
+
+
+def file_bytes(path):
+    # The structure .pb plus its shards and index for sharded outputs
+    total = os.path.getsize(path)
+    if os.path.exists(sharded_graphdef.index_path(path)):
+        reader = sharded_graphdef.ShardedGraphReader(path)
+        total += os.path.getsize(sharded_graphdef.index_path(path))
+        for shard in reader.index['shards']:
+            total += os.path.getsize(os.path.join(os.path.dirname(path), shard))
+    return total
+
+
+def summarize(path):
+    nodes = graphdef_wire.read_graph_def(path, with_attrs=False)
+    index = dict((n.name, n) for n in nodes)
+    fan_out = collections.Counter()
+    num_edges = 0
+    for node in nodes:
+        for i in node.inputs:
+            fan_out[graphdef_wire.input_node_name(i)] += 1
+            num_edges += 1
+    max_fan_in = max(nodes, key=lambda n: len(n.inputs)) if len(nodes) > 0 else None
+    max_fan_out = fan_out.most_common(1)[0] if len(fan_out) > 0 else ('', 0)
+    recorded = report_fallbacks(path)
+    if recorded is not None:
+        fallbacks = [n.name for n in nodes if n.op == 'Identity' and is_recorded(n.name, recorded)]
+    else:
+        fallbacks = [n.name for n in nodes if n.op == 'Identity' and not is_connector(n, index)]
+    return {
+        'path': path,
+        'bytes': file_bytes(path),
+        'nodes': len(nodes),
+        'edges': num_edges,
+        'depth': graph_depth(nodes, index),
+        'ops': collections.Counter(n.op for n in nodes).most_common(),
+        'max_fan_in': (max_fan_in.name, len(max_fan_in.inputs)) if max_fan_in is not None else ('', 0),
+        'max_fan_out': max_fan_out,
+        'fallbacks': fallbacks,
+    }
+
+
+def is_graph_file(name):
+    # model.pb, model.pb.gz, model.pb.zst. Shards and indexes of sharded
+    # outputs are summarized with their structure .pb.
+    return compressed_io.strip_codec(name).endswith('.pb')
+
+
+def collect_paths(paths):
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                result.extend(os.path.join(root, f) for f in sorted(files) if is_graph_file(f))
+        else:
+            result.append(path)
+    return result
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Summarizes converted TensorFlow GraphDefs without importing TensorFlow.')
+    parser.add_argument('paths', nargs='+', help='.pb (.pb.gz, .pb.zst) files or directories containing them')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Files summarized in parallel. Default is one per CPU.')
+    parser.add_argument('--top', type=int, default=10, help='Number of op types shown in the histogram. Default is 10.')
+    args = parser.parse_args(args)
+
+    paths = collect_paths(args.paths)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        summaries = list(executor.map(summarize, paths))
+
+    for s in summaries:
+        print('[i] %s (%d bytes)' % (s['path'], s['bytes']))
+        print('    nodes %d, edges %d, depth %d' % (s['nodes'], s['edges'], s['depth']))
+        print('    ops: ' + ', '.join('%s %d' % op for op in s['ops'][:args.top]))
+        print('    max fan-in: %s (%d), max fan-out: %s (%d)' % (s['max_fan_in'] + s['max_fan_out']))
+        if len(s['fallbacks']) > 0:
+            print('    Identity fallbacks (%d): %s' % (len(s['fallbacks']), ', '.join(s['fallbacks'])))
+
+
+if __name__=='__main__':
+    main(sys.argv[1:])
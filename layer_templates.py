@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Template cache for repeated Caffe blocks. A net is split into segments that
+# end at joins (layers with two or more bottoms, e.g. a residual Eltwise or a
+# Concat). Each segment is fingerprinted by its layer parameters, its wiring
+# relative to the segment and the shapes of the blobs it reads from outside.
+# The NodeDefs lowered for a segment are kept as a template with canonical
+# names, so a repeated block (res4b..res4f, or the same backbone in another
+# model) is instantiated by renaming instead of re-running the layer
+# handlers and their shape queries.
+#
+# Templates are GraphDefs in which layer k of the segment is named "L<k>" and
+# the j-th outside blob "IN<j>". They are kept in memory and, with a cache
+# directory, in <cache_dir>/<fingerprint>.pb.
+#
+# Only caffe2tf uses templates. onnx2tf answers its shape lookups from one
+# ONNX shape inference pass, so it does not pay for the per-layer graph
+# imports that templates avoid.
+
+import hashlib
+import json
+import os
+
+import tensorflow as tf
+from tensorflow.core.framework import graph_pb2
+
+import conversion_report
+from graph_passes import split_input
+
+# Marks template nodes of layers converted as Identity fallbacks, so the
+# report records them again when the template is instantiated
+FALLBACK_ATTR = '_template_fallback'
+
+
+def layer_segments(net):
+    # (start, end) layer index ranges, each ending at a join
+    start = 0
+    for i, layer in enumerate(net.layer):
+        if len(layer.bottom) >= 2:
+            yield start, i + 1
+            start = i + 1
+    if start < len(net.layer):
+        yield start, len(net.layer)
+
+
+def _shape_list(shape):
+    return None if shape.dims is None else shape.as_list()
+
+
+class TemplateCache(object):
+    def __init__(self, convert_layer, version, cache_dir=None):
+        # convert_layer(layer, graph_def, report) lowers one layer. version
+        # identifies the converter, templates from another version never match.
+        self.convert_layer = convert_layer
+        self.version = version
+        self.cache_dir = cache_dir
+        self.templates = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _wiring(self, layers):
+        # Bottoms as ("L", k) for layers of the segment, ("IN", j) otherwise
+        index = dict((layer.name, k) for k, layer in enumerate(layers))
+        outside = []
+        wiring = []
+        for layer in layers:
+            refs = []
+            for bottom in layer.bottom:
+                if bottom in index:
+                    refs.append(('L', index[bottom]))
+                else:
+                    if bottom not in outside:
+                        outside.append(bottom)
+                    refs.append(('IN', outside.index(bottom)))
+            wiring.append(refs)
+        return wiring, outside
+
+    def _fingerprint(self, layers, wiring, outside_shapes):
+        h = hashlib.sha1(self.version.encode('utf-8'))
+        for layer, refs in zip(layers, wiring):
+            params = type(layer)()
+            params.CopyFrom(layer)
+            for field in ('name', 'bottom', 'top', 'blobs'):
+                params.ClearField(field)
+            h.update(params.SerializeToString(deterministic=True))
+            h.update(json.dumps(refs).encode('utf-8'))
+        h.update(json.dumps(outside_shapes).encode('utf-8'))
+        return h.hexdigest()
+
+    def _load(self, key):
+        if key in self.templates:
+            return self.templates[key]
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, key + '.pb')
+        if not os.path.exists(path):
+            return None
+        template = graph_pb2.GraphDef()
+        with open(path, 'rb') as f:
+            template.ParseFromString(f.read())
+        self.templates[key] = template
+        return template
+
+    def _store(self, key, template):
+        self.templates[key] = template
+        if self.cache_dir is None:
+            return
+        path = os.path.join(self.cache_dir, key + '.pb')
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(template.SerializeToString())
+        os.replace(tmp_path, path)
+
+    def _canonical(self, name, names, outside):
+        # "res4b_branch2a/kernel" -> "L1/kernel", outside blobs -> "IN<j>"
+        if name in outside:
+            return 'IN%d' % outside.index(name)
+        prefix = name
+        while True:
+            if prefix in names:
+                return 'L%d%s' % (names[prefix], name[len(prefix):])
+            if '/' not in prefix:
+                return None
+            prefix = prefix.rsplit('/', 1)[0]
+
+    def _make_template(self, layers, outside, nodes, fallbacks):
+        names = dict((layer.name, k) for k, layer in enumerate(layers))
+        template = graph_pb2.GraphDef()
+        for node in nodes:
+            canonical = template.node.add()
+            canonical.CopyFrom(node)
+            name = self._canonical(node.name, names, outside)
+            if name is None or name.startswith('IN'):
+                return None
+            canonical.name = name
+            for i, input_name in enumerate(node.input):
+                prefix, base, port = split_input(input_name)
+                base = self._canonical(base, names, outside)
+                if base is None:
+                    return None
+                canonical.input[i] = prefix + base + port
+            if node.name in fallbacks:
+                canonical.attr[FALLBACK_ATTR].s = fallbacks[node.name].encode('utf-8')
+        return template
+
+    def _instantiate(self, template, layers, outside, output_graph_def, report):
+        def real(name):
+            head, sep, rest = name.partition('/')
+            if head.startswith('IN'):
+                return outside[int(head[2:])] + sep + rest
+            return layers[int(head[1:])].name + sep + rest
+
+        for canonical in template.node:
+            node = output_graph_def.node.add()
+            node.CopyFrom(canonical)
+            node.name = real(canonical.name)
+            for i, input_name in enumerate(canonical.input):
+                prefix, base, port = split_input(input_name)
+                node.input[i] = prefix + real(base) + port
+            if FALLBACK_ATTR in node.attr:
+                conversion_report.add_fallback(report, node.name, node.attr[FALLBACK_ATTR].s.decode('utf-8'))
+                del node.attr[FALLBACK_ATTR]
+
+    def convert_segment(self, layers, output_graph_def, report):
+        # Returns 'hit', 'miss' or 'uncacheable'
+        wiring, outside = self._wiring(layers)
+        outside_shapes = []
+        if len(outside) > 0:
+            # One shape query for the whole segment
+            try:
+                ops = tf.import_graph_def(output_graph_def, return_elements=outside, name="")
+            except ValueError:
+                # A bottom is not in the graph yet, convert layer by layer as usual
+                for layer in layers:
+                    self.convert_layer(layer, output_graph_def, report)
+                return 'uncacheable'
+            outside_shapes = [_shape_list(op.outputs[0].shape) if len(op.outputs) > 0 else None for op in ops]
+        key = self._fingerprint(layers, wiring, outside_shapes)
+
+        template = self._load(key)
+        if template is not None:
+            self._instantiate(template, layers, outside, output_graph_def, report)
+            return 'hit'
+
+        first_node = len(output_graph_def.node)
+        fallbacks = {}
+        for layer in layers:
+            num_fallbacks = len(report['fallback_nodes'])
+            self.convert_layer(layer, output_graph_def, report)
+            for entry in report['fallback_nodes'][num_fallbacks:]:
+                fallbacks[entry['name']] = entry['type']
+        template = self._make_template(layers, outside, output_graph_def.node[first_node:], fallbacks)
+        if template is None:
+            # Some node is not named after its layer, it cannot be renamed safely
+            return 'uncacheable'
+        self._store(key, template)
+        return 'miss'
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# Watch mode of the converters (--watch): the process stays up with
+# TensorFlow imported and converts the model again each time it is saved.
+#
+# The directory of the model is watched, not the file, so editors that save
+# through a temporary file and a rename are seen too. Linux uses inotify
+# (through libc, no extra package), elsewhere the file is polled. A change
+# is converted once the file has stopped changing for SETTLE_SECONDS, so a
+# half-written model is not read.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+import traceback
+
+POLL_INTERVAL = 0.2
+SETTLE_SECONDS = 0.05
+
+# inotify(7)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+def file_state(path):
+    # Changes whenever the file is written or replaced, None while missing
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class _Inotify(object):
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on %s' % directory)
+
+    def wait(self, timeout):
+        # Events are only a hint to look at the file again, drain them all
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poll(object):
+    def wait(self, timeout):
+        time.sleep(min(timeout, POLL_INTERVAL))
+
+    def close(self):
+        pass
+
+
+def _waiter(path):
+    if sys.platform.startswith('linux'):
+        try:
+            return _Inotify(os.path.dirname(os.path.abspath(path)))
+        except (OSError, AttributeError, TypeError):
+            # No inotify (old libc, watch limit reached), poll instead
+            pass
+    return _Poll()
+
+
+def _run(convert, previous_report):
+    # A failed conversion is reported and the watch goes on
+    start = time.time()
+    try:
+        report = convert()
+    except Exception:
+        traceback.print_exc()
+        print('[!] Conversion failed after %.2f s, waiting for the next save' % (time.time() - start))
+        return previous_report
+    print('[i] Converted in %.2f s' % (time.time() - start))
+    # One event file per watch, TensorBoard shows the latest graph
+    if previous_report is not None and previous_report.get('event_file') not in (None, report.get('event_file')):
+        try:
+            os.remove(previous_report['event_file'])
+        except OSError:
+            pass
+    return report
+
+
+def watch(path, convert):
+    # Calls convert() now and after each change of path, until Ctrl-C.
+    # convert returns the conversion report.
+    waiter = _waiter(path)
+    try:
+        last = file_state(path)
+        report = _run(convert, None)
+        print('[i] Watching %s (%s), Ctrl-C to stop' % (path, 'polling' if isinstance(waiter, _Poll) else 'inotify'))
+        while True:
+            waiter.wait(1.0)
+            state = file_state(path)
+            if state is None or state == last:
+                continue
+            time.sleep(SETTLE_SECONDS)
+            if file_state(path) != state:
+                continue
+            last = state
+            print('[i] %s changed' % path)
+            report = _run(convert, report)
+    except KeyboardInterrupt:
+        print('')
+    finally:
+        waiter.close()
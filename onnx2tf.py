@@ -11,12 +11,22 @@ import sys
 import numpy as np
 import onnx
 import tensorflow as tf
+from onnx import numpy_helper
 from tensorflow.core.framework import (attr_value_pb2, graph_pb2, node_def_pb2,
                                        op_def_pb2)
 from tensorflow.python.framework import tensor_shape, tensor_util
 
+import compressed_io
+import const_spill
+import conversion_progress
+import conversion_report
+import graph_passes
+import graphdef_wire
+import model_watch
+import sharded_graphdef
+import tb_event_writer
+
 types_in_graph = set()
-unsupported_onnx_types = set()
 onnx_tensor_dtype_to_tf_dtype = {
         1: 1, # float
         2: 4, # uint8
@@ -50,7 +60,77 @@ def extract_summary(graph):
         placeholders = inputs - tensors
         return name_to_graph_input, name_to_tensor, placeholders, tensors
 
-def create_constants(graph_def, name_to_graph_input, name_to_tensor, placeholders, tensors):
+# ModelProto.graph, GraphProto.initializer, TensorProto.data_type / name / raw_data
+MODEL_GRAPH = 7
+GRAPH_INITIALIZER = 5
+TENSOR_DATA_TYPE = 2
+TENSOR_NAME = 8
+TENSOR_RAW_DATA = 9
+
+def strip_initializer_payloads(model_data, store):
+        # Serialized ModelProto without the raw_data of large initializers,
+        # which are registered in store as sources at their offsets in
+        # model_data (an mmap), so parsing the model does not copy them
+        buf = memoryview(model_data)
+
+        def copy_fields(start, end, rewrite):
+                out = bytearray()
+                for field, wire_type, value, field_start, field_end in graphdef_wire.iter_field_spans(buf, start, end):
+                        if wire_type == graphdef_wire.LENGTH_DELIMITED and field in rewrite:
+                                body = rewrite[field](field_end - len(value), field_end)
+                                out += graphdef_wire.encode_varint(field << 3 | wire_type) + graphdef_wire.encode_varint(len(body)) + body
+                        else:
+                                out += buf[field_start:field_end]
+                return out
+
+        def strip_tensor(start, end):
+                name = None
+                data_type = None
+                payload = None
+                out = bytearray()
+                for field, wire_type, value, field_start, field_end in graphdef_wire.iter_field_spans(buf, start, end):
+                        if field == TENSOR_DATA_TYPE:
+                                data_type = value
+                        elif field == TENSOR_NAME:
+                                name = bytes(value).decode('utf-8')
+                        elif field == TENSOR_RAW_DATA and len(value) >= const_spill.SPILL_MIN_BYTES:
+                                payload = (field_end - len(value), len(value))
+                                continue
+                        out += buf[field_start:field_end]
+                if payload is None or name is None or onnx_tensor_dtype_to_tf_dtype.get(data_type) not in sharded_graphdef.TF_DTYPE_TO_NUMPY:
+                        return buf[start:end]
+                store.add_source(name, model_data, payload[0], payload[1])
+                return out
+
+        def strip_graph(start, end):
+                return copy_fields(start, end, {GRAPH_INITIALIZER: strip_tensor})
+
+        return bytes(copy_fields(0, len(buf), {MODEL_GRAPH: strip_graph}))
+
+def onnx_weight_to_tf(tensor, store=None):
+        # Initializer values reordered like create_constants orders their shapes (OIHW -> HWIO),
+        # as a contiguous array
+        if store is not None and store.has_source(tensor.name):
+                # raw_data was left in the mapped model file by strip_initializer_payloads, read it in place
+                dtype = sharded_graphdef.TF_DTYPE_TO_NUMPY[onnx_tensor_dtype_to_tf_dtype[tensor.data_type]]
+                array = np.frombuffer(store.source(tensor.name), dtype=dtype).reshape(tensor.dims)
+        else:
+                array = numpy_helper.to_array(tensor)
+        if array.ndim == 4:
+                array = np.transpose(array, (2, 3, 1, 0))
+        return np.ascontiguousarray(array)
+
+def set_weights(const, tensor, store=None):
+        # Initializer values into const, through the spill store under --max-memory
+        array = onnx_weight_to_tf(tensor, store)
+        if store is None:
+                const.attr["value"].tensor.tensor_content = array.tobytes()
+        else:
+                store.put(const, array)
+                if store.has_source(tensor.name):
+                        store.release_source(tensor.name)
+
+def create_constants(graph_def, name_to_graph_input, name_to_tensor, placeholders, tensors, with_weights=False, store=None):
         # Create Placeholders
         for name in placeholders:
                 tensor = name_to_graph_input[name]
@@ -63,7 +143,9 @@ def create_constants(graph_def, name_to_graph_input, name_to_tensor, placeholder
                 shape_proto = tensor.type.tensor_type.shape.dim
 
                 # Convert NCHW ordering to NHWC ordering
-                if len(shape_proto) == 4:
+                if not tensor.type.tensor_type.HasField("shape"):
+                        output_shape = None # Model input of unknown rank
+                elif len(shape_proto) == 4:
                         output_shape = [1,1,1,1]
                         output_shape[0] = shape_proto[0].dim_value
                         output_shape[1] = shape_proto[2].dim_value
@@ -91,575 +173,964 @@ def create_constants(graph_def, name_to_graph_input, name_to_tensor, placeholder
                         output_shape = unsorted_shape
                 shape_proto = tensor_shape.TensorShape(output_shape).as_proto()
                 const.attr["value"].tensor.tensor_shape.CopyFrom(shape_proto) 
+                if with_weights and onnx_dtype != 8: # Strings have no tensor_content
+                        const.attr["value"].tensor.dtype = onnx_tensor_dtype_to_tf_dtype[onnx_dtype]
+                        set_weights(const, tensor, store)
                 graph_def.node.extend([const])
 
-def gen_initial_graphdef(graph):
-        name_to_graph_input, name_to_tensor, placeholders, tensors = extract_summary(graph)
-        output_graph_def = graph_pb2.GraphDef()
-        create_constants(output_graph_def, name_to_graph_input, name_to_tensor, placeholders, tensors)
+def extract_subgraph(graph, outputs, inputs=(), value_infos=()):
+        # Returns a GraphProto holding only the nodes the requested outputs depend on.
+        # Tensors listed in inputs are cut and become graph inputs, typed by
+        # the graph's value_info or value_infos (e.g. infer_model_shapes).
+        producers = {}
+        for i, n in enumerate(graph.node):
+                for name in n.output:
+                        producers[name] = i
+                if n.name != "":
+                        producers[n.name] = i
+        initializers = dict((t.name, t) for t in graph.initializer)
+        graph_inputs = dict((t.name, t) for t in graph.input)
+        value_infos = dict((t.name, t) for t in list(graph.input) + list(value_infos) + list(graph.value_info) + list(graph.output))
+
+        keep = set()
+        used = set()
+        cuts = []
+        pending = []
+        for name in outputs:
+                if name not in producers:
+                        raise ValueError('No node produces "%s"' % name)
+                pending.append(producers[name])
+        while pending:
+                i = pending.pop()
+                if i in keep:
+                        continue
+                keep.add(i)
+                for name in graph.node[i].input:
+                        if name in inputs:
+                                if name not in cuts:
+                                        cuts.append(name)
+                        elif name in producers:
+                                pending.append(producers[name])
+                        elif name != "":
+                                used.add(name)
+
+        subgraph = onnx.GraphProto()
+        subgraph.name = graph.name
+        subgraph.node.extend([graph.node[i] for i in sorted(keep)])
+        subgraph.initializer.extend([initializers[name] for name in sorted(used) if name in initializers])
+        subgraph.input.extend([graph_inputs[name] for name in sorted(used) if name in graph_inputs])
+        for name in cuts:
+                if name not in value_infos or not value_infos[name].type.tensor_type.HasField("shape"):
+                        raise ValueError('Shape of cut tensor "%s" is unknown, the model has no value_info for it and ONNX shape inference found none' % name)
+                subgraph.input.extend([value_infos[name]])
+        return subgraph
+
+def nhwc(dims):
+        if len(dims) == 4:
+                return [dims[0], dims[2], dims[3], dims[1]]
+        return list(dims)
+
+def known_dims(value_info):
+        # Static ONNX dims of a ValueInfoProto, None if any dim is symbolic or missing
+        tensor_type = value_info.type.tensor_type
+        if not tensor_type.HasField("shape"):
+                return None
+        if not all(d.HasField("dim_value") for d in tensor_type.shape.dim):
+                return None
+        return [d.dim_value for d in tensor_type.shape.dim]
+
+def tf_window_dim(size, k, s, padding):
+        if padding == "SAME":
+                return -(-size // s)
+        return -(-(size - k + 1) // s)
+
+def lowered_shape(n, in_shapes):
+        # Shape TF infers for the lowering of n below, from the NHWC shapes of its
+        # inputs. None for ops not covered here, whose lowering may not keep the
+        # shape ONNX infers (Reshape, Flatten, Transpose, Identity fallbacks, ...).
+        if len(in_shapes) == 0 or in_shapes[0] is None:
+                return None
+        x = in_shapes[0]
+        attrs = dict((a.name, onnx.helper.get_attribute_value(a)) for a in n.attribute)
+        if n.op_type in ("Relu", "LRN", "Softmax", "BatchNormalization"):
+                return x
+        if n.op_type in ("Add", "Mul", "Sum"):
+                # Broadcasting differs between NCHW and NHWC
+                return x if all(s == x for s in in_shapes) else None
+        if n.op_type == "Concat":
+                axis = 0 if attrs.get("axis") == 0 else len(x) - 1
+                for s in in_shapes:
+                        if s is None or len(s) != len(x) or s[:axis] + s[axis+1:] != x[:axis] + x[axis+1:]:
+                                return None
+                return x[:axis] + [sum(s[axis] for s in in_shapes)] + x[axis+1:]
+        if n.op_type == "GlobalAveragePool" and len(x) == 4:
+                return [x[0], 1, 1, x[3]]
+        if n.op_type == "Gemm" and len(in_shapes) > 1 and in_shapes[1] is not None and len(x) == 2:
+                a = x[::-1] if attrs.get("transA", 0) else x
+                b = in_shapes[1][::-1] if attrs.get("transB", 0) else in_shapes[1]
+                return [a[0], b[1]] if a[1] == b[0] else None
+        if n.op_type == "Pad":
+                pads = list(attrs.get("pads", []))
+                rank = len(pads) // 2
+                if rank != len(x):
+                        return None
+                total = [pads[i] + pads[i+rank] for i in range(rank)]
+                return [d + p for d, p in zip(x, nhwc(total))]
+        if n.op_type in ("Conv", "MaxPool", "AveragePool") and len(x) == 4:
+                # Same padding choice as the lowering: SAME as soon as any pad is set
+                padding = "SAME" if any(p > 0 for p in attrs.get("pads", [])) else "VALID"
+                strides = list(attrs.get("strides", [1, 1]))
+                if n.op_type == "Conv":
+                        if len(in_shapes) < 2 or in_shapes[1] is None:
+                                return None
+                        kernel = list(attrs.get("kernel_shape", in_shapes[1][:2]))
+                        channels = in_shapes[1][3]
+                else:
+                        kernel = list(attrs.get("kernel_shape", [1, 1]))
+                        channels = x[3]
+                out = [x[0]] + [tf_window_dim(x[i+1], kernel[i], strides[i], padding) for i in range(2)] + [channels]
+                return out if min(out[1:3]) > 0 else None
+        return None
+
+# Ops lowered to NodeDefs with T=float, and ops built with TF ops whose output
+# dtype follows their first input. Other ops are Constants or Identity fallbacks.
+FLOAT_LOWERINGS = ("Add", "AveragePool", "BatchNormalization", "Concat", "Conv", "Gemm", "LRN", "MaxPool", "Mul",
+                   "Relu", "Softmax", "Sum")
+TF_BUILT_LOWERINGS = ("Flatten", "GlobalAveragePool", "Pad", "Reshape", "Transpose", "Upsample")
+
+def infer_model_shapes(model):
+        # GraphProto of model with the value_info of one ONNX shape inference pass
+        skeleton = onnx.ModelProto()
+        skeleton.ir_version = model.ir_version
+        skeleton.opset_import.extend(model.opset_import)
+        # Initializer shapes without their payloads, inference then skips copying weights
+        skeleton.graph.node.extend(model.graph.node)
+        skeleton.graph.input.extend(model.graph.input)
+        input_names = set(t.name for t in model.graph.input)
+        for tensor in model.graph.initializer:
+                if tensor.name not in input_names:
+                        skeleton.graph.input.extend([onnx.helper.make_tensor_value_info(tensor.name, tensor.data_type, tensor.dims)])
+        skeleton.graph.output.extend(model.graph.output)
+        skeleton.graph.value_info.extend(model.graph.value_info)
+        try:
+                return onnx.shape_inference.infer_shapes(skeleton).graph
+        except Exception:
+                # Inconsistent model, use the value_info it carries
+                return skeleton.graph
+
+def onnx_shape_index(model, graph, inferred=None):
+        # Output name -> (TF dtype enum, NHWC shape) of the tensors in the lowered
+        # graph. Shapes come from one ONNX shape inference pass over model (or
+        # inferred, its result) and are kept only where lowered_shape agrees
+        # with them, otherwise the shape is None and only lowerings that do not
+        # read it can use the entry.
+        if inferred is None:
+                inferred = infer_model_shapes(model)
+        onnx_shapes = {}
+        for value_info in list(inferred.value_info) + list(inferred.output):
+                dims = known_dims(value_info)
+                if dims is not None:
+                        onnx_shapes[value_info.name] = (value_info.type.tensor_type.elem_type, dims)
+
+        # Placeholders and Consts as create_constants shapes them
+        shapes = {}
+        initializers = set()
+        for tensor in graph.initializer:
+                initializers.add(tensor.name)
+                dims = list(tensor.dims)
+                if len(dims) == 4: # Kernels
+                        dims = [dims[2], dims[3], dims[1], dims[0]]
+                shapes[tensor.name] = (onnx_tensor_dtype_to_tf_dtype[tensor.data_type], dims)
+        for tensor in graph.input:
+                if tensor.name not in initializers:
+                        dims = known_dims(tensor)
+                        shapes[tensor.name] = (onnx_tensor_dtype_to_tf_dtype[tensor.type.tensor_type.elem_type], nhwc(dims) if dims is not None else None)
 
         for n in graph.node:
-                if n.op_type == "Add":
-                        # Generate node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Add"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        for name in n.input:
-                                new_node.input.extend([name])
-                        output_graph_def.node.extend([new_node])
+                if len(n.output) == 0 or n.name not in ("", n.output[0]):
+                        continue
+                if n.op_type in FLOAT_LOWERINGS:
+                        dtype = 1
+                elif n.op_type in TF_BUILT_LOWERINGS and len(n.input) > 0 and n.input[0] in shapes:
+                        dtype = shapes[n.input[0]][0]
+                else:
+                        continue
+                shape = None
+                if n.output[0] in onnx_shapes:
+                        elem_type, dims = onnx_shapes[n.output[0]]
+                        in_shapes = [shapes[name][1] if name in shapes else None for name in n.input]
+                        if onnx_tensor_dtype_to_tf_dtype.get(elem_type) == dtype and lowered_shape(n, in_shapes) == nhwc(dims):
+                                shape = nhwc(dims)
+                shapes[n.output[0]] = (dtype, shape)
+        return shapes
 
-                elif n.op_type == "BatchNormalization":
-                        # Prepare attributes
-                        if n.name == "":
-                                output_name = n.output[0]
-                        else:
-                                output_name = n.name
+def count_import(report, avoided):
+        report['tf_imports']['avoided' if avoided else 'performed'] += 1
 
-                        onnx_eps = 0.001
-                        onnx_momentum = 0.99
-                        onnx_is_test = 1
-                        tf_train = False
-                        for attr in n.attribute:
-                                if attr.name == "epsilon":
-                                        onnx_eps = attr.f 
-                                elif attr.name == "is_test":
-                                        onnx_is_test = attr.i 
-                                elif attr.name == "momentum":
-                                        onnx_momentum = attr.f
-
-                        if onnx_is_test == 0:
-                                tf_train = True
+def input_shape(output_graph_def, name, shapes, report):
+        # Shape of one tensor, from the index when it has it
+        if shapes is not None and name in shapes and shapes[name][1] is not None:
+                count_import(report, True)
+                return list(shapes[name][1])
+        count_import(report, False)
+        with tf.Graph().as_default():
+                op = tf.import_graph_def(output_graph_def, return_elements=[name], name="")[0]
+                return op.outputs[0].shape.as_list()
+
+def emit_nodes(output_graph_def, input_names, build, shapes, report, need_shapes=True):
+        # Calls build(tensors) with the named tensors and returns output_graph_def
+        # with the ops it created. When the index knows every input, the inputs are
+        # stand-in Placeholders in an empty graph and only the new ops are appended.
+        # Otherwise, or if a new op name is taken, the whole graph is imported.
+        # need_shapes=False accepts stand-ins of unknown shape, for builds that
+        # never read their input shapes.
+        if shapes is not None and all(name in shapes and (shapes[name][1] is not None or not need_shapes) for name in input_names):
+                with tf.Graph().as_default() as curr_graph:
+                        tensors = []
+                        for name in input_names:
+                                dtype, shape = shapes[name]
+                                tensors.append(tf.placeholder(tf.as_dtype(dtype), shape, name=name))
+                        if all(t.op.name == name for t, name in zip(tensors, input_names)):
+                                build(tensors)
+                new_nodes = [node for node in curr_graph.as_graph_def().node if node.name not in input_names]
+                existing = set(node.name for node in output_graph_def.node)
+                if len(new_nodes) > 0 and not any(node.name in existing for node in new_nodes):
+                        output_graph_def.node.extend(new_nodes)
+                        count_import(report, True)
+                        return output_graph_def
+        count_import(report, False)
+        with tf.Graph().as_default() as curr_graph:
+                ops = tf.import_graph_def(output_graph_def, return_elements=input_names, name="")
+                build([op.outputs[0] for op in ops])
+        return curr_graph.as_graph_def()
+
+def convert_node(n, output_graph_def, report, shapes, name_to_tensor, with_weights, store=None):
+        # Lowers one ONNX node. Returns the GraphDef, which handlers that build
+        # their nodes through an import replace by a new one.
+        if n.op_type == "Add":
+                # Generate node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Add"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                for name in n.input:
+                        new_node.input.extend([name])
+                output_graph_def.node.extend([new_node])
+
+        elif n.op_type == "BatchNormalization":
+                # Prepare attributes
+                if n.name == "":
+                        output_name = n.output[0]
+                else:
+                        output_name = n.name
+
+                onnx_eps = 0.001
+                onnx_momentum = 0.99
+                onnx_is_test = 1
+                tf_train = False
+                for attr in n.attribute:
+                        if attr.name == "epsilon":
+                                onnx_eps = attr.f 
+                        elif attr.name == "is_test":
+                                onnx_is_test = attr.i 
+                        elif attr.name == "momentum":
+                                onnx_momentum = attr.f
+
+                if onnx_is_test == 0:
+                        tf_train = True
                         
-                        # Generate node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "FusedBatchNorm"
-                        new_node.name = output_name
-                        new_node.attr["T"].type = 1
-                        new_node.attr["epsilon"].f = onnx_eps
-                        new_node.attr["is_training"].b = tf_train
-                        for name in n.input:
-                                new_node.input.extend([name])
-                        output_graph_def.node.extend([new_node])
+                # Generate node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "FusedBatchNorm"
+                new_node.name = output_name
+                new_node.attr["T"].type = 1
+                new_node.attr["epsilon"].f = onnx_eps
+                new_node.attr["is_training"].b = tf_train
+                for name in n.input:
+                        new_node.input.extend([name])
+                output_graph_def.node.extend([new_node])
 
-                elif n.op_type == "Conv":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Conv2D"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        new_node.input.extend([n.input[0]]) # Don't add weights/biases
-                        stride_list = [1,1,1,1]
-                        pad_bstring = "VALID".encode("utf-8")
-                        weight_tensor = name_to_tensor[n.input[1]]
-                        out_channels = weight_tensor.dims[0] 
-                        in_channels = weight_tensor.dims[1]
-                        kernel_shape_list = [1,1,in_channels,out_channels]
-                        for attr in n.attribute:
-                                if attr.name == "strides":
-                                        stride_list[1] = attr.ints[0]
-                                        stride_list[2] = attr.ints[1]
-                                elif attr.name == "pads":
-                                        for val in attr.ints:
-                                                if val > 0:
-                                                        pad_bstring = "SAME".encode("utf-8") 
-                                elif attr.name == "kernel_shape":
-                                        kernel_shape_list[0] = attr.ints[0]
-                                        kernel_shape_list[1] = attr.ints[1]
-                                #TODO: Dilations
-                        new_node.attr["padding"].s = pad_bstring
-                        new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
-
-                        # Generate kernel node
-                        kernel = node_def_pb2.NodeDef()
-                        kernel.op = "Const"      
-                        kernel.name = new_node.name + "/kernel"        
-                        kernel.attr["dtype"].type = 1
-                        kernel_shape = tensor_shape.TensorShape(kernel_shape_list).as_proto()
-                        kernel.attr["value"].tensor.tensor_shape.CopyFrom(kernel_shape) 
-                        new_node.input.extend([kernel.name])        
-
-                        output_graph_def.node.extend([kernel])
-                        output_graph_def.node.extend([new_node])
+        elif n.op_type == "Conv":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Conv2D"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                new_node.input.extend([n.input[0]]) # Don't add weights/biases
+                stride_list = [1,1,1,1]
+                pad_bstring = "VALID".encode("utf-8")
+                weight_tensor = name_to_tensor[n.input[1]]
+                out_channels = weight_tensor.dims[0] 
+                in_channels = weight_tensor.dims[1]
+                kernel_shape_list = [1,1,in_channels,out_channels]
+                for attr in n.attribute:
+                        if attr.name == "strides":
+                                stride_list[1] = attr.ints[0]
+                                stride_list[2] = attr.ints[1]
+                        elif attr.name == "pads":
+                                for val in attr.ints:
+                                        if val > 0:
+                                                pad_bstring = "SAME".encode("utf-8") 
+                        elif attr.name == "kernel_shape":
+                                kernel_shape_list[0] = attr.ints[0]
+                                kernel_shape_list[1] = attr.ints[1]
+                        #TODO: Dilations
+                new_node.attr["padding"].s = pad_bstring
+                new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
 
-                elif n.op_type == "Concat":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "ConcatV2"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        onnx_axis = n.attribute[0].i
-                        num_inputs = len(n.input)
-                        new_node.attr["N"].i = num_inputs
-                        for name in n.input:
-                                new_node.input.extend([name])
-
-                        # Generate axis input tensor
-                        axis = node_def_pb2.NodeDef()
-                        axis.op = "Const"
-                        axis.name = new_node.name + "/axis"
-                        axis.attr["dtype"].type = 3 # DT_INT32
-                        axis.attr["value"].tensor.dtype = 3 # DT_INT32
-
-                        # # Take into account NCHW ordering for onnx.Concat vs NHWC for tf.Concat        
-                        if onnx_axis == 0:
-                                tf_axis = 0
-                        else:
-                                tf_axis = -1
+                # Generate kernel node
+                kernel = node_def_pb2.NodeDef()
+                kernel.op = "Const"      
+                kernel.name = new_node.name + "/kernel"        
+                kernel.attr["dtype"].type = 1
+                kernel_shape = tensor_shape.TensorShape(kernel_shape_list).as_proto()
+                kernel.attr["value"].tensor.tensor_shape.CopyFrom(kernel_shape) 
+                if with_weights:
+                        kernel.attr["value"].tensor.dtype = 1
+                        set_weights(kernel, weight_tensor, store)
+                new_node.input.extend([kernel.name])        
 
-                        axis.attr["value"].tensor.int_val.append(tf_axis)
-                        new_node.input.extend([axis.name])
+                output_graph_def.node.extend([kernel])
+                output_graph_def.node.extend([new_node])
 
-                        output_graph_def.node.extend([axis])
-                        output_graph_def.node.extend([new_node])            
+        elif n.op_type == "Concat":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "ConcatV2"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                onnx_axis = n.attribute[0].i
+                num_inputs = len(n.input)
+                new_node.attr["N"].i = num_inputs
+                for name in n.input:
+                        new_node.input.extend([name])
 
-                elif n.op_type == "Constant":
-                        # Generate node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Const"
-                        new_node.attr["dtype"].type = 3 # DT_INT32
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        onnx_dims = n.attribute[0].t.dims[0]
-                        onnx_dt = n.attribute[0].t.data_type
-                        tf_dt = onnx_tensor_dtype_to_tf_dtype[onnx_dt]
-                        onnx_raw_data = n.attribute[0].t.raw_data # as a byte string
-                        new_node.attr["value"].tensor.dtype = tf_dt 
-                        new_node.attr["value"].tensor.tensor_content = onnx_raw_data
-                        new_node.attr["value"].tensor.tensor_shape.dim.add(size=onnx_dims)
+                # Generate axis input tensor
+                axis = node_def_pb2.NodeDef()
+                axis.op = "Const"
+                axis.name = new_node.name + "/axis"
+                axis.attr["dtype"].type = 3 # DT_INT32
+                axis.attr["value"].tensor.dtype = 3 # DT_INT32
+
+                # # Take into account NCHW ordering for onnx.Concat vs NHWC for tf.Concat        
+                if onnx_axis == 0:
+                        tf_axis = 0
+                else:
+                        tf_axis = -1
+
+                axis.attr["value"].tensor.int_val.append(tf_axis)
+                new_node.input.extend([axis.name])
+
+                output_graph_def.node.extend([axis])
+                output_graph_def.node.extend([new_node])            
+
+        elif n.op_type == "Constant":
+                # Generate node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Const"
+                new_node.attr["dtype"].type = 3 # DT_INT32
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                onnx_dims = n.attribute[0].t.dims[0]
+                onnx_dt = n.attribute[0].t.data_type
+                tf_dt = onnx_tensor_dtype_to_tf_dtype[onnx_dt]
+                onnx_raw_data = n.attribute[0].t.raw_data # as a byte string
+                new_node.attr["value"].tensor.dtype = tf_dt 
+                new_node.attr["value"].tensor.tensor_content = onnx_raw_data
+                new_node.attr["value"].tensor.tensor_shape.dim.add(size=onnx_dims)
                        
-                        output_graph_def.node.extend([new_node])
+                output_graph_def.node.extend([new_node])
 
-                # This is more like reshape in tensorflow
-                elif n.op_type == "Flatten": 
-                        if n.name == "":
-                                output_name = n.output[0]
-                        else:
-                                output_name = n.name
-                        input_name = n.input[0]
-                        onnx_axis = 1
-                        if len(n.attribute) > 0:
-                                onnx_axis = n.attribute[0].i
+        # This is more like reshape in tensorflow
+        elif n.op_type == "Flatten": 
+                if n.name == "":
+                        output_name = n.output[0]
+                else:
+                        output_name = n.name
+                input_name = n.input[0]
+                onnx_axis = 1
+                if len(n.attribute) > 0:
+                        onnx_axis = n.attribute[0].i
                         
-                        #Generate layer
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")
-                                input_tensor = op[0].outputs[0]
-                                input_tensor_shape = tensor.shape.as_list()    
-                                if onnx_axis == 1 and input_tensor_shape[0] == 1:
-                                        shape_tensor = tf.constant([1, -1], name=output_name+'/Const')
-                                        output_tensor = tf.reshape(input_tensor, shape_tensor, name=output_name)
-                                elif onnx_axis == 1 and input_tensor_shape[0] > 1:
-                                        shape_tensor = tf.constant([input_tensor_shape[0], -1], name=output_name+'/Const')
-                                        output_tensor = tf.reshape(input_tensor, shape_tensor, name=output_name)
-                                else:
-                                        dim0 = 1
-                                        for i in range(onnx_axis):
-                                                dim0 = dim0*input_tensor_shape[i]
-                                        shape_tensor = tf.constant([dim0, -1], name=output_name+'/Const')
-                                        output_tensor = tf.reshape(input_tensor, shape_tensor, name=output_name)
-                                
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif n.op_type == "Gemm":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "MatMul"
-                        if n.name == "":
-                                new_node.name = n.output[0]
+                #Generate layer
+                def build(tensors):
+                        input_tensor = tensors[0]
+                        input_tensor_shape = input_tensor.shape.as_list()
+                        if onnx_axis == 1 and input_tensor_shape[0] == 1:
+                                shape_tensor = tf.constant([1, -1], name=output_name+'/Const')
+                                output_tensor = tf.reshape(input_tensor, shape_tensor, name=output_name)
+                        elif onnx_axis == 1 and input_tensor_shape[0] > 1:
+                                shape_tensor = tf.constant([input_tensor_shape[0], -1], name=output_name+'/Const')
+                                output_tensor = tf.reshape(input_tensor, shape_tensor, name=output_name)
                         else:
-                                new_node.name = n.name
+                                dim0 = 1
+                                for i in range(onnx_axis):
+                                        dim0 = dim0*input_tensor_shape[i]
+                                shape_tensor = tf.constant([dim0, -1], name=output_name+'/Const')
+                                output_tensor = tf.reshape(input_tensor, shape_tensor, name=output_name)
 
-                        onnx_transA = 0
-                        onnx_transB = 0
-                        for attr in n.attribute:
-                                if attr.name == "transA":
-                                        onnx_transA = attr.i
-                                elif attr.name == "transB":
-                                        onnx_transB = attr.i
-
-                        new_node.attr["T"].type = 1                                            
-                        if onnx_transA != 0:
-                                new_node.attr["transpose_a"].b = True
-                        if onnx_transB != 0:
-                                new_node.attr["transpose_b"].b = True
-
-                        # Add inputs, ignore input C since we don't care about bias adds
-                        new_node.input.extend([n.input[0]])
-                        new_node.input.extend([n.input[1]])
-                        output_graph_def.node.extend([new_node])
+                # Update output_graph_def
+                output_graph_def = emit_nodes(output_graph_def, [input_name], build, shapes, report)
 
-                elif n.op_type == "GlobalAveragePool":
-                        if n.name == "":
-                                output_name = n.output[0]
-                        else:
-                                output_name = n.name
-                        input_name = n.input[0]
+        elif n.op_type == "Gemm":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "MatMul"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+
+                onnx_transA = 0
+                onnx_transB = 0
+                for attr in n.attribute:
+                        if attr.name == "transA":
+                                onnx_transA = attr.i
+                        elif attr.name == "transB":
+                                onnx_transB = attr.i
+
+                new_node.attr["T"].type = 1                                            
+                if onnx_transA != 0:
+                        new_node.attr["transpose_a"].b = True
+                if onnx_transB != 0:
+                        new_node.attr["transpose_b"].b = True
+
+                # Add inputs, ignore input C since we don't care about bias adds
+                new_node.input.extend([n.input[0]])
+                new_node.input.extend([n.input[1]])
+                output_graph_def.node.extend([new_node])
+
+        elif n.op_type == "GlobalAveragePool":
+                if n.name == "":
+                        output_name = n.output[0]
+                else:
+                        output_name = n.name
+                input_name = n.input[0]
                         
-                        # Generate layer     
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")
-                                tensor = op[0].outputs[0]        
-                                output_tensor = tf.keras.layers.GlobalAveragePooling2D()(tensor)  # Shape: [N, C]
-                                # Convert to [N, 1, 1, C] as per onnx specification     
-                                intermediate_tensor = tf.expand_dims(output_tensor, axis=1, name=output_name+'_1')
-                                tf.expand_dims(intermediate_tensor, axis=1, name=output_name)                            
+                # Generate layer     
+                def build(tensors):
+                        output_tensor = tf.keras.layers.GlobalAveragePooling2D()(tensors[0])  # Shape: [N, C]
+                        # Convert to [N, 1, 1, C] as per onnx specification     
+                        intermediate_tensor = tf.expand_dims(output_tensor, axis=1, name=output_name+'_1')
+                        tf.expand_dims(intermediate_tensor, axis=1, name=output_name)                            
                         
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif n.op_type == "LRN":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "LRN"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
+                # Update output_graph_def
+                output_graph_def = emit_nodes(output_graph_def, [input_name], build, shapes, report)
 
-                        # Intialize attrs using tf defaults
-                        onnx_size = 5 
-                        onnx_alpha = 1e-4
-                        onnx_beta = 0.5
-                        onnx_bias = 1.0
+        elif n.op_type == "LRN":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "LRN"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
 
-                        for attr in n.attribute:
-                                if attr.name == "size":
-                                        onnx_size = attr.i
-                                elif attr.name == "alpha":
-                                        onnx_alpha = attr.f                    
-                                elif attr.name == "beta":
-                                        onnx_beta = attr.f 
-                                elif attr.name == "bias":
-                                        onnx_bias = attr.f        
-
-                        new_node.attr["alpha"].f = onnx_alpha
-                        new_node.attr["beta"].f = onnx_beta
-                        new_node.attr["depth_radius"].i = onnx_size
-                        new_node.attr["bias"].f = onnx_bias
-                        new_node.attr["T"].type = 1
-                        new_node.input.extend([n.input[0]])
+                # Intialize attrs using tf defaults
+                onnx_size = 5 
+                onnx_alpha = 1e-4
+                onnx_beta = 0.5
+                onnx_bias = 1.0
 
-                        output_graph_def.node.extend([new_node])   
+                for attr in n.attribute:
+                        if attr.name == "size":
+                                onnx_size = attr.i
+                        elif attr.name == "alpha":
+                                onnx_alpha = attr.f                    
+                        elif attr.name == "beta":
+                                onnx_beta = attr.f 
+                        elif attr.name == "bias":
+                                onnx_bias = attr.f        
 
-                elif n.op_type == "MaxPool" or n.op_type == "AveragePool":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        if n.op_type == "MaxPool":
-                                new_node.op = "MaxPool"
-                        else:
-                                new_node.op = "AvgPool" 
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        new_node.input.extend([n.input[0]])
-                        stride_list = [1,1,1,1]
-                        pad_bstring = "VALID".encode("utf-8")
-                        kernel_shape_list = [1,1,1,1]
-                        pad_list = [0,0,0,0]
-                        for attr in n.attribute:
-                                if attr.name == "strides":
-                                        stride_list[1] = attr.ints[0]
-                                        stride_list[2] = attr.ints[1]
-                                elif attr.name == "pads":
-                                        for i,val in enumerate(attr.ints):
-                                                pad_list[i] = val                                                
-                                                if val > 0:
-                                                        pad_bstring = "SAME".encode("utf-8") 
-                                elif attr.name == "kernel_shape":
-                                        kernel_shape_list[1] = attr.ints[0]
-                                        kernel_shape_list[2] = attr.ints[1]
-                        new_node.attr["ksize"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=kernel_shape_list))
-                        new_node.attr["padding"].s = pad_bstring
-                        new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
-
-                        # Clean output shape since onnx does weird things
-                        input_as_op = tf.import_graph_def(output_graph_def, return_elements=[n.input[0]], name="")[0]
-                        bottom_shape = input_as_op.outputs[0].shape.as_list()
-                        onnx_out_spatial = bottom_shape
-                        need_squeeze = False
-                        squeeze_dims = []
-                        if len(bottom_shape) > 2:
-                                start_index = 1
+                new_node.attr["alpha"].f = onnx_alpha
+                new_node.attr["beta"].f = onnx_beta
+                new_node.attr["depth_radius"].i = onnx_size
+                new_node.attr["bias"].f = onnx_bias
+                new_node.attr["T"].type = 1
+                new_node.input.extend([n.input[0]])
+
+                output_graph_def.node.extend([new_node])   
+
+        elif n.op_type == "MaxPool" or n.op_type == "AveragePool":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                if n.op_type == "MaxPool":
+                        new_node.op = "MaxPool"
+                else:
+                        new_node.op = "AvgPool" 
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                new_node.input.extend([n.input[0]])
+                stride_list = [1,1,1,1]
+                pad_bstring = "VALID".encode("utf-8")
+                kernel_shape_list = [1,1,1,1]
+                pad_list = [0,0,0,0]
+                for attr in n.attribute:
+                        if attr.name == "strides":
+                                stride_list[1] = attr.ints[0]
+                                stride_list[2] = attr.ints[1]
+                        elif attr.name == "pads":
+                                for i,val in enumerate(attr.ints):
+                                        pad_list[i] = val                                                
+                                        if val > 0:
+                                                pad_bstring = "SAME".encode("utf-8") 
+                        elif attr.name == "kernel_shape":
+                                kernel_shape_list[1] = attr.ints[0]
+                                kernel_shape_list[2] = attr.ints[1]
+                new_node.attr["ksize"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=kernel_shape_list))
+                new_node.attr["padding"].s = pad_bstring
+                new_node.attr["strides"].list.CopyFrom(attr_value_pb2.AttrValue.ListValue(i=stride_list))
+
+                # Clean output shape since onnx does weird things
+                bottom_shape = input_shape(output_graph_def, n.input[0], shapes, report)
+                onnx_out_spatial = bottom_shape
+                need_squeeze = False
+                squeeze_dims = []
+                if len(bottom_shape) > 2:
+                        start_index = 1
+                else:
+                        start_index = 0
+                for i in range(start_index, start_index + 2):
+                        if start_index == 1:
+                                pad_total = pad_list[i*2 - 2] + pad_list[i*2 - 1]
+                                k_val = kernel_shape_list[i]
+                                s_val = stride_list[i]
                         else:
-                                start_index = 0
-                        for i in range(start_index, start_index + 2):
-                                if start_index == 1:
-                                        pad_total = pad_list[i*2 - 2] + pad_list[i*2 - 1]
-                                        k_val = kernel_shape_list[i]
-                                        s_val = stride_list[i]
-                                else:
-                                        pad_total = pad_list[i*2] + pad_list[i*2 + 1]
-                                        k_val = kernel_shape_list[i-1]
-                                        s_val = stride_list[i-1]
-                                onnx_out_spatial[i] = math.floor((onnx_out_spatial[i] + pad_total - k_val) / (s_val + 1))
-                                if onnx_out_spatial[i] == 0:
-                                        need_squeeze = True
-                                        squeeze_dims.append(i)
-                        if need_squeeze == True:
-                                original_name = new_node.name
-                                new_node.name = new_node.name + '/presqueeze'
-                                output_graph_def.node.extend([new_node])
-                                with tf.Graph().as_default() as curr_graph:
-                                        op = tf.import_graph_def(output_graph_def, return_elements=[new_node.name], name="")
-                                        tensor = op[0].outputs[0]
-                                        tf.squeeze(tensor, squeeze_dims, name=new_node.name + '/Squeeze')
+                                pad_total = pad_list[i*2] + pad_list[i*2 + 1]
+                                k_val = kernel_shape_list[i-1]
+                                s_val = stride_list[i-1]
+                        onnx_out_spatial[i] = math.floor((onnx_out_spatial[i] + pad_total - k_val) / s_val) + 1
+                        if onnx_out_spatial[i] == 0:
+                                need_squeeze = True
+                                squeeze_dims.append(i)
+                if need_squeeze == True:
+                        original_name = new_node.name
+                        new_node.name = new_node.name + '/presqueeze'
+                        output_graph_def.node.extend([new_node])
+                        def build(tensors):
+                                tf.squeeze(tensors[0], squeeze_dims, name=new_node.name + '/Squeeze')
                                 
-                                # Update output_graph_def
-                                output_graph_def = curr_graph.as_graph_def()
-                                tail_name = new_node.name + '/Squeeze'
+                        # Update output_graph_def
+                        output_graph_def = emit_nodes(output_graph_def, [new_node.name], build, shapes, report, need_shapes=False)
+                        tail_name = new_node.name + '/Squeeze'
                                 
-                                # Use Identity op to maintain layer.name in graph_def
-                                connector = node_def_pb2.NodeDef()
-                                connector.op = "Identity"
-                                connector.name = original_name
-                                connector.attr["T"].type = 1
-                                connector.input.extend([tail_name])
-                                output_graph_def.node.extend([connector])
-                        else:
-                                output_graph_def.node.extend([new_node])
-
-                elif n.op_type == "Mul":
-                        # Generate node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Mul"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        for name in n.input:
-                                new_node.input.extend([name])
-                        output_graph_def.node.extend([new_node])                        
-
-                elif n.op_type == "Pad":
-                        # Prepare attributes
-                        onnx_mode = "constant".encode('utf-8') # Ignored here since output shape is not affected by mode
-                        onnx_pads = [] # Onnx format: [x1_begin,x2_begin,...,x1_end,x2_end]
-                        onnx_value = 0.0 # Ignored as well
-                        input_name = n.input[0]
-                        tf_pads = []
-                        tf_mode = "CONSTANT"
-                        if n.name == "":
-                                output_name = n.output[0]
-                        else:
-                                output_name = n.name   
-                        for attr in n.attribute:
-                                if attr.name == "mode":
-                                        onnx_mode = attr.s
-                                elif attr.name == "pads":
-                                        for i in attr.ints:
-                                                onnx_pads.append(i)
-                                elif attr.name == "value":
-                                        onnx_value = attr.f
-                        rank = math.ceil(len(onnx_pads)/2) # Should be an int but just in case
-                        for i in range(rank):
-                                ith_pads = [onnx_pads[i],onnx_pads[i+rank]]
-                                tf_pads.append(ith_pads)
+                        # Use Identity op to maintain layer.name in graph_def
+                        connector = node_def_pb2.NodeDef()
+                        connector.op = "Identity"
+                        connector.name = original_name
+                        connector.attr["T"].type = 1
+                        connector.input.extend([tail_name])
+                        output_graph_def.node.extend([connector])
+                else:
+                        output_graph_def.node.extend([new_node])
+
+        elif n.op_type == "Mul":
+                # Generate node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Mul"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                for name in n.input:
+                        new_node.input.extend([name])
+                output_graph_def.node.extend([new_node])                        
+
+        elif n.op_type == "Pad":
+                # Prepare attributes
+                onnx_mode = "constant".encode('utf-8') # Ignored here since output shape is not affected by mode
+                onnx_pads = [] # Onnx format: [x1_begin,x2_begin,...,x1_end,x2_end]
+                onnx_value = 0.0 # Ignored as well
+                input_name = n.input[0]
+                tf_pads = []
+                tf_mode = "CONSTANT"
+                if n.name == "":
+                        output_name = n.output[0]
+                else:
+                        output_name = n.name   
+                for attr in n.attribute:
+                        if attr.name == "mode":
+                                onnx_mode = attr.s
+                        elif attr.name == "pads":
+                                for i in attr.ints:
+                                        onnx_pads.append(i)
+                        elif attr.name == "value":
+                                onnx_value = attr.f
+                rank = math.ceil(len(onnx_pads)/2) # Should be an int but just in case
+                for i in range(rank):
+                        ith_pads = [onnx_pads[i],onnx_pads[i+rank]]
+                        tf_pads.append(ith_pads)
                         
-                        # Reorder to NHWC for tf_pads, onnx_pads is NCHW
-                        if rank == 4:
-                                myorder = [0,2,3,1]
-                                tf_pads = [tf_pads[i] for i in myorder]
+                # Reorder to NHWC for tf_pads, onnx_pads is NCHW
+                if rank == 4:
+                        myorder = [0,2,3,1]
+                        tf_pads = [tf_pads[i] for i in myorder]
                         
-                        if onnx_mode == "reflect".encode('utf-8'):
-                                tf_mode = "REFLECT"
-
-                        # Generate layer
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")
-                                tensor = op[0].outputs[0]
-                                paddings = tf.constant(tf_pads, name=output_name+'/Const')
-                                tf.pad(tensor, paddings, tf_mode, name=output_name)
+                if onnx_mode == "reflect".encode('utf-8'):
+                        tf_mode = "REFLECT"
+
+                # Generate layer
+                def build(tensors):
+                        paddings = tf.constant(tf_pads, name=output_name+'/Const')
+                        tf.pad(tensors[0], paddings, tf_mode, name=output_name)
                         
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif n.op_type == "Relu":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Relu"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        new_node.input.extend([n.input[0]])
-                        output_graph_def.node.extend([new_node])
+                # Update output_graph_def
+                output_graph_def = emit_nodes(output_graph_def, [input_name], build, shapes, report, need_shapes=False)
 
-                elif n.op_type == "Reshape":
-                        # Prepare attributes
-                        is_reshape_1 = False
-                        if n.name == "":
-                                output_name = n.output[0]
-                        else:
-                                output_name = n.name
-                        input_name = n.input[0]
-                        if len(n.input) > 1: # Onnx.Reshape-5
-                                shape_name = n.input[1]
-                        else:
-                                print('Using a deprecated version of Reshape (Reshape-1) from ONNX operator set')
-                                for attr in n.attribute:
-                                        if attr.name == "shape":
-                                                output_shape = list(attr.ints)
-                                                is_reshape_1 = True
+        elif n.op_type == "Relu":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Relu"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                new_node.input.extend([n.input[0]])
+                output_graph_def.node.extend([new_node])
+
+        elif n.op_type == "Reshape":
+                # Prepare attributes
+                is_reshape_1 = False
+                if n.name == "":
+                        output_name = n.output[0]
+                else:
+                        output_name = n.name
+                input_name = n.input[0]
+                if len(n.input) > 1: # Onnx.Reshape-5
+                        shape_name = n.input[1]
+                else:
+                        print('Using a deprecated version of Reshape (Reshape-1) from ONNX operator set')
+                        for attr in n.attribute:
+                                if attr.name == "shape":
+                                        output_shape = list(attr.ints)
+                                        is_reshape_1 = True
                                                     
-                        # Generate layer     
-                        with tf.Graph().as_default() as curr_graph:
-                                if is_reshape_1 == False:
-                                        input_list = tf.import_graph_def(output_graph_def, return_elements=[input_name, shape_name], name="")
-                                        data_tensor = input_list[0].outputs[0]
-                                        shape_tensor = input_list[1].outputs[0]  
-                                elif is_reshape_1 == True:
-                                        data_tensor = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")[0].outputs[0]
-                                        shape_tensor = tf.constant(output_shape, name=output_name+'/Const')
-                                output_tensor = tf.reshape(data_tensor, shape_tensor, name=output_name) 
+                # Generate layer     
+                def build(tensors):
+                        data_tensor = tensors[0]
+                        if is_reshape_1 == False:
+                                shape_tensor = tensors[1]
+                        elif is_reshape_1 == True:
+                                shape_tensor = tf.constant(output_shape, name=output_name+'/Const')
+                        output_tensor = tf.reshape(data_tensor, shape_tensor, name=output_name) 
 
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif n.op_type == "Softmax":
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "Softmax"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        new_node.input.extend([n.input[0]])
-                        output_graph_def.node.extend([new_node])
+                # Update output_graph_def
+                if is_reshape_1 == False:
+                        output_graph_def = emit_nodes(output_graph_def, [input_name, shape_name], build, shapes, report, need_shapes=False)
+                else:
+                        output_graph_def = emit_nodes(output_graph_def, [input_name], build, shapes, report, need_shapes=False)
+
+        elif n.op_type == "Softmax":
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "Softmax"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                new_node.input.extend([n.input[0]])
+                output_graph_def.node.extend([new_node])
                 
-                elif n.op_type == "Sum":
-                        # Generate node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = "AddN"
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        num_inputs = len(n.input)
-                        new_node.attr["N"].i = num_inputs
-                        for name in n.input:
-                                new_node.input.extend([name])
-                        output_graph_def.node.extend([new_node])                
-
-                elif n.op_type == "Transpose":
-                        # Prepare attributes
-                        if n.name == "":
-                                output_name = n.output[0]
-                        else:
-                                output_name = n.name
-                        input_name = n.input[0]
-                        onnx_perm = list(n.attribute[0].ints) # indices are in NCHW, convert to NHWC
-                        tf_perm = []
-                        if len(onnx_perm) == 4:
-                              dim_map = {0: 0, 1: 3, 2: 1, 3: 2}  
-                              for d in onnx_perm:
-                                      tf_perm.append(dim_map[d])
-                        else:
-                                tf_perm = onnx_perm
+        elif n.op_type == "Sum":
+                # Generate node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = "AddN"
+                if n.name == "":
+                        new_node.name = n.output[0]
+                else:
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                num_inputs = len(n.input)
+                new_node.attr["N"].i = num_inputs
+                for name in n.input:
+                        new_node.input.extend([name])
+                output_graph_def.node.extend([new_node])                
+
+        elif n.op_type == "Transpose":
+                # Prepare attributes
+                if n.name == "":
+                        output_name = n.output[0]
+                else:
+                        output_name = n.name
+                input_name = n.input[0]
+                onnx_perm = list(n.attribute[0].ints) # indices are in NCHW, convert to NHWC
+                tf_perm = []
+                if len(onnx_perm) == 4:
+                      dim_map = {0: 0, 1: 3, 2: 1, 3: 2}  
+                      for d in onnx_perm:
+                              tf_perm.append(dim_map[d])
+                else:
+                        tf_perm = onnx_perm
                         
-                        # Generate layer     
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")
-                                tensor = op[0].outputs[0]        
-                                output_tensor = tf.transpose(tensor, perm=tf_perm, name=output_name) 
+                # Generate layer     
+                def build(tensors):
+                        output_tensor = tf.transpose(tensors[0], perm=tf_perm, name=output_name) 
 
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
-
-                elif n.op_type == "Upsample":
-                        # Generate layer 
-                        input_name = n.input[0]
-                        onnx_mode = "nearest".encode('utf-8')
-                        onnx_h_scale = 2.0
-                        onnx_w_scale = 2.0
-                        if n.name == "":
-                                output_name = n.output[0]
+                # Update output_graph_def
+                output_graph_def = emit_nodes(output_graph_def, [input_name], build, shapes, report, need_shapes=False)
+
+        elif n.op_type == "Upsample":
+                # Generate layer 
+                input_name = n.input[0]
+                onnx_mode = "nearest".encode('utf-8')
+                onnx_h_scale = 2.0
+                onnx_w_scale = 2.0
+                if n.name == "":
+                        output_name = n.output[0]
+                else:
+                        output_name = n.name                        
+                for attr in n.attribute:
+                        if attr.name == "height_scale":
+                                onnx_h_scale = attr.f
+                        elif attr.name == "mode":
+                                onnx_mode = attr.s
+                        elif attr.name == "width_scale":
+                                onnx_w_scale = attr.f
+
+                def build(tensors):
+                        tensor = tensors[0]
+                        tf_tensor_shape = tensor.shape.as_list()
+                        new_dims = [1,1]
+                        if len(tf_tensor_shape) == 4:
+                                new_dims[0] = tf_tensor_shape[1]*onnx_h_scale
+                                new_dims[1] = tf_tensor_shape[2]*onnx_w_scale
                         else:
-                                output_name = n.name                        
-                        for attr in n.attribute:
-                                if attr.name == "height_scale":
-                                        onnx_h_scale = attr.f
-                                elif attr.name == "mode":
-                                        onnx_mode = attr.s
-                                elif attr.name == "width_scale":
-                                        onnx_w_scale = attr.f
-
-                        with tf.Graph().as_default() as curr_graph:
-                                op = tf.import_graph_def(output_graph_def, return_elements=[input_name], name="")
-                                tensor = op[0].outputs[0]
-                                tf_tensor_shape = tensor.shape.as_list()
-                                new_dims = [1,1]
-                                if len(tf_tensor_shape) == 4:
-                                        new_dims[0] = tf_tensor_shape[1]*onnx_h_scale
-                                        new_dims[1] = tf_tensor_shape[2]*onnx_w_scale
-                                else:
-                                        print('weird input case for upsampling')
-                                if onnx_mode == "nearest".encode('utf-8'):
-                                        size_tensor = tf.constant([int(new_dims[0]), int(new_dims[1])], name=output_name+'/Const')
-                                        tf.image.resize_nearest_neighbor(tensor, size_tensor, name=output_name)
-                                else:
-                                        size_tensor = tf.constant([int(new_dims[0]), int(new_dims[1])], name=output_name+'/Const')
-                                        tf.image.resize_bilinear(tensor, size_tensor, name=output_name)
+                                print('weird input case for upsampling')
+                        if onnx_mode == "nearest".encode('utf-8'):
+                                size_tensor = tf.constant([int(new_dims[0]), int(new_dims[1])], name=output_name+'/Const')
+                                tf.image.resize_nearest_neighbor(tensor, size_tensor, name=output_name)
+                        else:
+                                size_tensor = tf.constant([int(new_dims[0]), int(new_dims[1])], name=output_name+'/Const')
+                                tf.image.resize_bilinear(tensor, size_tensor, name=output_name)
 
-                        # Update output_graph_def
-                        output_graph_def = curr_graph.as_graph_def()
+                # Update output_graph_def
+                output_graph_def = emit_nodes(output_graph_def, [input_name], build, shapes, report)
 
+        else:
+                # Generate main node
+                new_node = node_def_pb2.NodeDef()
+                new_node.op = 'Identity'
+                if n.name == "":
+                        new_node.name = n.output[0]
                 else:
-                        # Generate main node
-                        new_node = node_def_pb2.NodeDef()
-                        new_node.op = 'Identity'
-                        if n.name == "":
-                                new_node.name = n.output[0]
-                        else:
-                                new_node.name = n.name
-                        new_node.attr["T"].type = 1
-                        if len(n.input) > 0:
-                                new_node.input.extend([n.input[0]])
+                        new_node.name = n.name
+                new_node.attr["T"].type = 1
+                if len(n.input) > 0:
+                        new_node.input.extend([n.input[0]])
 
-                        # For user to keep track of unsuppported onnx ops
-                        if n.op_type != "Identity":
-                                unsupported_onnx_types.add(n.op_type)
-                        output_graph_def.node.extend([new_node])                        
+                # For user to keep track of unsuppported onnx ops
+                if n.op_type != "Identity":
+                        conversion_report.add_fallback(report, new_node.name, n.op_type)
+                output_graph_def.node.extend([new_node])                        
 
         return output_graph_def
 
+def gen_initial_graphdef(graph, report=None, options=None, shapes=None, progress=None, store=None):
+        if report is None:
+                report = conversion_report.new_report('onnx')
+        if options is None:
+                options = {}
+        report['tf_imports'] = {'avoided': 0, 'performed': 0}
+        with_weights = options.get('weights', False)
+        name_to_graph_input, name_to_tensor, placeholders, tensors = extract_summary(graph)
+        output_graph_def = graph_pb2.GraphDef()
+        create_constants(output_graph_def, name_to_graph_input, name_to_tensor, placeholders, tensors, with_weights, store)
+
+        for node_index, n in enumerate(graph.node):
+                if progress is not None:
+                        progress.update(node_index, n.op_type, n.name or n.output[0], output_graph_def)
+                output_graph_def = convert_node(n, output_graph_def, report, shapes, name_to_tensor, with_weights, store)
+
+        return output_graph_def
+
+def build_onnx_graph(model_data, report, options=None, store=None):
+        # Converts serialized ModelProto bytes to a GraphDef. With a
+        # const_spill.ConstSpillStore, model_data is an mmap and large
+        # payloads are spilled to the store.
+        if options is None:
+                options = {}
+        with conversion_report.timed(report, 'parse'):
+                if store is not None:
+                        model_data = strip_initializer_payloads(model_data, store)
+                onnx_model = onnx.load_model_from_string(model_data)
+        graph = onnx_model.graph
+        with conversion_report.timed(report, 'shapes'):
+                # On the whole model, cut points take their shapes from it
+                inferred = infer_model_shapes(onnx_model)
+        if options.get('outputs'):
+                with conversion_report.timed(report, 'extract'):
+                        graph = extract_subgraph(graph, options['outputs'].split(','), (options.get('inputs') or '').split(','), inferred.value_info)
+        conversion_report.count_source_ops(report, [n.op_type for n in graph.node])
+        with conversion_report.timed(report, 'shapes'):
+                shapes = onnx_shape_index(onnx_model, graph, inferred)
+
+        # Generate tf GraphDef
+        with conversion_report.timed(report, 'convert'):
+                progress = conversion_progress.from_options('onnx', len(graph.node), options)
+                try:
+                        # A fresh default graph per conversion, ops of earlier
+                        # conversions in the process (--watch, warm workers)
+                        # would slow the imports down
+                        with tf.Graph().as_default(), tf.Session() as sess:
+                                out_graph = gen_initial_graphdef(graph, report, options, shapes, progress, store)
+                except BaseException as e:
+                        if progress is not None:
+                                progress.fail(e)
+                        raise
+                if progress is not None:
+                        progress.finish(len(graph.node), out_graph)
+        if options.get('dedup'):
+                with conversion_report.timed(report, 'dedup'):
+                        removed, saved = graph_passes.dedup_constants(out_graph, store)
+                report['dedup'] = {'removed_nodes': removed, 'bytes_saved': saved}
+        if options.get('weight_dtype', 'fp32') != 'fp32':
+                with conversion_report.timed(report, 'weight_dtype'):
+                        reduced, bytes_before, bytes_after = graph_passes.reduce_weight_precision(out_graph, options['weight_dtype'], store=store)
+                report['weight_dtype'] = {'dtype': options['weight_dtype'], 'tensors': reduced, 'bytes_before': bytes_before, 'bytes_after': bytes_after}
+        if options.get('scopes'):
+                with conversion_report.timed(report, 'scopes'):
+                        before, after = graph_passes.assign_name_scopes(out_graph)
+                report['scopes'] = {'top_level_before': before, 'top_level_after': after}
+        return out_graph
+
+def convert_onnx_data(model_data, report, options=None):
+        # Converts serialized ModelProto bytes to serialized GraphDef bytes
+        out_graph = build_onnx_graph(model_data, report, options)
+        with conversion_report.timed(report, 'serialize'):
+                data = out_graph.SerializeToString()
+        conversion_report.finalize(report, out_graph, len(data))
+        return data
+
+def write_event_file(report, graph_bytes, logdir):
+        # TensorBoard graph view without a separate summary step
+        with conversion_report.timed(report, 'events'):
+                report['event_file'] = tb_event_writer.write_graph_event(graph_bytes, logdir)
+
+def convert_onnx_streamed(model_path, output_path, report, options):
+        # --max-memory: the model is memory-mapped, large payloads spill to a
+        # file next to the output and the GraphDef is streamed to disk
+        if options.get('shard_size'):
+                raise ValueError('--max-memory streams the payloads into one .pb, it cannot be combined with --shard-size')
+        spill_dir = options.get('spill_dir') or os.path.dirname(os.path.abspath(output_path))
+        store = const_spill.ConstSpillStore(int(options['max_memory'] * 2**20), spill_dir)
+        try:
+                with conversion_report.timed(report, 'read'):
+                        model_data = compressed_io.map_file(model_path, spill_dir)
+                out_graph = build_onnx_graph(model_data, report, options, store)
+                with conversion_report.timed(report, 'write'):
+                        with compressed_io.open_write(output_path) as stream:
+                                graph_bytes = store.write_graph_def(out_graph, stream)
+                conversion_report.finalize(report, out_graph, graph_bytes)
+                if compressed_io.codec_of_path(output_path) is not None:
+                        report['compressed_bytes'] = os.path.getsize(output_path)
+                if options.get('logdir'):
+                        # Spilled Consts go to the event file without their payloads
+                        write_event_file(report, out_graph.SerializeToString(), options['logdir'])
+                report['memory'] = store.summary()
+        finally:
+                store.close()
+        return report
+
+def convert_onnx(model_path, output_path, options=None):
+        report = conversion_report.new_report('onnx', model_path, output_path)
+        if options is not None and options.get('max_memory'):
+                return convert_onnx_streamed(model_path, output_path, report, options)
+        with conversion_report.timed(report, 'read'):
+                model_data = compressed_io.read_file(model_path)
+        if options is not None and options.get('shard_size'):
+                # Large Const payloads go to sidecar shards to stay under the 2 GB protobuf limit
+                if compressed_io.codec_of_path(output_path) is not None:
+                        raise ValueError('Shards are memory-mapped and cannot be compressed, write %s instead' % compressed_io.strip_codec(output_path))
+                out_graph = build_onnx_graph(model_data, report, options)
+                with conversion_report.timed(report, 'write'):
+                        total_bytes = sharded_graphdef.write_sharded(out_graph, output_path, int(options['shard_size'] * 2**20))
+                conversion_report.finalize(report, out_graph, total_bytes)
+                if options.get('logdir'):
+                        write_event_file(report, out_graph.SerializeToString(), options['logdir'])
+                return report
+        data = convert_onnx_data(model_data, report, options)
+        with conversion_report.timed(report, 'write'):
+                file_bytes = compressed_io.write_file(output_path, data)
+        if compressed_io.codec_of_path(output_path) is not None:
+                report['compressed_bytes'] = file_bytes
+        if options is not None and options.get('logdir'):
+                write_event_file(report, data, options['logdir'])
+        return report
+
 ## -------------------------------- MAIN ---------------------------------- ##
-parser = argparse.ArgumentParser(description='Converts an Onnx model to a TensorFlow model')
-parser.add_argument('-m', '--model', required=True, help='Target Onnx model file. e.g. model.onnx')
-parser.add_argument('-o', '--output', default='converted_onnx_model.pb', help='Name of output TensorFlow model. Default is converted_onnx_model.pb.')
-args = parser.parse_args()
-
-print('[i] Input model:  ', args.model)
-print('[i] Output: ', args.output)
-
-# Load ONNX model
-onnx_model = onnx.load(args.model)
-
-# Generate tf GraphDef, serialize, and write into protobuf
-with tf.Session() as sess:
-        out_graph = gen_initial_graphdef(onnx_model.graph)
-with open(args.output, "wb") as f:
-        f.write(out_graph.SerializeToString())
-if len(unsupported_onnx_types) == 0:
-        print('All Onnx layer types in this prototxt are supported')
-else:
-        print('Unsupported Onnx ops: ', unsupported_onnx_types)
-f.close()
+def main(args):
+        parser = argparse.ArgumentParser(description='Converts an Onnx model to a TensorFlow model')
+        parser.add_argument('-m', '--model', required=True, help='Target Onnx model file, optionally gzip/zstd compressed. e.g. model.onnx, model.onnx.gz')
+        parser.add_argument('-o', '--output', default='converted_onnx_model.pb', help='Name of output TensorFlow model, compressed when it ends in .gz or .zst. Default is converted_onnx_model.pb.')
+        parser.add_argument('--weights', action='store_true', help='Carry initializer values into the Const nodes.')
+        parser.add_argument('--dedup', action='store_true', help='Merge Const nodes with identical contents.')
+        parser.add_argument('--weight-dtype', choices=graph_passes.WEIGHT_DTYPES, default='fp32', help='Store float32 Const payloads as fp16 or per-channel int8, read back through Cast (and Mul) nodes. Default is fp32.')
+        parser.add_argument('--scopes', action='store_true', help='Nest nodes into name scopes inferred from layer names and topology, for TensorBoard.')
+        parser.add_argument('--outputs', help='Comma separated node outputs to keep. Only the nodes they depend on are converted.')
+        parser.add_argument('--inputs', help='Comma separated tensors to cut at, used with --outputs. They become Placeholders, shaped by ONNX shape inference on the whole model.')
+        parser.add_argument('--shard-size', type=float, help='Write large Const payloads to sidecar shard files of about this many MB, with the structure in the .pb.')
+        parser.add_argument('--max-memory', type=float, help='Peak memory budget in MB. Large Const payloads spill to a memory-mapped file while the graph is built and are streamed into the output. Use with --weights.')
+        parser.add_argument('--spill-dir', help='Directory for the --max-memory spill file. Default is the output directory.')
+        parser.add_argument('--logdir', help='Also write a TensorBoard event file with the graph to this directory.')
+        parser.add_argument('--no-progress', action='store_true', help='Do not draw the progress bar. It is drawn only when stderr is a terminal.')
+        parser.add_argument('--progress-json', help='Append progress events as JSON lines to this file or named pipe.')
+        parser.add_argument('--watch', action='store_true', help='Keep running and convert again each time the model is saved.')
+        args = parser.parse_args(args)
+
+        print('[i] Input model:  ', args.model)
+        print('[i] Output: ', args.output)
+
+        options = vars(args)
+        options['progress'] = not args.no_progress and sys.stderr.isatty()
+        if args.watch:
+                def convert():
+                        report = convert_onnx(args.model, args.output, options)
+                        print_summary(report)
+                        return report
+                model_watch.watch(args.model, convert)
+                return
+        print_summary(convert_onnx(args.model, args.output, options))
+
+def print_summary(report):
+        if 'dedup' in report:
+                print('[i] Deduplicated %d Const nodes, saved %d bytes' % (report['dedup']['removed_nodes'], report['dedup']['bytes_saved']))
+        if 'weight_dtype' in report:
+                w = report['weight_dtype']
+                print('[i] Weights stored as %s: %d tensors, %d -> %d bytes (%.1fx smaller)' % (w['dtype'], w['tensors'], w['bytes_before'], w['bytes_after'], w['bytes_before'] / float(max(w['bytes_after'], 1))))
+        if 'scopes' in report:
+                print('[i] Top-level names: %d -> %d' % (report['scopes']['top_level_before'], report['scopes']['top_level_after']))
+        print('[i] Shape queries answered without a TF import: %d of %d' % (report['tf_imports']['avoided'], report['tf_imports']['avoided'] + report['tf_imports']['performed']))
+        if 'memory' in report:
+                m = report['memory']
+                print('[i] Spilled %d Const payloads (%.1f MB, %.1f MB on disk), peak RSS %.0f MB of %.0f MB' % (m['spilled_tensors'], m['spilled_bytes'] / 2.0**20, m['spill_file_bytes'] / 2.0**20, (m['peak_rss_bytes'] or 0) / 2.0**20, m['budget_bytes'] / 2.0**20))
+                if m['peak_rss_bytes'] is not None and m['peak_rss_bytes'] > m['budget_bytes']:
+                        print('[!] Peak RSS is over --max-memory, TensorFlow and the graph structure alone need more')
+        if 'compressed_bytes' in report:
+                print('[i] Compressed output: %d -> %d bytes' % (report['output_bytes'], report['compressed_bytes']))
+        if 'event_file' in report:
+                print('[i] Event file: ', report['event_file'])
+        print('[i] Report: ', conversion_report.write_report(report))
+        if len(report['unsupported_types']) == 0:
+                print('All Onnx layer types in this prototxt are supported')
+        else:
+                print('Unsupported Onnx ops: ', set(report['unsupported_types']))
+
+if __name__=='__main__':
+        main(sys.argv[1:])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Numerical parity harness: converts ONNX models with onnx2tf, runs the
+# converted graph and the ONNX reference evaluator on CPU with the same random
+# input, and compares activations node by node.
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+
+def nchw_to_nhwc(array):
+    if array.ndim == 4:
+        return np.transpose(array, (0, 2, 3, 1))
+    return array
+
+
+def onnx_to_tf_weight(array):
+    # Matches the OIHW -> HWIO ordering used by onnx2tf.create_constants
+    if array.ndim == 4:
+        return np.transpose(array, (2, 3, 1, 0))
+    return array
+
+
+def tf_node_name(node):
+    if node.name == "":
+        return node.output[0]
+    return node.name
+
+
+def random_inputs(graph, rng):
+    initializers = set(t.name for t in graph.initializer)
+    feeds = {}
+    for value_info in graph.input:
+        if value_info.name in initializers:
+            continue
+        # Symbolic dims (e.g. batch) are fed as 1
+        dims = [max(d.dim_value, 1) for d in value_info.type.tensor_type.shape.dim]
+        feeds[value_info.name] = rng.standard_normal(dims).astype(np.float32)
+    return feeds
+
+
+def weight_feeds(graph, graph_def):
+    # The converters only emit Const shapes, so the source weights are fed into
+    # the Const outputs of the converted graph instead.
+    from onnx import numpy_helper
+
+    weights = dict((t.name, numpy_helper.to_array(t)) for t in graph.initializer)
+    const_names = set(n.name for n in graph_def.node if n.op == 'Const')
+    feeds = {}
+    for name, array in weights.items():
+        if name in const_names:
+            feeds[name + ':0'] = onnx_to_tf_weight(array)
+    for n in graph.node:
+        if n.op_type == "Conv" and n.input[1] in weights:
+            kernel_name = tf_node_name(n) + '/kernel'
+            if kernel_name in const_names:
+                feeds[kernel_name + ':0'] = onnx_to_tf_weight(weights[n.input[1]])
+    return feeds
+
+
+def run_tf(graph_def, feeds, fetches):
+    import tensorflow as tf
+
+    values = {}
+    errors = {}
+    config = tf.ConfigProto(device_count={'GPU': 0})
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        with tf.Session(graph=graph, config=config) as sess:
+            try:
+                results = sess.run(fetches, feed_dict=feeds)
+                values = dict(zip(fetches, results))
+            except tf.errors.OpError:
+                # Isolate the failing nodes
+                for fetch in fetches:
+                    try:
+                        values[fetch] = sess.run(fetch, feed_dict=feeds)
+                    except tf.errors.OpError as e:
+                        errors[fetch] = e.message.split('\n')[0]
+    return values, errors
+
+
+def check_model(job):
+    model_path, seed, rtol, atol = job
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import onnx
+    import tensorflow as tf
+    from onnx.reference import ReferenceEvaluator
+
+    import onnx2tf
+
+    result = {'model': model_path, 'compared': 0, 'mismatches': [], 'errors': []}
+    model = onnx.load(model_path)
+    with tf.Graph().as_default():
+        graph_def = onnx2tf.gen_initial_graphdef(model.graph)
+
+    rng = np.random.default_rng(seed)
+    inputs = random_inputs(model.graph, rng)
+    tf_names = set(n.name for n in graph_def.node)
+    pairs = []
+    for n in model.graph.node:
+        name = tf_node_name(n)
+        if name in tf_names and n.op_type != "Constant":
+            pairs.append((n.output[0], name + ':0', n.op_type))
+
+    try:
+        onnx_values = ReferenceEvaluator(model).run([p[0] for p in pairs], inputs)
+    except Exception as e:
+        result['errors'].append(('<onnx reference>', str(e).split('\n')[0]))
+        return result
+
+    feeds = weight_feeds(model.graph, graph_def)
+    for name, array in inputs.items():
+        feeds[name + ':0'] = nchw_to_nhwc(array)
+    tf_values, tf_errors = run_tf(graph_def, feeds, [p[1] for p in pairs])
+
+    for (onnx_name, tf_name, op_type), expected in zip(pairs, onnx_values):
+        if tf_name in tf_errors:
+            result['errors'].append((tf_name, tf_errors[tf_name]))
+            continue
+        expected = nchw_to_nhwc(np.asarray(expected))
+        actual = np.asarray(tf_values[tf_name])
+        result['compared'] += 1
+        if expected.shape != actual.shape:
+            result['mismatches'].append((tf_name, op_type, 'shape %s != onnx %s' % (list(actual.shape), list(expected.shape))))
+        elif not np.allclose(actual, expected, rtol=rtol, atol=atol):
+            max_err = float(np.max(np.abs(actual.astype(np.float64) - expected)))
+            result['mismatches'].append((tf_name, op_type, 'max abs err %.3g' % max_err))
+    return result
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Compares converted TensorFlow graphs with their ONNX source on CPU.')
+    parser.add_argument('-m', '--model', required=True, nargs='+', help='One or more Onnx model files')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='Models checked in parallel. Default is one per CPU.')
+    parser.add_argument('--seed', type=int, default=0, help='Random input seed. Default is 0.')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='Relative tolerance. Default is 1e-3.')
+    parser.add_argument('--atol', type=float, default=1e-4, help='Absolute tolerance. Default is 1e-4.')
+    parser.add_argument('--max-report', type=int, default=10, help='Mismatches printed per model. Default is 10.')
+    args = parser.parse_args(args)
+
+    jobs = [(m, args.seed, args.rtol, args.atol) for m in args.model]
+    num_procs = args.jobs or min(len(jobs), multiprocessing.cpu_count())
+    # spawn keeps TensorFlow out of the parent and gives each model a clean process
+    with multiprocessing.get_context('spawn').Pool(num_procs) as pool:
+        results = pool.map(check_model, jobs)
+
+    failed = 0
+    for result in results:
+        print('[i] Model: ', result['model'])
+        print('    compared %d nodes, %d mismatches, %d errors' % (result['compared'], len(result['mismatches']), len(result['errors'])))
+        for name, op_type, message in result['mismatches'][:args.max_report]:
+            print('    %s (%s): %s' % (name, op_type, message))
+        for name, message in result['errors'][:args.max_report]:
+            print('    %s: error: %s' % (name, message))
+        if len(result['mismatches']) > 0 or len(result['errors']) > 0:
+            failed += 1
+    return 1 if failed > 0 else 0
+
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Sharded GraphDef output for graphs whose Const payloads would push the
+# serialized GraphDef past the 2 GB protobuf limit.
+#
+#   model.pb             graph structure, large Consts without tensor_content
+#   model.pb.shard00000  raw tensor payloads, concatenated and 64-byte aligned
+#   model.pb.index.json  node name -> (shard, offset, length, dtype, shape, sha1)
+#
+# The structure loads like any small .pb. Payloads are memory-mapped and only
+# paged in when a tensor is read.
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+
+import numpy as np
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# TensorFlow DataType enum -> numpy dtype (tensor_content is little endian)
+TF_DTYPE_TO_NUMPY = {
+    1: '<f4',  # float
+    2: '<f8',  # double
+    3: '<i4',  # int32
+    4: 'u1',   # uint8
+    5: '<i2',  # int16
+    6: 'i1',   # int8
+    9: '<i8',  # int64
+    10: '?',   # bool
+    17: '<u2', # uint16
+    19: '<f2', # half
+    22: '<u4', # uint32
+    23: '<u8', # uint64
+}
+
+
+def index_path(output_path):
+    return output_path + '.index.json'
+
+
+def write_sharded(graph_def, output_path, shard_bytes=1 << 30, min_const_bytes=64 * 1024):
+    # Moves Const payloads of at least min_const_bytes out of graph_def into
+    # shard files of about shard_bytes each. graph_def is modified in place.
+    # Returns the total number of bytes written.
+    index = {'format': FORMAT_VERSION, 'graph': os.path.basename(output_path), 'shards': [], 'tensors': {}}
+    shard = None
+    offset = 0
+    total_bytes = 0
+    try:
+        for node in graph_def.node:
+            if node.op != 'Const':
+                continue
+            tensor = node.attr['value'].tensor
+            content = tensor.tensor_content
+            if len(content) < min_const_bytes:
+                continue
+            if shard is None or (offset > 0 and offset + len(content) > shard_bytes):
+                if shard is not None:
+                    shard.close()
+                shard_name = '%s.shard%05d' % (os.path.basename(output_path), len(index['shards']))
+                shard = open(os.path.join(os.path.dirname(output_path), shard_name), 'wb')
+                index['shards'].append(shard_name)
+                offset = 0
+            padding = -offset % ALIGNMENT
+            shard.write(b'\0' * padding)
+            offset += padding
+            shard.write(content)
+            index['tensors'][node.name] = {
+                'shard': len(index['shards']) - 1,
+                'offset': offset,
+                'length': len(content),
+                'dtype': TF_DTYPE_TO_NUMPY.get(tensor.dtype, 'u1'),
+                'shape': [d.size for d in tensor.tensor_shape.dim],
+                'sha1': hashlib.sha1(content).hexdigest(),
+            }
+            offset += len(content)
+            total_bytes += padding + len(content)
+            tensor.ClearField('tensor_content')
+    finally:
+        if shard is not None:
+            shard.close()
+
+    data = graph_def.SerializeToString()
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    with open(index_path(output_path), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    return total_bytes + len(data)
+
+
+class ShardedGraphReader(object):
+    def __init__(self, path):
+        self.path = path
+        with open(index_path(path)) as f:
+            self.index = json.load(f)
+        if self.index.get('format') != FORMAT_VERSION:
+            raise ValueError('Unsupported sharded GraphDef format in %s' % index_path(path))
+        self.tensors = self.index['tensors']
+        self._maps = {}
+
+    def _shard(self, i):
+        if i not in self._maps:
+            shard_path = os.path.join(os.path.dirname(self.path), self.index['shards'][i])
+            with open(shard_path, 'rb') as f:
+                self._maps[i] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[i]
+
+    def tensor_bytes(self, name):
+        entry = self.tensors[name]
+        return memoryview(self._shard(entry['shard']))[entry['offset']:entry['offset'] + entry['length']]
+
+    def tensor(self, name):
+        # Zero-copy view backed by the mapped shard
+        entry = self.tensors[name]
+        return np.frombuffer(self.tensor_bytes(name), dtype=entry['dtype']).reshape(entry['shape'])
+
+    def structure_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def load_graph_def(self, materialize=False):
+        # materialize=True restores every payload, only possible below 2 GB
+        from tensorflow.core.framework import graph_pb2
+
+        graph_def = graph_pb2.GraphDef()
+        graph_def.ParseFromString(self.structure_bytes())
+        if materialize:
+            self.materialize(graph_def)
+        return graph_def
+
+    def materialize(self, graph_def):
+        for node in graph_def.node:
+            if node.name in self.tensors:
+                node.attr['value'].tensor.tensor_content = bytes(self.tensor_bytes(node.name))
+        return graph_def
+
+    def check(self):
+        # Returns the names of tensors whose payload no longer matches the index
+        bad = []
+        for name, entry in self.tensors.items():
+            try:
+                data = self.tensor_bytes(name)
+            except (OSError, ValueError):
+                # Missing shard, or an empty one (which cannot be mapped)
+                bad.append(name)
+                continue
+            # A truncated shard yields a short slice
+            if len(data) != entry['length'] or hashlib.sha1(data).hexdigest() != entry['sha1']:
+                bad.append(name)
+        return bad
+
+    def close(self):
+        for m in self._maps.values():
+            try:
+                m.close()
+            except BufferError:
+                # A tensor() view is still alive, the map goes with it
+                pass
+        self._maps = {}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Inspects and checks a sharded GraphDef written with --shard-size.')
+    parser.add_argument('-i', '--input', required=True, help='Structure .pb of the sharded GraphDef')
+    parser.add_argument('--check', action='store_true', help='Verify every payload against its recorded sha1')
+    args = parser.parse_args(args)
+
+    reader = ShardedGraphReader(args.input)
+    payload_bytes = sum(e['length'] for e in reader.tensors.values())
+    print('[i] Structure: ', args.input, '(%d bytes)' % os.path.getsize(args.input))
+    print('[i] Shards: %d, sharded tensors: %d, payload bytes: %d' % (len(reader.index['shards']), len(reader.tensors), payload_bytes))
+    if args.check:
+        bad = reader.check()
+        if len(bad) > 0:
+            print('Corrupt tensors (%d): %s' % (len(bad), ', '.join(bad)))
+            return 1
+        print('[i] All payloads match')
+    return 0
+
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# Writes a TensorBoard events.out.tfevents file holding a GraphDef, without
+# importing TensorFlow. Records use TFRecord framing:
+#   uint64 length | masked crc32c(length) | data | masked crc32c(data)
+
+import argparse
+import itertools
+import os
+import socket
+import struct
+import sys
+import time
+
+try:
+    # Optional C implementation, much faster for large graphs
+    from crc32c import crc32c as _crc32c_native
+except ImportError:
+    _crc32c_native = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x82F63B78
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+# Numbers the event files of this process, like TensorFlow's file writers
+_file_counter = itertools.count()
+
+
+# Without the C implementation, payloads of at least _LANES * _MIN_LANE_BYTES
+# are cut into _LANES equal lanes whose CRCs numpy advances side by side, one
+# byte per step, then folded together. A byte at a time in Python runs at about
+# 5 MB/s, this at about 60 MB/s.
+_LANES = 4096
+_MIN_LANE_BYTES = 64
+
+
+def _gf2_times(matrix, vector):
+    # matrix is a list of 32 columns over GF(2)
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+
+def _zeros_operator(length):
+    # Matrix that advances a CRC register over length zero bytes, by squaring
+    # the one-bit operator as in zlib's crc32_combine
+    bit = [0x82F63B78] + [1 << i for i in range(31)]
+    for _ in range(3):
+        bit = [_gf2_times(bit, column) for column in bit]
+    result = [1 << i for i in range(32)]
+    while length:
+        if length & 1:
+            result = [_gf2_times(bit, column) for column in result]
+        length >>= 1
+        if length:
+            bit = [_gf2_times(bit, column) for column in bit]
+    return result
+
+
+def _crc32c_update(crc, data):
+    table = _CRC32C_TABLE
+    for b in data:
+        crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+def _crc32c_lanes(crc, data):
+    # CRC is linear: the register after lane i is the register after lane i-1
+    # advanced over len(lane) zero bytes, xor lane i's own register from zero
+    lane_bytes = len(data) // _LANES
+    lanes = np.frombuffer(data, dtype=np.uint8, count=lane_bytes * _LANES).reshape(_LANES, lane_bytes)
+    table = np.array(_CRC32C_TABLE, dtype=np.uint32)
+    registers = np.zeros(_LANES, dtype=np.uint32)
+    registers[0] = crc
+    for column in np.ascontiguousarray(lanes.T):
+        registers = table[(registers ^ column) & 0xFF] ^ (registers >> 8)
+    advance = _zeros_operator(lane_bytes)
+    crc = 0
+    for register in registers.tolist():
+        crc = _gf2_times(advance, crc) ^ register
+    return _crc32c_update(crc, data[lane_bytes * _LANES:])
+
+
+def crc32c(data):
+    if _crc32c_native is not None:
+        return _crc32c_native(data)
+    data = memoryview(data).cast('B')
+    if np is not None and len(data) >= _LANES * _MIN_LANE_BYTES:
+        return _crc32c_lanes(0xFFFFFFFF, data) ^ 0xFFFFFFFF
+    return _crc32c_update(0xFFFFFFFF, data) ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+    crc = crc32c(data)
+    return ((((crc >> 15) | (crc << 17)) & 0xFFFFFFFF) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def encode_record(data):
+    header = struct.pack('<Q', len(data))
+    return header + struct.pack('<I', masked_crc32c(header)) + data + struct.pack('<I', masked_crc32c(data))
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        b = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def encode_event(wall_time, step=0, file_version=None, graph_def=None):
+    # tensorflow.Event: wall_time = 1 (double), step = 2 (int64),
+    # file_version = 3 (string), graph_def = 4 (serialized GraphDef bytes)
+    event = b'\x09' + struct.pack('<d', wall_time) + b'\x10' + _varint(step)
+    if file_version is not None:
+        version = file_version.encode('utf-8')
+        event += b'\x1a' + _varint(len(version)) + version
+    if graph_def is not None:
+        event += b'\x22' + _varint(len(graph_def)) + graph_def
+    return event
+
+
+def _create_event_file(logdir, now):
+    # Writers in other processes, threads or conversions within the same
+    # second get their own file: the name carries the pid and a counter, and
+    # O_EXCL never opens a file that exists already
+    while True:
+        path = os.path.join(logdir, 'events.out.tfevents.%d.%s.%d.%d' % (int(now), socket.gethostname(), os.getpid(), next(_file_counter)))
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        except FileExistsError:
+            continue
+        return path, os.fdopen(fd, 'wb')
+
+
+def write_graph_event(graph_bytes, logdir):
+    # Returns the path of the written event file
+    os.makedirs(logdir, exist_ok=True)
+    now = time.time()
+    path, f = _create_event_file(logdir, now)
+    with f:
+        f.write(encode_record(encode_event(now, file_version='brain.Event:2')))
+        f.write(encode_record(encode_event(now, graph_def=graph_bytes)))
+    return path
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Writes a TensorBoard event file for a GraphDef without TensorFlow.')
+    parser.add_argument('-g', '--graph', required=True, help='Converted .pb file')
+    parser.add_argument('-l', '--logdir', required=True, help='TensorBoard log directory')
+    args = parser.parse_args(args)
+
+    with open(args.graph, 'rb') as f:
+        graph_bytes = f.read()
+    print('[i] Event file: ', write_graph_event(graph_bytes, args.logdir))
+
+
+if __name__=='__main__':
+    main(sys.argv[1:])
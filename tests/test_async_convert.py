@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# ConversionPool with a stand-in frontend, so the tests need neither
+# TensorFlow nor models. Workers are spawned and import this module by name.
+
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_convert
+
+
+def sleepy_convert_data(model_data, report, options):
+    # Records when it ran and in which process, then sleeps
+    report['pid'] = os.getpid()
+    report['start'] = time.time()
+    if options.get('pid_file'):
+        with open(options['pid_file'], 'w') as f:
+            f.write(str(os.getpid()))
+    if options.get('ignore_sigterm'):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(options['seconds'])
+    report['end'] = time.time()
+    return b'converted ' + model_data
+
+
+async_convert.FRONTENDS['sleepy'] = (__name__, 'sleepy_convert_data')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def _wait_for_file(path, timeout=30.0):
+    deadline = time.time() + timeout
+    while not os.path.exists(path) or os.path.getsize(path) == 0:
+        if time.time() > deadline:
+            raise AssertionError('%s was not written' % path)
+        time.sleep(0.05)
+    with open(path) as f:
+        return int(f.read())
+
+
+class ConversionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.model = os.path.join(self.tmp.name, 'model.onnx')
+        with open(self.model, 'wb') as f:
+            f.write(b'model')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_concurrency_limit(self):
+        pool = async_convert.ConversionPool(max_concurrent=2)
+
+        async def run():
+            outputs = [os.path.join(self.tmp.name, 'out%d.pb' % i) for i in range(5)]
+            return await asyncio.gather(*[pool.convert('sleepy', self.model, out, options={'seconds': 0.5}) for out in outputs])
+
+        try:
+            reports = asyncio.run(run())
+        finally:
+            pool.close()
+        events = sorted([(r['start'], 1) for r in reports] + [(r['end'], -1) for r in reports])
+        running = 0
+        most = 0
+        for _, step in events:
+            running += step
+            most = max(most, running)
+        self.assertEqual(most, 2)
+        # Two warm workers served all five conversions
+        self.assertEqual(len(set(r['pid'] for r in reports)), 2)
+        with open(os.path.join(self.tmp.name, 'out4.pb'), 'rb') as f:
+            self.assertEqual(f.read(), b'converted model')
+
+    def test_pool_reused_across_event_loops(self):
+        # Like the default pool of get_pool(), used by two asyncio.run() calls
+        pool = async_convert.ConversionPool(max_concurrent=1)
+
+        async def run(name):
+            outputs = [os.path.join(self.tmp.name, '%s%d.pb' % (name, i)) for i in range(3)]
+            return await asyncio.gather(*[pool.convert('sleepy', self.model, out, options={'seconds': 0.1}) for out in outputs])
+
+        try:
+            first = asyncio.run(run('first'))
+            second = asyncio.run(run('second'))
+        finally:
+            pool.close()
+        # The warm worker of the first loop served the second
+        self.assertEqual(set(r['pid'] for r in first + second), set([first[0]['pid']]))
+
+    def _cancel_frees_slot(self, options):
+        pool = async_convert.ConversionPool(max_concurrent=1)
+        pid_file = os.path.join(self.tmp.name, 'pid')
+        options = dict(options, seconds=60, pid_file=pid_file)
+
+        async def run():
+            task = asyncio.ensure_future(pool.convert('sleepy', self.model, os.path.join(self.tmp.name, 'slow.pb'), options=options))
+            pid = await asyncio.get_running_loop().run_in_executor(None, _wait_for_file, pid_file)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            alive = _pid_alive(pid)
+            # The only slot is free again
+            start = time.time()
+            report = await pool.convert('sleepy', self.model, os.path.join(self.tmp.name, 'fast.pb'), timeout=30, options={'seconds': 0})
+            return alive, report, time.time() - start
+
+        try:
+            alive, report, seconds = asyncio.run(run())
+        finally:
+            pool.close()
+        self.assertFalse(alive)
+        self.assertIn('end', report)
+        return seconds
+
+    def test_cancel_kills_worker(self):
+        self._cancel_frees_slot({})
+
+    def test_cancel_kills_worker_ignoring_sigterm(self):
+        kill_timeout = async_convert.KILL_TIMEOUT
+        async_convert.KILL_TIMEOUT = 0.5
+        try:
+            self._cancel_frees_slot({'ignore_sigterm': True})
+        finally:
+            async_convert.KILL_TIMEOUT = kill_timeout
+
+    def test_timeout_kills_worker(self):
+        pool = async_convert.ConversionPool(max_concurrent=1)
+        pid_file = os.path.join(self.tmp.name, 'pid')
+
+        async def run():
+            with self.assertRaises(asyncio.TimeoutError):
+                await pool.convert('sleepy', self.model, os.path.join(self.tmp.name, 'slow.pb'), timeout=3, options={'seconds': 60, 'pid_file': pid_file})
+
+        try:
+            asyncio.run(run())
+        finally:
+            pool.close()
+        self.assertFalse(_pid_alive(_wait_for_file(pid_file)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# ConstSpillStore: the GraphDef streamed by write_graph_def must parse to the
+# graph held in memory, and identical payloads share one spill entry. Then the
+# same through onnx2tf --max-memory on a small ONNX model.
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import const_spill
+
+try:
+    from tensorflow.core.framework import graph_pb2
+except ImportError:
+    graph_pb2 = None
+
+try:
+    import onnx
+    from onnx import helper, numpy_helper
+    import tensorflow as tf
+    import onnx2tf
+except ImportError:
+    onnx2tf = None
+
+# TensorFlow DataType enum
+DT_FLOAT = 1
+DT_INT32 = 3
+
+
+def _const(graph_def, name, array, dtype):
+    node = graph_def.node.add()
+    node.name = name
+    node.op = 'Const'
+    node.device = '/cpu:0'
+    node.attr['dtype'].type = dtype
+    tensor = node.attr['value'].tensor
+    tensor.dtype = dtype
+    for size in array.shape:
+        tensor.tensor_shape.dim.add().size = size
+    tensor.tensor_content = array.tobytes()
+    return node
+
+
+def _graph_def():
+    rng = np.random.RandomState(0)
+    weights = rng.randn(64, 16, 5, 5).astype('<f4')
+    graph_def = graph_pb2.GraphDef()
+    graph_def.versions.producer = 27
+    node = graph_def.node.add()
+    node.name = 'data'
+    node.op = 'Placeholder'
+    node.attr['dtype'].type = DT_FLOAT
+    # Payload lengths whose varints take 3 and 4 bytes, the same payload
+    # twice, the same bytes as another dtype, and one left in memory
+    _const(graph_def, 'conv1/weights', weights, DT_FLOAT)
+    _const(graph_def, 'conv2/weights', weights, DT_FLOAT)
+    _const(graph_def, 'ids', weights.view('<i4'), DT_INT32)
+    _const(graph_def, 'fc/weights', rng.randn(2100, 1000).astype('<f4'), DT_FLOAT)
+    _const(graph_def, 'shape', np.array([1, -1], dtype='<i4'), DT_INT32)
+    for name in ('conv1', 'conv2'):
+        node = graph_def.node.add()
+        node.name = name
+        node.op = 'Conv2D'
+        node.input.extend(['data', name + '/weights'])
+        node.attr['T'].type = DT_FLOAT
+        node.attr['padding'].s = b'SAME'
+        node.attr['strides'].list.i.extend([1, 1, 1, 1])
+    return graph_def
+
+
+@unittest.skipIf(graph_pb2 is None, 'TensorFlow is not installed')
+class ConstSpillStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # No allowance: every payload from SPILL_MIN_BYTES on is spilled
+        self.store = const_spill.ConstSpillStore(0, self.tmp.name)
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def _spilled_graph_def(self):
+        original = _graph_def()
+        graph_def = graph_pb2.GraphDef()
+        graph_def.CopyFrom(original)
+        for node in graph_def.node:
+            if node.op == 'Const':
+                self.store.put(node, node.attr['value'].tensor.tensor_content)
+        return original, graph_def
+
+    def test_shared_entries(self):
+        original, graph_def = self._spilled_graph_def()
+        spilled = [n.name for n in graph_def.node if self.store.is_spilled(n)]
+        self.assertEqual(spilled, ['conv1/weights', 'conv2/weights', 'ids', 'fc/weights'])
+        self.assertEqual(self.store.spilled_tensors, 4)
+        # conv1 and conv2 weights in one entry, ids has the same bytes too
+        self.assertEqual(len(self.store.entries), 2)
+        nodes = dict((n.name, n) for n in graph_def.node)
+        self.assertEqual(nodes['conv1/weights'].attr['_spill'].i, nodes['conv2/weights'].attr['_spill'].i)
+        self.assertEqual(nodes['ids'].attr['_spill'].i, nodes['conv1/weights'].attr['_spill'].i)
+        for offset, _ in self.store.entries:
+            self.assertEqual(offset % const_spill.ALIGNMENT, 0)
+        expected = dict((n.name, n.attr['value'].tensor.tensor_content) for n in original.node if n.op == 'Const')
+        for name in spilled:
+            self.assertEqual(self.store.payload(nodes[name]).tobytes(), expected[name])
+            self.store.release(nodes[name])
+
+    def test_streamed_graph_def(self):
+        original, graph_def = self._spilled_graph_def()
+        for chunk_size in (const_spill.CHUNK_SIZE, 4096):
+            with mock.patch.object(const_spill, 'CHUNK_SIZE', chunk_size):
+                stream = io.BytesIO()
+                written = self.store.write_graph_def(graph_def, stream)
+            data = stream.getvalue()
+            self.assertEqual(written, len(data))
+            self.assertEqual(len(data), original.ByteSize())
+            streamed = graph_pb2.GraphDef()
+            streamed.ParseFromString(data)
+            self.assertEqual(streamed, original)
+            self.assertEqual(streamed.SerializeToString(deterministic=True), original.SerializeToString(deterministic=True))
+
+
+def _onnx_model():
+    # Two convolutions with the same weights under different names, added
+    rng = np.random.RandomState(0)
+    weights = (rng.randn(64, 16, 5, 5) * 0.05).astype(np.float32)
+    initializers = [
+        numpy_helper.from_array(weights, 'conv1_W'),
+        numpy_helper.from_array(weights.copy(), 'conv2_W'),
+        numpy_helper.from_array((rng.randn(64, 64, 3, 3) * 0.05).astype(np.float32), 'conv3_W'),
+        numpy_helper.from_array(np.zeros(64, dtype=np.float32), 'conv3_B'),
+    ]
+    nodes = [
+        helper.make_node('Conv', ['data', 'conv1_W'], ['conv1'], name='conv1', kernel_shape=[5, 5], pads=[2, 2, 2, 2]),
+        helper.make_node('Conv', ['data', 'conv2_W'], ['conv2'], name='conv2', kernel_shape=[5, 5], pads=[2, 2, 2, 2]),
+        helper.make_node('Add', ['conv1', 'conv2'], ['sum'], name='sum'),
+        helper.make_node('Conv', ['sum', 'conv3_W', 'conv3_B'], ['conv3'], name='conv3', kernel_shape=[3, 3], pads=[1, 1, 1, 1]),
+    ]
+    graph = helper.make_graph(
+        nodes, 'spill', [helper.make_tensor_value_info('data', onnx.TensorProto.FLOAT, [1, 16, 32, 32])],
+        [helper.make_tensor_value_info('conv3', onnx.TensorProto.FLOAT, [1, 64, 32, 32])], initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid('', 9)])
+
+
+@unittest.skipIf(onnx2tf is None or not hasattr(tf, 'Session'), 'onnx2tf needs onnx and the TensorFlow 1 API')
+class ConvertOnnxStreamedTest(unittest.TestCase):
+    def test_max_memory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            model = os.path.join(tmp, 'model.onnx')
+            onnx.save(_onnx_model(), model)
+            in_memory = os.path.join(tmp, 'in_memory.pb')
+            streamed = os.path.join(tmp, 'streamed.pb')
+            onnx2tf.convert_onnx(model, in_memory, {'weights': True})
+            # A budget below the RSS already in use spills every large payload
+            report = onnx2tf.convert_onnx(model, streamed, {'weights': True, 'max_memory': 1})
+            # The initializers and the Conv2D kernels made from them, six
+            # payloads of two distinct values: one entry each
+            self.assertEqual(report['memory']['spilled_tensors'], 6)
+            self.assertEqual(report['memory']['spill_file_bytes'], (64 * 16 * 5 * 5 + 64 * 64 * 3 * 3) * 4)
+            graph_defs = []
+            for path in (in_memory, streamed):
+                graph_def = graph_pb2.GraphDef()
+                with open(path, 'rb') as f:
+                    graph_def.ParseFromString(f.read())
+                graph_defs.append(graph_def)
+            self.assertEqual(graph_defs[1], graph_defs[0])
+            self.assertEqual(os.path.getsize(streamed), os.path.getsize(in_memory))
+
+
+if __name__ == '__main__':
+    unittest.main()
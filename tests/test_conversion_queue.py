@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# The shared-filesystem queue on a temporary directory, with a stand-in
+# frontend so no converter runs. Worker processes are spawned and import this
+# module by name.
+
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conversion_queue
+
+
+def fake_convert(model_path, output_path, options):
+    # Logs each run, then fails or writes the output
+    with open(options['log'], 'a') as f:
+        f.write('%s %d %r\n' % (os.path.basename(model_path), os.getpid(), time.time()))
+    time.sleep(options.get('seconds', 0))
+    if options.get('fail'):
+        raise RuntimeError('cannot convert %s' % model_path)
+    with open(output_path, 'wb') as f:
+        f.write(b'converted')
+    return {'output_bytes': 9, 'unsupported_types': []}
+
+
+conversion_queue.FRONTENDS['fake'] = (__name__, 'fake_convert')
+
+
+def _work_process(queue_dir):
+    conversion_queue.work(queue_dir, None, lease_timeout=30.0, poll_interval=0.05, exit_when_empty=True)
+
+
+def _runs(log):
+    with open(log) as f:
+        return [line.split() for line in f]
+
+
+class ConversionQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = os.path.join(self.tmp.name, 'queue')
+        self.log = os.path.join(self.tmp.name, 'runs.log')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _submit(self, name, **options):
+        model = os.path.join(self.tmp.name, name)
+        with open(model, 'w') as f:
+            f.write('model')
+        options['log'] = self.log
+        return conversion_queue.submit(self.queue, model, frontend='fake', options=options, max_attempts=3, retry_delay=0.2)
+
+    def _files(self, state):
+        return conversion_queue._job_files(self.queue, state)
+
+    def test_each_job_done_once(self):
+        jobs = [self._submit('model%02d.onnx' % i, seconds=0.05) for i in range(12)]
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=_work_process, args=(self.queue,)) for _ in range(3)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join(60)
+            self.assertEqual(p.exitcode, 0)
+        self.assertEqual(self._files('done'), sorted(job + '.json' for job in jobs))
+        for state in ('pending', 'leased', 'failed'):
+            self.assertEqual(self._files(state), [])
+        runs = _runs(self.log)
+        self.assertEqual(sorted(run[0] for run in runs), ['model%02d.onnx' % i for i in range(12)])
+        self.assertGreater(len(set(run[1] for run in runs)), 1)
+        for i in range(12):
+            with open(os.path.join(self.tmp.name, 'model%02d.pb' % i), 'rb') as f:
+                self.assertEqual(f.read(), b'converted')
+
+    def test_failing_job(self):
+        job = self._submit('broken.onnx', fail=True)
+        self.assertEqual(conversion_queue.work(self.queue, 'w', poll_interval=0.02, exit_when_empty=True), 0)
+        self.assertEqual(self._files('failed'), [job + '.json'])
+        self.assertEqual(self._files('pending'), [])
+        with open(os.path.join(self.queue, 'failed', job + '.json')) as f:
+            spec = json.load(f)
+        self.assertEqual(spec['attempts'], 3)
+        self.assertEqual(len(spec['errors']), 3)
+        self.assertIn('RuntimeError: cannot convert', spec['errors'][-1]['error'])
+        # Retried after retry_delay, then twice that
+        times = [float(run[2]) for run in _runs(self.log)]
+        self.assertEqual(len(times), 3)
+        self.assertGreaterEqual(times[1] - times[0], 0.2)
+        self.assertGreaterEqual(times[2] - times[1], 0.4)
+
+    def test_stale_lease_reaped(self):
+        job = self._submit('orphan.onnx')
+        lease = conversion_queue.claim(self.queue, 'dead', lease_timeout=1.0)
+        self.assertEqual(lease.spec['id'], job)
+        # The worker died: no more heartbeats
+        lease._stop.set()
+        lease._thread.join()
+        past = time.time() - 5
+        os.utime(lease.path, (past, past))
+        self.assertEqual(conversion_queue.work(self.queue, 'alive', lease_timeout=1.0, poll_interval=0.02, exit_when_empty=True), 1)
+        self.assertEqual(self._files('done'), [job + '.json'])
+        self.assertEqual(self._files('leased'), [])
+        with open(os.path.join(self.queue, 'done', job + '.json')) as f:
+            spec = json.load(f)
+        self.assertEqual(spec['worker'], 'alive')
+        self.assertEqual(spec['attempts'], 2)
+        self.assertEqual(spec['errors'][0]['error'], 'Lease of dead expired')
+        self.assertEqual(len(_runs(self.log)), 1)
+
+    def test_fresh_lease_given_back(self):
+        # The owner touches its lease between the reaper's stat and rename
+        job = self._submit('busy.onnx')
+        lease = conversion_queue.claim(self.queue, 'busy', lease_timeout=1.0)
+        lease._stop.set()
+        lease._thread.join()
+        past = time.time() - 5
+        os.utime(lease.path, (past, past))
+        rename = os.rename
+
+        def heartbeat_then_rename(src, dst):
+            if src == lease.path:
+                os.utime(src, None)
+            rename(src, dst)
+
+        with mock.patch.object(conversion_queue.os, 'rename', heartbeat_then_rename):
+            self.assertEqual(conversion_queue.reap_stale(self.queue, 'reaper', lease_timeout=1.0), 0)
+        self.assertTrue(os.path.exists(lease.path))
+        self.assertEqual(self._files('leased'), ['%s@busy.json' % job])
+        self.assertEqual(self._files('pending'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
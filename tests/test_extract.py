@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# --outputs/--inputs slices cut mid-network: the cut points become
+# Placeholders shaped like the tensors they replace, so the layers after them
+# (InnerProduct, Flatten, Reshape, MaxPool, Gemm) can be converted.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+try:
+    import caffe2tf
+except ImportError:
+    caffe2tf = None
+
+try:
+    import onnx
+    from onnx import helper, numpy_helper
+    import onnx2tf
+except ImportError:
+    onnx2tf = None
+
+TF1 = tf is not None and hasattr(tf, 'Session')
+
+NET = b'''
+name: "cut"
+layer { name: "data" type: "Input" top: "data" input_param { shape { dim: 1 dim: 3 dim: 32 dim: 32 } } }
+layer { name: "conv1" type: "Convolution" bottom: "data" top: "conv1" convolution_param { num_output: 8 kernel_size: 3 pad: 1 } }
+layer { name: "relu1" type: "ReLU" bottom: "conv1" top: "conv1" }
+layer { name: "pool1" type: "Pooling" bottom: "conv1" top: "pool1" pooling_param { pool: MAX kernel_size: 2 stride: 2 } }
+layer { name: "flat" type: "Flatten" bottom: "pool1" top: "flat" }
+layer { name: "fc" type: "InnerProduct" bottom: "pool1" top: "fc" inner_product_param { num_output: 10 } }
+layer { name: "reshape" type: "Reshape" bottom: "pool1" top: "reshape" reshape_param { shape { dim: 0 dim: -1 } } }
+layer { name: "fc2" type: "InnerProduct" bottom: "fc" top: "fc2" inner_product_param { num_output: 4 } }
+'''
+
+
+def _placeholders(graph_def):
+    return dict((n.name, [d.size for d in n.attr['shape'].shape.dim]) for n in graph_def.node if n.op == 'Placeholder')
+
+
+@unittest.skipIf(caffe2tf is None or not TF1, 'caffe2tf needs Caffe\'s caffe_pb2 and the TensorFlow 1 API')
+class CaffeSubnetTest(unittest.TestCase):
+    def _convert(self, outputs, inputs, net=NET):
+        report = caffe2tf.conversion_report.new_report('caffe')
+        return caffe2tf.build_caffe_graph(net, report, {'outputs': outputs, 'inputs': inputs})
+
+    def test_parse_cut_inputs(self):
+        self.assertEqual(caffe2tf.parse_cut_inputs('pool5:1,512,7,7,rois'), {'pool5': [1, 512, 7, 7], 'rois': None})
+        self.assertEqual(caffe2tf.parse_cut_inputs('a,b'), {'a': None, 'b': None})
+        self.assertEqual(caffe2tf.parse_cut_inputs(''), {})
+
+    def test_shape_from_full_net(self):
+        for outputs in ('fc', 'flat', 'reshape'):
+            graph_def = self._convert(outputs, 'pool1')
+            self.assertEqual(_placeholders(graph_def), {'pool1': [1, 16, 16, 8]})
+            self.assertIn(outputs, [n.name for n in graph_def.node])
+        # A 2-D cut point
+        self.assertEqual(_placeholders(self._convert('fc2', 'fc')), {'fc': [1, 10]})
+
+    def test_given_shape(self):
+        graph_def = self._convert('fc', 'pool1:1,8,4,4')
+        self.assertEqual(_placeholders(graph_def), {'pool1': [1, 4, 4, 8]})
+
+    def test_unknown_shape(self):
+        net = NET.replace(b' input_param { shape { dim: 1 dim: 3 dim: 32 dim: 32 } }', b'')
+        with self.assertRaisesRegex(ValueError, 'cut blob "pool1".*--inputs pool1:N,C,H,W'):
+            self._convert('fc', 'pool1', net)
+        # A given shape needs no inference
+        self.assertEqual(_placeholders(self._convert('fc', 'pool1:1,8,16,16', net)), {'pool1': [1, 16, 16, 8]})
+
+
+def _onnx_model():
+    initializers = [
+        numpy_helper.from_array(np.zeros((8, 3, 3, 3), dtype=np.float32), 'conv_W'),
+        numpy_helper.from_array(np.zeros((10, 8 * 16 * 16), dtype=np.float32), 'fc_W'),
+    ]
+    nodes = [
+        helper.make_node('Conv', ['data', 'conv_W'], ['conv'], name='conv', kernel_shape=[3, 3], pads=[1, 1, 1, 1]),
+        helper.make_node('Relu', ['conv'], ['relu'], name='relu'),
+        helper.make_node('MaxPool', ['relu'], ['pool'], name='pool', kernel_shape=[2, 2], strides=[2, 2]),
+        helper.make_node('Flatten', ['pool'], ['flat'], name='flat', axis=1),
+        helper.make_node('Gemm', ['flat', 'fc_W'], ['fc'], name='fc', transB=1),
+        # Shape inference knows nothing of this one
+        helper.make_node('Scramble', ['relu'], ['scrambled'], name='scrambled', domain='custom'),
+        helper.make_node('Relu', ['scrambled'], ['out'], name='out'),
+    ]
+    # No value_info: cut points get their shapes from inference only
+    graph = helper.make_graph(
+        nodes, 'cut', [helper.make_tensor_value_info('data', onnx.TensorProto.FLOAT, [1, 3, 32, 32])],
+        [helper.make_tensor_value_info('fc', onnx.TensorProto.FLOAT, [1, 10])], initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 9), helper.make_opsetid('custom', 1)])
+    return model.SerializeToString()
+
+
+@unittest.skipIf(onnx2tf is None or not TF1, 'onnx2tf needs onnx and the TensorFlow 1 API')
+class OnnxSubgraphTest(unittest.TestCase):
+    def _convert(self, outputs, inputs):
+        report = onnx2tf.conversion_report.new_report('onnx')
+        return onnx2tf.build_onnx_graph(_onnx_model(), report, {'outputs': outputs, 'inputs': inputs})
+
+    def test_shape_from_inference(self):
+        for outputs, inputs, shape in (('fc', 'relu', [1, 32, 32, 8]), ('flat', 'relu', [1, 32, 32, 8]), ('fc', 'pool', [1, 16, 16, 8])):
+            graph_def = self._convert(outputs, inputs)
+            self.assertEqual(_placeholders(graph_def), {inputs: shape})
+            self.assertIn(outputs, [n.name for n in graph_def.node])
+
+    def test_unknown_shape(self):
+        with self.assertRaisesRegex(ValueError, 'cut tensor "scrambled"'):
+            self._convert('out', 'scrambled')
+
+
+if __name__ == '__main__':
+    unittest.main()
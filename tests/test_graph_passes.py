@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# dedup_constants, reduce_weight_precision (weights only, other Consts stay
+# exact) and assign_name_scopes on small synthetic GraphDefs.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import graph_passes
+
+try:
+    from tensorflow.core.framework import graph_pb2
+except ImportError:
+    graph_pb2 = None
+
+# TensorFlow DataType enum
+DT_INT32 = 3
+
+
+def _const(graph_def, name, array):
+    node = graph_def.node.add()
+    node.name = name
+    node.op = 'Const'
+    node.attr['dtype'].type = graph_passes.DT_FLOAT
+    tensor = node.attr['value'].tensor
+    tensor.dtype = graph_passes.DT_FLOAT
+    for size in array.shape:
+        tensor.tensor_shape.dim.add().size = size
+    tensor.tensor_content = array.astype('<f4').tobytes()
+
+
+def _raw_const(graph_def, name, dtype, shape, content):
+    node = graph_def.node.add()
+    node.name = name
+    node.op = 'Const'
+    node.attr['dtype'].type = dtype
+    tensor = node.attr['value'].tensor
+    tensor.dtype = dtype
+    for size in shape:
+        tensor.tensor_shape.dim.add().size = size
+    tensor.tensor_content = content
+    return node
+
+
+def _op(graph_def, name, op, inputs):
+    node = graph_def.node.add()
+    node.name = name
+    node.op = op
+    node.input.extend(inputs)
+
+
+def _inputs(graph_def):
+    return dict((n.name, list(n.input)) for n in graph_def.node)
+
+
+@unittest.skipIf(graph_pb2 is None, 'TensorFlow is not installed')
+class DedupConstantsTest(unittest.TestCase):
+    def _graph_def(self):
+        content = np.arange(24, dtype='<f4').tobytes()
+        graph_def = graph_pb2.GraphDef()
+        _op(graph_def, 'data', 'Placeholder', [])
+        _raw_const(graph_def, 'a', graph_passes.DT_FLOAT, (2, 3, 4), content)
+        _raw_const(graph_def, 'b', graph_passes.DT_FLOAT, (2, 3, 4), content)
+        _raw_const(graph_def, 'c', graph_passes.DT_FLOAT, (2, 3, 4), content)
+        # Same bytes, other dtype or shape
+        _raw_const(graph_def, 'as_int', DT_INT32, (2, 3, 4), content)
+        _raw_const(graph_def, 'reshaped', graph_passes.DT_FLOAT, (6, 4), content)
+        _op(graph_def, 'add', 'Add', ['data', 'b'])
+        _op(graph_def, 'mul', 'Mul', ['c:0', 'a'])
+        _op(graph_def, 'sub', 'Sub', ['as_int', 'reshaped', '^c'])
+        return graph_def
+
+    def test_duplicates_merged(self):
+        graph_def = self._graph_def()
+        self.assertEqual(graph_passes.dedup_constants(graph_def)[0], 2)
+        self.assertEqual([n.name for n in graph_def.node], ['data', 'a', 'as_int', 'reshaped', 'add', 'mul', 'sub'])
+        inputs = _inputs(graph_def)
+        # Ports and control inputs are kept, only the name changes
+        self.assertEqual(inputs['add'], ['data', 'a'])
+        self.assertEqual(inputs['mul'], ['a:0', 'a'])
+        self.assertEqual(inputs['sub'], ['as_int', 'reshaped', '^a'])
+
+    def test_bytes_saved(self):
+        graph_def = self._graph_def()
+        size = graph_def.ByteSize()
+        removed = [n.ByteSize() for n in graph_def.node if n.name in ('b', 'c')]
+        bytes_saved = graph_passes.dedup_constants(graph_def)[1]
+        self.assertEqual(bytes_saved, sum(removed))
+        # Each removed node held its 96 byte payload
+        self.assertGreater(bytes_saved, 2 * 96)
+        # The GraphDef also loses each node's field tag and two byte length
+        self.assertEqual(size - graph_def.ByteSize(), bytes_saved + 2 * 3)
+
+    def test_nothing_to_merge(self):
+        graph_def = self._graph_def()
+        graph_passes.dedup_constants(graph_def)
+        before = graph_pb2.GraphDef()
+        before.CopyFrom(graph_def)
+        self.assertEqual(graph_passes.dedup_constants(graph_def), (0, 0))
+        self.assertEqual(graph_def, before)
+
+
+@unittest.skipIf(graph_pb2 is None, 'TensorFlow is not installed')
+class ReduceWeightPrecisionTest(unittest.TestCase):
+    def _graph_def(self):
+        rng = np.random.RandomState(0)
+        graph_def = graph_pb2.GraphDef()
+        _op(graph_def, 'data', 'Placeholder', [])
+        _const(graph_def, 'conv/filter', rng.randn(3, 3, 16, 32))
+        _op(graph_def, 'conv', 'Conv2D', ['data', 'conv/filter'])
+        for param in ('scale', 'offset', 'mean', 'variance'):
+            _const(graph_def, 'bn/' + param, rng.rand(512))
+        _op(graph_def, 'bn', 'FusedBatchNorm', ['conv', 'bn/scale', 'bn/offset', 'bn/mean', 'bn/variance'])
+        _const(graph_def, 'fc/weights', rng.randn(512, 10))
+        _op(graph_def, 'fc', 'MatMul', ['bn', 'fc/weights', '^conv/filter'])
+        # Not weights: PriorBox priors, a MatMul a operand, a filter also
+        # read as a plain value
+        _const(graph_def, 'priorbox', rng.rand(2, 4096))
+        _op(graph_def, 'priors', 'Identity', ['priorbox'])
+        _const(graph_def, 'table', rng.randn(300, 512))
+        _op(graph_def, 'lookup', 'MatMul', ['table', 'fc/weights'])
+        _const(graph_def, 'shared', rng.randn(3, 3, 32, 32))
+        _op(graph_def, 'conv2', 'Conv2D', ['conv', 'shared'])
+        _op(graph_def, 'shared_sum', 'Sum', ['shared', 'conv'])
+        return graph_def
+
+    def test_weight_consts(self):
+        self.assertEqual(graph_passes.weight_consts(self._graph_def()), set([
+            'conv/filter', 'bn/scale', 'bn/offset', 'bn/mean', 'bn/variance', 'fc/weights']))
+
+    def test_only_weights_reduced(self):
+        for weight_dtype in ('fp16', 'int8'):
+            original = self._graph_def()
+            graph_def = self._graph_def()
+            reduced = graph_passes.reduce_weight_precision(graph_def, weight_dtype)[0]
+            self.assertEqual(reduced, 6)
+            nodes = dict((n.name, n) for n in graph_def.node)
+            before = dict((n.name, n) for n in original.node)
+            for name in ('priorbox', 'table', 'shared'):
+                self.assertEqual(nodes[name], before[name])
+            for name in ('conv/filter', 'bn/mean', 'fc/weights'):
+                # Still readable as float32 under the original name
+                self.assertEqual(nodes[name].op, 'Cast' if weight_dtype == 'fp16' else 'Mul')
+                self.assertIn(name + '/' + weight_dtype, nodes)
+
+
+@unittest.skipIf(graph_pb2 is None, 'TensorFlow is not installed')
+class AssignNameScopesTest(unittest.TestCase):
+    def _graph_def(self):
+        # Three ResNet stages of three blocks, each closed by a residual Add
+        graph_def = graph_pb2.GraphDef()
+        _op(graph_def, 'data', 'Placeholder', [])
+        _op(graph_def, 'res2', 'Identity', ['data'])
+        last = 'res2'
+        for stage in (2, 3, 4):
+            for block in 'abc':
+                name = 'res%d%s' % (stage, block)
+                bn = 'bn%d%s' % (stage, block)
+                _raw_const(graph_def, name + '_branch2a/weights', graph_passes.DT_FLOAT, (1,), b'\0\0\0\0')
+                _op(graph_def, name + '_branch2a', 'Conv2D', [last, name + '_branch2a/weights'])
+                _op(graph_def, bn, 'FusedBatchNorm', [name + '_branch2a'])
+                _op(graph_def, name + '_relu', 'Relu', [bn + ':0'])
+                _op(graph_def, name, 'Add', [last, name + '_relu', '^' + bn])
+                last = name
+        _raw_const(graph_def, 'fc/weights', graph_passes.DT_FLOAT, (1,), b'\0\0\0\0')
+        _op(graph_def, 'fc', 'MatMul', [last + ':0', 'fc/weights'])
+        return graph_def
+
+    def test_scopes(self):
+        graph_def = self._graph_def()
+        count = len(graph_def.node)
+        before, after = graph_passes.assign_name_scopes(graph_def, max_top_level=8)
+        self.assertEqual(before, 39)
+        self.assertLessEqual(after, 8)
+        names = [n.name for n in graph_def.node]
+        self.assertEqual(len(set(names)), count)
+        self.assertEqual(len(set(name.split('/', 1)[0] for name in names)), after)
+        for node in graph_def.node:
+            for input_name in node.input:
+                self.assertIn(graph_passes.split_input(input_name)[1], names)
+        inputs = _inputs(graph_def)
+        self.assertEqual(inputs['res3/res3b/res3b'], ['res3/res3a/res3a', 'res3/res3b/res3b_relu', '^res3/res3b/bn3b'])
+        self.assertEqual(inputs['res3/res3b/res3b_relu'], ['res3/res3b/bn3b:0'])
+        # Weights stay with their layer
+        self.assertIn('res4/res4c/res4c_branch2a/weights', names)
+
+    def test_stable(self):
+        graph_def = self._graph_def()
+        after = graph_passes.assign_name_scopes(graph_def, max_top_level=8)[1]
+        scoped = graph_pb2.GraphDef()
+        scoped.CopyFrom(graph_def)
+        self.assertEqual(graph_passes.assign_name_scopes(graph_def, max_top_level=8), (after, after))
+        self.assertEqual(graph_def, scoped)
+
+    def test_narrow_graph_unchanged(self):
+        graph_def = self._graph_def()
+        before = graph_pb2.GraphDef()
+        before.CopyFrom(graph_def)
+        self.assertEqual(graph_passes.assign_name_scopes(graph_def, max_top_level=39), (39, 39))
+        self.assertEqual(graph_def, before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Round trip of a sharded GraphDef: write_sharded, ShardedGraphReader and the
+# --check of the command line tool.
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sharded_graphdef
+
+try:
+    from tensorflow.core.framework import graph_pb2
+except ImportError:
+    graph_pb2 = None
+
+# TensorFlow DataType enum
+DT_FLOAT = 1
+DT_INT32 = 3
+DT_HALF = 19
+
+
+def _const(graph_def, name, array, dtype):
+    node = graph_def.node.add()
+    node.name = name
+    node.op = 'Const'
+    node.attr['dtype'].type = dtype
+    tensor = node.attr['value'].tensor
+    tensor.dtype = dtype
+    for size in array.shape:
+        tensor.tensor_shape.dim.add().size = size
+    tensor.tensor_content = array.tobytes()
+    return node
+
+
+def _graph_def():
+    rng = np.random.RandomState(0)
+    graph_def = graph_pb2.GraphDef()
+    graph_def.versions.producer = 27
+    _const(graph_def, 'conv1/weights', rng.randn(64, 16, 7, 7).astype('<f4'), DT_FLOAT)
+    _const(graph_def, 'conv2/weights', rng.randn(128, 64, 3, 3).astype('<f4'), DT_FLOAT)
+    _const(graph_def, 'fc/weights', rng.randn(256, 300).astype('<f2'), DT_HALF)
+    _const(graph_def, 'ids', np.arange(40000, dtype='<i4'), DT_INT32)
+    # Below min_const_bytes, stays in the structure
+    _const(graph_def, 'shape', np.array([1, -1], dtype='<i4'), DT_INT32)
+    node = graph_def.node.add()
+    node.name = 'conv1'
+    node.op = 'Conv2D'
+    node.input.extend(['data', 'conv1/weights'])
+    return graph_def
+
+
+@unittest.skipIf(graph_pb2 is None, 'TensorFlow is not installed')
+class ShardedGraphDefTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'model.pb')
+        self.original = _graph_def()
+        graph_def = graph_pb2.GraphDef()
+        graph_def.CopyFrom(self.original)
+        # Small shards, so the payloads spread over several files
+        sharded_graphdef.write_sharded(graph_def, self.path, shard_bytes=256 * 1024)
+        self.reader = sharded_graphdef.ShardedGraphReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.tmp.cleanup()
+
+    def _check(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            status = sharded_graphdef.main(['-i', self.path, '--check'])
+        return status, out.getvalue()
+
+    def test_round_trip(self):
+        self.assertGreater(len(self.reader.index['shards']), 1)
+        self.assertEqual(sorted(self.reader.tensors), ['conv1/weights', 'conv2/weights', 'fc/weights', 'ids'])
+        # The structure alone is small
+        self.assertLess(os.path.getsize(self.path), 1024)
+        graph_def = self.reader.load_graph_def(materialize=True)
+        # Map fields (attr) are only ordered in deterministic serialization
+        self.assertEqual(graph_def.SerializeToString(deterministic=True), self.original.SerializeToString(deterministic=True))
+        self.assertEqual(graph_def, self.original)
+
+    def test_lazy_tensor(self):
+        self.assertEqual(self.reader._maps, {})
+        weights = self.reader.tensor('fc/weights')
+        self.assertEqual(weights.dtype, np.dtype('<f2'))
+        self.assertEqual(weights.shape, (256, 300))
+        # Only the shard holding the tensor is mapped
+        self.assertEqual(list(self.reader._maps), [self.reader.tensors['fc/weights']['shard']])
+        expected = next(n for n in self.original.node if n.name == 'fc/weights')
+        self.assertEqual(weights.tobytes(), expected.attr['value'].tensor.tensor_content)
+        ids = self.reader.tensor('ids')
+        self.assertEqual(ids.dtype, np.dtype('<i4'))
+        self.assertEqual(ids.shape, (40000,))
+        self.assertEqual(int(ids[12345]), 12345)
+        self.reader.close()
+
+    def test_check(self):
+        status, out = self._check()
+        self.assertEqual(status, 0)
+        self.assertIn('All payloads match', out)
+        self.reader.close()
+        entry = self.reader.tensors['conv2/weights']
+        shard = os.path.join(self.tmp.name, self.reader.index['shards'][entry['shard']])
+        with open(shard, 'r+b') as f:
+            f.seek(entry['offset'] + 100)
+            f.write(b'\xff\xff\xff\xff')
+        status, out = self._check()
+        self.assertEqual(status, 1)
+        self.assertIn('Corrupt tensors (1): conv2/weights', out)
+
+    def test_check_truncated(self):
+        self.reader.close()
+        last = len(self.reader.index['shards']) - 1
+        shard = os.path.join(self.tmp.name, self.reader.index['shards'][last])
+        names = sorted((e['offset'], n) for n, e in self.reader.tensors.items() if e['shard'] == last)
+        names = [n for _, n in names]
+        with open(shard, 'r+b') as f:
+            f.truncate(os.path.getsize(shard) - 10)
+        status, out = self._check()
+        self.assertEqual(status, 1)
+        self.assertIn(names[-1], out)
+        # An emptied or missing shard is reported too
+        with open(shard, 'wb'):
+            pass
+        self.assertEqual(self._check()[0], 1)
+        os.remove(shard)
+        status, out = self._check()
+        self.assertEqual(status, 1)
+        for name in names:
+            self.assertIn(name, out)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Checksums against known values, and event files written at once into one
+# logdir must not overwrite each other.
+
+import os
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tb_event_writer
+
+
+def _records(path):
+    records = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        header = data[offset:offset + 8]
+        length = struct.unpack('<Q', header)[0]
+        assert struct.unpack('<I', data[offset + 8:offset + 12])[0] == tb_event_writer.masked_crc32c(header)
+        record = data[offset + 12:offset + 12 + length]
+        assert struct.unpack('<I', data[offset + 12 + length:offset + 16 + length])[0] == tb_event_writer.masked_crc32c(record)
+        records.append(record)
+        offset += 16 + length
+    return records
+
+
+class Crc32cTest(unittest.TestCase):
+    def test_check_value(self):
+        # The CRC-32C check value (RFC 3720)
+        self.assertEqual(tb_event_writer.crc32c(b'123456789'), 0xE3069283)
+        self.assertEqual(tb_event_writer.crc32c(b''), 0)
+
+    def test_tfrecord_frame(self):
+        # tf.io.TFRecordWriter output for one record
+        frame = bytes.fromhex('0d000000000000003c37b834627261696e2e4576656e743a32ee01067c')
+        self.assertEqual(tb_event_writer.encode_record(b'brain.Event:2'), frame)
+
+    def test_fallbacks_agree(self):
+        # Long enough for the numpy lanes, with a tail that does not fill a lane
+        data = os.urandom(tb_event_writer._LANES * 100 + 77)
+        expected = tb_event_writer._crc32c_update(0xFFFFFFFF, data) ^ 0xFFFFFFFF
+        with mock.patch.object(tb_event_writer, '_crc32c_native', None):
+            self.assertEqual(tb_event_writer.crc32c(data), expected)
+            if tb_event_writer.np is not None:
+                self.assertEqual(tb_event_writer._crc32c_lanes(0xFFFFFFFF, memoryview(data)) ^ 0xFFFFFFFF, expected)
+
+
+class EventWriterTest(unittest.TestCase):
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            logdir = os.path.join(tmp, 'logs')
+            paths = {}
+
+            def write(i):
+                paths[i] = tb_event_writer.write_graph_event(b'graph %d' % i, logdir)
+
+            threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(set(paths.values())), 8)
+            self.assertEqual(sorted(os.listdir(logdir)), sorted(os.path.basename(p) for p in paths.values()))
+            for i, path in paths.items():
+                self.assertIn('.%d.' % os.getpid(), os.path.basename(path))
+                records = _records(path)
+                self.assertEqual(len(records), 2)
+                self.assertTrue(records[1].endswith(b'graph %d' % i))
+
+    def test_existing_file_kept(self):
+        with tempfile.TemporaryDirectory() as logdir:
+            first = tb_event_writer.write_graph_event(b'first', logdir)
+            with open(first, 'rb') as f:
+                data = f.read()
+            second = tb_event_writer.write_graph_event(b'second', logdir)
+            self.assertNotEqual(first, second)
+            with open(first, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
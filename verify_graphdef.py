@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import sys
+import time
+
+import graphdef_wire
+
+# Attrs reported through the shape comparison instead of as raw attr diffs
+SHAPE_ATTRS = ('shape', '_output_shapes')
+
+
+def local_digest(node):
+    h = hashlib.sha1()
+    h.update(node.op.encode('utf-8'))
+    for key in sorted(node.attrs):
+        h.update(b'\x00' + key.encode('utf-8') + b'\x00')
+        h.update(node.attrs[key])
+    for name in node.inputs:
+        h.update(b'\x01' + name.encode('utf-8'))
+    return h.digest()
+
+
+def subgraph_digests(index):
+    # Merkle digest per node: equal digests mean the node and everything
+    # upstream of it are identical, so the detailed diff can skip them.
+    digests = {}
+    for root in index:
+        if root in digests:
+            continue
+        stack = [(root, False)]
+        on_stack = set()
+        while stack:
+            name, expanded = stack.pop()
+            if name in digests:
+                continue
+            node = index[name]
+            producers = [graphdef_wire.input_node_name(i) for i in node.inputs]
+            if not expanded:
+                on_stack.add(name)
+                stack.append((name, True))
+                for p in producers:
+                    if p in index and p not in digests and p not in on_stack:
+                        stack.append((p, False))
+                continue
+            on_stack.discard(name)
+            h = hashlib.sha1(local_digest(node))
+            for p in producers:
+                # Missing producers and back edges only contribute their name
+                h.update(digests.get(p, p.encode('utf-8')))
+            digests[name] = h.digest()
+    return digests
+
+
+def describe_attr(attr_bytes):
+    if attr_bytes is None:
+        return '<unset>'
+    value = graphdef_wire.attr_scalar(attr_bytes)
+    if value is None:
+        return '<%d bytes>' % len(attr_bytes)
+    return repr(value)
+
+
+def diff_node(ref, cand):
+    diffs = []
+    if ref.op != cand.op:
+        diffs.append('op %s -> %s' % (ref.op, cand.op))
+    if ref.inputs != cand.inputs:
+        diffs.append('inputs %s -> %s' % (ref.inputs, cand.inputs))
+    for key in sorted(set(ref.attrs) | set(cand.attrs)):
+        if key in SHAPE_ATTRS:
+            continue
+        ref_attr = ref.attrs.get(key)
+        cand_attr = cand.attrs.get(key)
+        if ref_attr != cand_attr:
+            diffs.append('attr %s %s -> %s' % (key, describe_attr(ref_attr), describe_attr(cand_attr)))
+    ref_shape = graphdef_wire.node_shape(ref)
+    cand_shape = graphdef_wire.node_shape(cand)
+    if ref_shape != cand_shape:
+        diffs.append('shape %s -> %s' % (ref_shape, cand_shape))
+    return diffs
+
+
+def verify(reference_nodes, candidate_nodes):
+    ref_index = dict((n.name, n) for n in reference_nodes)
+    cand_index = dict((n.name, n) for n in candidate_nodes)
+    ref_digests = subgraph_digests(ref_index)
+    cand_digests = subgraph_digests(cand_index)
+
+    missing = [n.name for n in reference_nodes if n.name not in cand_index]
+    extra = [n.name for n in candidate_nodes if n.name not in ref_index]
+    identical = 0
+    changed = []
+    for node in reference_nodes:
+        if node.name not in cand_index:
+            continue
+        if ref_digests[node.name] == cand_digests[node.name]:
+            identical += 1
+            continue
+        diffs = diff_node(node, cand_index[node.name])
+        if len(diffs) > 0:
+            changed.append((node.name, diffs))
+        else:
+            # Locally equal, the difference is upstream and reported there
+            identical += 1
+    return missing, extra, changed, identical
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Diffs a converted TensorFlow GraphDef against a reference GraphDef.')
+    parser.add_argument('-r', '--reference', required=True, help='Reference (golden) .pb file')
+    parser.add_argument('-c', '--candidate', required=True, help='Newly converted .pb file to check')
+    parser.add_argument('--max-report', type=int, default=50, help='Maximum number of entries printed per section. Default is 50.')
+    args = parser.parse_args(args)
+
+    start = time.time()
+    reference_nodes = graphdef_wire.read_graph_def(args.reference)
+    candidate_nodes = graphdef_wire.read_graph_def(args.candidate)
+    missing, extra, changed, identical = verify(reference_nodes, candidate_nodes)
+    elapsed = time.time() - start
+
+    print('[i] Reference: ', args.reference, '(%d nodes)' % len(reference_nodes))
+    print('[i] Candidate: ', args.candidate, '(%d nodes)' % len(candidate_nodes))
+    print('[i] Identical nodes: %d' % identical)
+    for title, names in (('Missing in candidate', missing), ('Extra in candidate', extra)):
+        if len(names) > 0:
+            print('%s (%d):' % (title, len(names)))
+            for name in names[:args.max_report]:
+                print('  ', name)
+    if len(changed) > 0:
+        print('Changed nodes (%d):' % len(changed))
+        for name, diffs in changed[:args.max_report]:
+            for d in diffs:
+                print('  ', name + ':', d)
+    num_diffs = len(missing) + len(extra) + len(changed)
+    if num_diffs == 0:
+        print('[i] Graphs match (%.3fs)' % elapsed)
+    else:
+        print('[i] %d differences (%.3fs)' % (num_diffs, elapsed))
+    return 1 if num_diffs > 0 else 0
+
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))